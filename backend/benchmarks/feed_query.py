@@ -0,0 +1,163 @@
+"""
+Benchmark of a feed page query: loading `Tweet` ORM instances with their
+relationships and building the response from them (how the feed was read
+before) against the projected Core query of `User.get_feed`. Reports time
+and peak of memory allocated by Python per page.
+
+Data is inserted in a transaction which is rolled back at the end, so any
+database configured by POSTGRES_* variables can be used. Run from the
+`backend` directory:
+
+    PYTHONPATH=src python -m benchmarks.feed_query --tweets 1000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+
+from benchmarks.serialization import build_dicts
+from database.models import (
+    Media,
+    MediaVariant,
+    Tweet,
+    TweetLike,
+    TweetMedia,
+    User,
+    async_session,
+)
+
+
+async def seed(session, tweets: int, likes: int, medias: int) -> int:
+    """
+    Insert a user with `tweets` tweets, each with `medias` medias and
+    `likes` likes.
+
+    :return: int (id of the user)
+    """
+    user_ids = await session.scalars(
+        insert(User)
+        .values(
+            [
+                {"name": f"bench_{i}", "api_key": f"bench_{i}_{time.time()}"}
+                for i in range(likes + 1)
+            ]
+        )
+        .returning(User.id)
+    )
+    author_id, *liker_ids = user_ids.all()
+    tweet_ids = await session.scalars(
+        insert(Tweet)
+        .values(
+            [
+                {"content": f"Tweet {i}", "author_id": author_id}
+                for i in range(tweets)
+            ]
+        )
+        .returning(Tweet.id)
+    )
+    tweet_ids = tweet_ids.all()
+    if medias:
+        media_ids = await session.scalars(
+            insert(Media)
+            .values(
+                [
+                    {"media_path": f"/medias/bench_{i}.png"}
+                    for i in range(tweets * medias)
+                ]
+            )
+            .returning(Media.id)
+        )
+        media_ids = media_ids.all()
+        await session.execute(
+            insert(MediaVariant),
+            [
+                {
+                    "media_id": media_id,
+                    "width": width,
+                    "height": width // 2,
+                    "media_path": f"/medias/bench_{media_id}_{width}w.webp",
+                }
+                for media_id in media_ids
+                for width in (320, 1080)
+            ],
+        )
+        await session.execute(
+            insert(TweetMedia),
+            [
+                {"tweet_id": tweet_id, "media_id": media_ids[i * medias + j]}
+                for i, tweet_id in enumerate(tweet_ids)
+                for j in range(medias)
+            ],
+        )
+    if likes:
+        await session.execute(
+            insert(TweetLike),
+            [
+                {"tweet_id": tweet_id, "user_id": liker_id}
+                for tweet_id in tweet_ids
+                for liker_id in liker_ids
+            ],
+        )
+    return author_id
+
+
+async def load_orm(session, user_id: int, limit: int) -> list:
+    query = User._feed_page((Tweet,), user_id, limit, None, None)
+    feed = await session.execute(query)
+    return build_dicts(feed.scalars().unique())
+
+
+async def load_rows(session, user_id: int, limit: int) -> list:
+    return await User.get_feed(session, user_id=user_id, limit=limit)
+
+
+async def measure(load, session, user_id: int, limit: int, repeat: int):
+    """
+    :return: tuple (best time in milliseconds, the least peak of allocated
+        memory in KiB, the page)
+    """
+    best_time = best_peak = float("inf")
+    for _ in range(repeat):
+        session.expunge_all()
+        tracemalloc.start()
+        start = time.perf_counter()
+        page = await load(session, user_id, limit)
+        best_time = min(best_time, time.perf_counter() - start)
+        best_peak = min(best_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best_time * 1e3, best_peak / 1024, page
+
+
+async def run(args):
+    async with async_session() as session:
+        user_id = await seed(session, args.tweets, args.likes, args.medias)
+        orm_time, orm_peak, orm_page = await measure(
+            load_orm, session, user_id, args.tweets, args.repeat
+        )
+        rows_time, rows_peak, rows_page = await measure(
+            load_rows, session, user_id, args.tweets, args.repeat
+        )
+        await session.rollback()
+    assert orm_page == rows_page
+    print(f"ORM entities:  {orm_time:8.1f} ms  {orm_peak:10.0f} KiB")
+    print(f"Core rows:     {rows_time:8.1f} ms  {rows_peak:10.0f} KiB")
+    print(
+        f"ratio:         {orm_time / rows_time:8.2f}x  "
+        f"{orm_peak / rows_peak:9.2f}x"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tweets", type=int, default=1000)
+    parser.add_argument("--likes", type=int, default=10)
+    parser.add_argument("--medias", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
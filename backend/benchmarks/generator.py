@@ -0,0 +1,288 @@
+"""
+Generator of a synthetic social graph for load tests: users with a
+power-law distribution of followers, their tweets, likes and medias.
+
+Rows are bulk-loaded by COPY in one transaction and appended to the data
+which is already in the database configured by POSTGRES_* variables.
+Counter triggers are disabled while loading (the tables are locked), and
+the counters and timelines are filled afterwards by a few statements.
+Generated users have api-keys `bench_<id>`. Run from the `backend`
+directory:
+
+    PYTHONPATH=src python -m benchmarks.generator --users 10000
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Dict, List
+
+import asyncpg
+
+from conf import TIMELINE_FANOUT_LIMIT
+from database.models import engine
+
+# Columns of the loaded tables, in the order of loading
+COLUMNS = {
+    "users": ("id", "name", "api_key"),
+    "users_follow": ("id", "user_follower_id", "user_following_id"),
+    "tweets": ("id", "content", "author_id"),
+    "tweet_likes": ("id", "tweet_id", "user_id"),
+    "medias": ("id", "media_path"),
+    "tweet_medias": ("id", "tweet_id", "media_id"),
+}
+
+# Tables whose counters are maintained by triggers, see `database.models`
+COUNTED_TABLES = ("users_follow", "tweet_likes", "tweet_medias")
+
+
+def power_law_weights(count: int, alpha: float, rnd: random.Random):
+    """
+    Weights of popularity `1 / rank ** alpha` with ranks shuffled, so the
+    most popular users are spread over the ids.
+    """
+    ranks = list(range(1, count + 1))
+    rnd.shuffle(ranks)
+    return [1 / rank**alpha for rank in ranks]
+
+
+def sample_count(mean: float, rnd: random.Random) -> int:
+    """
+    Exponentially distributed count with the given mean.
+    """
+    return int(rnd.expovariate(1 / mean)) if mean > 0 else 0
+
+
+def generate_rows(
+    first_ids: Dict[str, int],
+    users: int,
+    follows: float,
+    alpha: float,
+    tweets: float,
+    likes: float,
+    medias: float,
+    seed: int,
+) -> Dict[str, List[tuple]]:
+    """
+    Generate rows of the graph, with ids starting from `first_ids`.
+
+    :param first_ids: dict (table -> first free id)
+    :param users: int (number of users)
+    :param follows: float (mean number of users followed by a user)
+    :param alpha: float (exponent of the power law of popularity)
+    :param tweets: float (mean number of tweets of a user)
+    :param likes: float (mean number of likes of a tweet)
+    :param medias: float (share of tweets with an attached media)
+    :param seed: int (seed of the random generator)
+    :return: dict (table -> rows in the column order of `COLUMNS`)
+    """
+    rnd = random.Random(seed)
+    user_ids = list(range(first_ids["users"], first_ids["users"] + users))
+    weights = power_law_weights(users, alpha, rnd)
+    cum_weights = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    rows = {table: [] for table in COLUMNS}
+    rows["users"] = [
+        (user_id, f"bench_{user_id}", f"bench_{user_id}")
+        for user_id in user_ids
+    ]
+
+    follow_id = first_ids["users_follow"]
+    for follower_id in user_ids:
+        count = min(sample_count(follows, rnd), users - 1)
+        followed = set(rnd.choices(user_ids, cum_weights=cum_weights, k=count))
+        followed.discard(follower_id)
+        for following_id in sorted(followed):
+            rows["users_follow"].append((follow_id, follower_id, following_id))
+            follow_id += 1
+
+    # Popular authors write more and get more likes
+    mean_weight = total / users
+    tweet_id = first_ids["tweets"]
+    tweet_ids, tweet_weights = [], []
+    for user_id, weight in zip(user_ids, weights):
+        scale = min(weight / mean_weight, 10)
+        for _ in range(sample_count(tweets * max(scale, 0.5), rnd)):
+            rows["tweets"].append(
+                (tweet_id, f"Benchmark tweet {tweet_id}", user_id)
+            )
+            tweet_ids.append(tweet_id)
+            tweet_weights.append(weight)
+            tweet_id += 1
+
+    like_id = first_ids["tweet_likes"]
+    liked = set()
+    if tweet_ids:
+        targets = rnd.choices(
+            tweet_ids, weights=tweet_weights, k=int(len(tweet_ids) * likes)
+        )
+        for target in targets:
+            pair = (target, rnd.choice(user_ids))
+            if pair not in liked:
+                liked.add(pair)
+                rows["tweet_likes"].append((like_id, *pair))
+                like_id += 1
+
+    media_id = first_ids["medias"]
+    link_id = first_ids["tweet_medias"]
+    for target in tweet_ids:
+        if rnd.random() < medias:
+            rows["medias"].append((media_id, f"/medias/bench_{media_id}.png"))
+            rows["tweet_medias"].append((link_id, target, media_id))
+            media_id += 1
+            link_id += 1
+    return rows
+
+
+# Fill the counters of the loaded rows, the same as the triggers would do,
+# every query gets the first loaded id of its table
+COUNTERS = (
+    (
+        "users_follow",
+        """
+        UPDATE users SET followers_count = followers_count + c.count,
+            version = version + c.count
+        FROM (
+            SELECT user_following_id AS id, count(*) FROM users_follow
+            WHERE id >= $1 GROUP BY user_following_id
+        ) AS c WHERE users.id = c.id
+        """,
+    ),
+    (
+        "users_follow",
+        """
+        UPDATE users SET following_count = following_count + c.count,
+            version = version + c.count
+        FROM (
+            SELECT user_follower_id AS id, count(*) FROM users_follow
+            WHERE id >= $1 GROUP BY user_follower_id
+        ) AS c WHERE users.id = c.id
+        """,
+    ),
+    (
+        "tweet_likes",
+        """
+        UPDATE tweets SET like_count = like_count + c.count,
+            version = version + c.count
+        FROM (
+            SELECT tweet_id AS id, count(*) FROM tweet_likes
+            WHERE id >= $1 GROUP BY tweet_id
+        ) AS c WHERE tweets.id = c.id
+        """,
+    ),
+    (
+        "tweet_medias",
+        """
+        UPDATE medias SET ref_count = ref_count + c.count
+        FROM (
+            SELECT media_id AS id, count(*) FROM tweet_medias
+            WHERE id >= $1 GROUP BY media_id
+        ) AS c WHERE medias.id = c.id
+        """,
+    ),
+)
+
+# Authors with too many followers read on fan-out, see `UserTimeline.fan_out`
+FANOUT_ON_READ = """
+    UPDATE users SET fanout_on_read = true
+    WHERE id >= $1 AND followers_count > $2
+"""
+
+TIMELINES = """
+    INSERT INTO user_timelines (user_id, tweet_id, author_id)
+    SELECT users_follow.user_follower_id, tweets.id, tweets.author_id
+    FROM tweets
+    JOIN users ON users.id = tweets.author_id
+    JOIN users_follow ON users_follow.user_following_id = tweets.author_id
+    WHERE tweets.id >= $1 AND NOT users.fanout_on_read
+    ON CONFLICT DO NOTHING
+"""
+
+
+def dsn() -> str:
+    return engine.url.set(drivername="postgresql").render_as_string(
+        hide_password=False
+    )
+
+
+async def load(connection: asyncpg.Connection, **options) -> Dict[str, int]:
+    """
+    Generate the graph (see `generate_rows` for `options`) and load it.
+
+    :return: dict (table -> number of loaded rows)
+    """
+    first_ids = {}
+    for table in COLUMNS:
+        last_id = await connection.fetchval(
+            f"SELECT coalesce(max(id), 0) FROM {table}"
+        )
+        first_ids[table] = last_id + 1
+    rows = generate_rows(first_ids, **options)
+    async with connection.transaction():
+        for table in COUNTED_TABLES:
+            await connection.execute(
+                f"ALTER TABLE {table} DISABLE TRIGGER USER"
+            )
+        for table, columns in COLUMNS.items():
+            await connection.copy_records_to_table(
+                table, records=rows[table], columns=columns
+            )
+            await connection.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT max(id) FROM {table}))"
+            )
+        for table in COUNTED_TABLES:
+            await connection.execute(
+                f"ALTER TABLE {table} ENABLE TRIGGER USER"
+            )
+        for table, query in COUNTERS:
+            await connection.execute(query, first_ids[table])
+        await connection.execute(
+            FANOUT_ON_READ, first_ids["users"], TIMELINE_FANOUT_LIMIT
+        )
+        timelines = await connection.execute(TIMELINES, first_ids["tweets"])
+    loaded = {table: len(table_rows) for table, table_rows in rows.items()}
+    loaded["user_timelines"] = int(timelines.split()[-1])
+    return loaded
+
+
+async def run(args):
+    connection = await asyncpg.connect(dsn())
+    try:
+        started = time.perf_counter()
+        loaded = await load(
+            connection,
+            users=args.users,
+            follows=args.follows,
+            alpha=args.alpha,
+            tweets=args.tweets,
+            likes=args.likes,
+            medias=args.medias,
+            seed=args.seed,
+        )
+        elapsed = time.perf_counter() - started
+    finally:
+        await connection.close()
+    for table, count in loaded.items():
+        print(f"{table:16} {count:10}")
+    print(f"loaded in {elapsed:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--follows", type=float, default=20)
+    parser.add_argument("--alpha", type=float, default=1.0)
+    parser.add_argument("--tweets", type=float, default=10)
+    parser.add_argument("--likes", type=float, default=5)
+    parser.add_argument("--medias", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
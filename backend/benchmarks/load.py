@@ -0,0 +1,265 @@
+"""
+Load driver of the API: concurrent clients send a mix of requests to the
+ASGI app in the same process (through httpx, without network and external
+tools) on behalf of the users made by `benchmarks.generator`, and latency
+percentiles and throughput are reported per endpoint.
+
+Results can be saved as a baseline and compared with it later: endpoints
+which got slower or handle fewer requests than the baseline beyond the
+tolerance are flagged, and the exit code is 1 then. Baselines depend on
+the machine and the data, save them where they are compared. Run from the
+`backend` directory:
+
+    PYTHONPATH=src python -m benchmarks.load --requests 2000 \\
+        --baseline benchmarks/baselines/default.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+from httpx import AsyncClient
+from sqlalchemy import select
+
+from app import init_app
+from database.models import Tweet, User, async_session
+
+
+async def feed(client, rnd, user, data):
+    return await client.get(
+        "/api/tweets",
+        headers=user,
+        params={"limit": 20, "compact": True},
+    )
+
+
+async def profile_me(client, rnd, user, data):
+    return await client.get(
+        "/api/users/me", headers=user, params={"compact": True}
+    )
+
+
+async def profile(client, rnd, user, data):
+    user_id = rnd.choice(data.users)[0]
+    return await client.get(
+        f"/api/users/{user_id}", headers=user, params={"compact": True}
+    )
+
+
+async def tweets_by_ids(client, rnd, user, data):
+    ids = ",".join(str(pk) for pk in rnd.sample(data.tweet_ids, 10))
+    return await client.get("/api/tweets", headers=user, params={"ids": ids})
+
+
+async def like(client, rnd, user, data):
+    tweet_id = rnd.choice(data.tweet_ids)
+    return await client.post(f"/api/tweets/{tweet_id}/likes", headers=user)
+
+
+async def unlike(client, rnd, user, data):
+    tweet_id = rnd.choice(data.tweet_ids)
+    return await client.delete(f"/api/tweets/{tweet_id}/likes", headers=user)
+
+
+async def post_tweet(client, rnd, user, data):
+    return await client.post(
+        "/api/tweets",
+        headers=user,
+        json={"tweet_data": "Load test", "tweet_media_ids": []},
+    )
+
+
+# Endpoint name -> (request, weight in the mix)
+SCENARIOS = {
+    "GET /api/tweets": (feed, 40),
+    "GET /api/users/me": (profile_me, 15),
+    "GET /api/users/{pk}": (profile, 10),
+    "GET /api/tweets?ids": (tweets_by_ids, 10),
+    "POST /api/tweets/{pk}/likes": (like, 10),
+    "DELETE /api/tweets/{pk}/likes": (unlike, 10),
+    "POST /api/tweets": (post_tweet, 5),
+}
+
+
+class LoadData(NamedTuple):
+    # (id, headers) of the generated users
+    users: List[tuple]
+    # Ids of the latest tweets
+    tweet_ids: List[int]
+
+
+async def load_data(users: int, tweets: int) -> LoadData:
+    async with async_session() as session:
+        rows = await session.execute(
+            select(User.id, User.api_key)
+            .filter(User.api_key.like("bench_%"))
+            .limit(users)
+        )
+        tweet_ids = await session.scalars(
+            select(Tweet.id).order_by(Tweet.id.desc()).limit(tweets)
+        )
+        return LoadData(
+            users=[(pk, [("api-key", api_key)]) for pk, api_key in rows],
+            tweet_ids=tweet_ids.all(),
+        )
+
+
+def percentile(values: List[float], percent: int) -> float:
+    """
+    Percentile by the nearest rank.
+    """
+    ordered = sorted(values)
+    rank = max(1, round(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(
+    latencies: Dict[str, List[float]], errors: Dict[str, int], elapsed: float
+) -> Dict[str, dict]:
+    """
+    :return: dict (endpoint -> count, errors, p50, p95, p99 in milliseconds
+        and throughput in requests per second)
+    """
+    return {
+        endpoint: {
+            "count": len(values),
+            "errors": errors[endpoint],
+            "p50": round(percentile(values, 50) * 1e3, 2),
+            "p95": round(percentile(values, 95) * 1e3, 2),
+            "p99": round(percentile(values, 99) * 1e3, 2),
+            "throughput": round(len(values) / elapsed, 2),
+        }
+        for endpoint, values in sorted(latencies.items())
+    }
+
+
+def compare(
+    results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float
+) -> Dict[str, List[str]]:
+    """
+    :return: dict (endpoint -> metrics which regressed beyond `tolerance`)
+    """
+    regressions = {}
+    for endpoint, result in results.items():
+        base = baseline.get(endpoint)
+        if not base:
+            continue
+        regressed = [
+            metric
+            for metric in ("p50", "p95", "p99")
+            if result[metric] > base[metric] * (1 + tolerance)
+        ]
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressed.append("throughput")
+        if regressed:
+            regressions[endpoint] = regressed
+    return regressions
+
+
+async def drive(
+    app, requests: int, concurrency: int, data: LoadData, seed: int
+):
+    """
+    Send `requests` requests by `concurrency` clients.
+
+    :return: tuple (latencies in seconds and number of failed requests by
+        endpoint, elapsed seconds)
+    """
+    rnd = random.Random(seed)
+    endpoints = list(SCENARIOS)
+    weights = [SCENARIOS[endpoint][1] for endpoint in endpoints]
+    plan = rnd.choices(endpoints, weights=weights, k=requests)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    async def client_loop(client):
+        while plan:
+            endpoint = plan.pop()
+            request = SCENARIOS[endpoint][0]
+            user = rnd.choice(data.users)[1]
+            started = time.perf_counter()
+            response = await request(client, rnd, user, data)
+            latencies[endpoint].append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors[endpoint] += 1
+
+    async with AsyncClient(app=app, base_url="http://load") as client:
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(client_loop(client) for _ in range(concurrency))
+        )
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def report(results: Dict[str, dict], regressions: Dict[str, List[str]]):
+    print(
+        f"{'endpoint':32} {'count':>6} {'errors':>6} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}"
+    )
+    for endpoint, result in results.items():
+        flags = ", ".join(regressions.get(endpoint, []))
+        print(
+            f"{endpoint:32} {result['count']:6} {result['errors']:6} "
+            f"{result['p50']:8.1f} {result['p95']:8.1f} "
+            f"{result['p99']:8.1f} {result['throughput']:8.1f}"
+            + (f"  REGRESSION: {flags}" if flags else "")
+        )
+
+
+async def run(args) -> Optional[Dict[str, List[str]]]:
+    data = await load_data(args.users, args.tweets)
+    if not data.users or len(data.tweet_ids) < 10:
+        sys.exit("No generated data, run benchmarks.generator first")
+    app = init_app()
+    # Warm up connections and caches
+    await drive(app, args.concurrency * 5, args.concurrency, data, 0)
+    latencies, errors, elapsed = await drive(
+        app, args.requests, args.concurrency, data, args.seed
+    )
+    results = summarize(latencies, errors, elapsed)
+    regressions = {}
+    if args.baseline and not args.save:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"], args.tolerance)
+    report(results, regressions)
+    total = sum(result["count"] for result in results.values())
+    print(f"total: {total} requests, {total / elapsed:.1f} req/s")
+    if args.save:
+        with open(args.baseline, "w") as file:
+            options = {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "users": len(data.users),
+            }
+            json.dump({"options": options, "results": results}, file, indent=2)
+            file.write("\n")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", help="JSON file of the baseline")
+    parser.add_argument(
+        "--save", action="store_true", help="save results as the baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    if args.save and not args.baseline:
+        parser.error("--save requires --baseline")
+    regressions = asyncio.run(run(args))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Micro-benchmark of feed serialization: per-tweet cost of the dicts built
+from ORM instances with stdlib `json` (how the feed was serialized before)
+and with orjson, against the rows of `User.get_feed`, which already have
+the response shape and are only copied into dicts, with orjson. Building
+of the dicts is timed with the serialization; the query itself is measured
+by `benchmarks.feed_query`.
+
+Run from the `backend` directory:
+
+    PYTHONPATH=src python -m benchmarks.serialization --tweets 1000
+
+For 1000 tweets with 10 likes and 2 medias each:
+
+    dicts + json:         25.16 us/tweet
+    dicts + orjson:        7.88 us/tweet
+    rows + orjson:         2.28 us/tweet
+
+Rows are shallow copies, so most of the gain is in not building the nested
+dicts in Python: decoding of the JSON columns happens in the query.
+"""
+import argparse
+import json
+import time
+from types import MappingProxyType, SimpleNamespace
+
+import orjson
+
+
+def make_feed(tweets: int, likes: int, medias: int) -> list:
+    users = [SimpleNamespace(id=i, name=f"user_{i}") for i in range(likes + 1)]
+    feed = []
+    for i in range(tweets):
+        attachments = [
+            SimpleNamespace(
+                media_path=f"/medias/{i}_{j}.png",
+                variants=[
+                    SimpleNamespace(
+                        width=width,
+                        height=width // 2,
+                        media_path=f"/medias/{i}_{j}_{width}w.webp",
+                    )
+                    for width in (320, 1080)
+                ],
+            )
+            for j in range(medias)
+        ]
+        feed.append(
+            SimpleNamespace(
+                id=i,
+                content=f"Content of the tweet {i}",
+                author=users[0],
+                medias=attachments,
+                likes=users[1:],
+            )
+        )
+    return feed
+
+
+def build_dicts(feed: list) -> list:
+    """
+    Build the response tweets from ORM instances (or alike).
+    """
+    return [
+        {
+            "id": tweet.id,
+            "content": tweet.content,
+            "author": {"id": tweet.author.id, "name": tweet.author.name},
+            "attachments": [media.media_path for media in tweet.medias],
+            "attachment_variants": [
+                {
+                    "url": media.media_path,
+                    "variants": [
+                        {
+                            "width": variant.width,
+                            "height": variant.height,
+                            "url": variant.media_path,
+                        }
+                        for variant in media.variants
+                    ],
+                }
+                for media in tweet.medias
+            ],
+            "likes": [
+                {"id": user.id, "name": user.name} for user in tweet.likes
+            ],
+        }
+        for tweet in feed
+    ]
+
+
+def serialize_dicts(feed: list) -> bytes:
+    tweets = build_dicts(feed)
+    # The same arguments as `JSONResponse.render`
+    return json.dumps(
+        {"result": True, "tweets": tweets},
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def serialize_dicts_orjson(feed: list) -> bytes:
+    return orjson.dumps({"result": True, "tweets": build_dicts(feed)})
+
+
+def make_rows(feed: list) -> list:
+    """
+    Result rows of the feed query: read-only mappings of the columns.
+    """
+    return [MappingProxyType(tweet) for tweet in build_dicts(feed)]
+
+
+def serialize_rows(rows: list) -> bytes:
+    # The same as `User.get_feed` does with the result mappings
+    tweets = [dict(row) for row in rows]
+    return orjson.dumps({"result": True, "tweets": tweets})
+
+
+def measure(serialize, feed: list, repeat: int) -> float:
+    """
+    :return: float (best time per tweet in microseconds)
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        serialize(feed)
+        best = min(best, time.perf_counter() - start)
+    return best / len(feed) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tweets", type=int, default=1000)
+    parser.add_argument("--likes", type=int, default=10)
+    parser.add_argument("--medias", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    feed = make_feed(args.tweets, args.likes, args.medias)
+    rows = make_rows(feed)
+    expected = json.loads(serialize_dicts(feed))
+    assert orjson.loads(serialize_dicts_orjson(feed)) == expected
+    assert orjson.loads(serialize_rows(rows)) == expected
+    dicts = measure(serialize_dicts, feed, args.repeat)
+    dicts_orjson = measure(serialize_dicts_orjson, feed, args.repeat)
+    projected = measure(serialize_rows, rows, args.repeat)
+    print(f"dicts + json:      {dicts:8.2f} us/tweet")
+    print(f"dicts + orjson:    {dicts_orjson:8.2f} us/tweet")
+    print(f"rows + orjson:     {projected:8.2f} us/tweet")
+    print(f"speedup:           {dicts / projected:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Add version stamps to users and tweets
+
+Revision ID: 0c6f2b9d4e13
+Revises: 5d1a8f3e6b27
+Create Date: 2026-10-18 15:48:21.740316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0c6f2b9d4e13"
+down_revision: Union[str, None] = "5d1a8f3e6b27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def tweet_likes_count(set_version: str) -> str:
+    return f"""
+        CREATE OR REPLACE FUNCTION tweet_likes_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE tweets
+                SET like_count = like_count + 1{set_version}
+                WHERE id = NEW.tweet_id;
+            ELSE
+                UPDATE tweets
+                SET like_count = like_count - 1{set_version}
+                WHERE id = OLD.tweet_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+
+
+def users_follow_count(set_version: str) -> str:
+    return f"""
+        CREATE OR REPLACE FUNCTION users_follow_count() RETURNS trigger AS $$
+        BEGIN
+            -- Rows are locked in the order of ids, so users who follow
+            -- each other at the same time do not deadlock
+            IF TG_OP = 'INSERT' THEN
+                PERFORM 1 FROM users
+                WHERE id IN (NEW.user_following_id, NEW.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users
+                SET followers_count = followers_count + 1{set_version}
+                WHERE id = NEW.user_following_id;
+                UPDATE users
+                SET following_count = following_count + 1{set_version}
+                WHERE id = NEW.user_follower_id;
+            ELSE
+                PERFORM 1 FROM users
+                WHERE id IN (OLD.user_following_id, OLD.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users
+                SET followers_count = followers_count - 1{set_version}
+                WHERE id = OLD.user_following_id;
+                UPDATE users
+                SET following_count = following_count - 1{set_version}
+                WHERE id = OLD.user_follower_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column("version", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column(
+        "tweets",
+        sa.Column("version", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.execute(tweet_likes_count(", version = version + 1"))
+    op.execute(users_follow_count(", version = version + 1"))
+
+
+def downgrade() -> None:
+    op.execute(users_follow_count(""))
+    op.execute(tweet_likes_count(""))
+    op.drop_column("tweets", "version")
+    op.drop_column("users", "version")
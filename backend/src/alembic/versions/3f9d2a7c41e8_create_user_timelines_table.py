@@ -0,0 +1,74 @@
+"""Create user_timelines table
+
+Revision ID: 3f9d2a7c41e8
+Revises: 629da068200d
+Create Date: 2026-10-18 10:12:41.218311
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f9d2a7c41e8"
+down_revision: Union[str, None] = "629da068200d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column(
+            "fanout_on_read",
+            sa.Boolean(),
+            server_default=sa.false(),
+            nullable=False,
+        ),
+    )
+    op.create_table(
+        "user_timelines",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["author_id"], ["users.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("user_id", "tweet_id"),
+    )
+    op.create_index(
+        "ix_user_timelines_user_id_author_id",
+        "user_timelines",
+        ["user_id", "author_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_user_timelines_tweet_id",
+        "user_timelines",
+        ["tweet_id"],
+        unique=False,
+    )
+    # Fill timelines with tweets which were created before this revision
+    op.execute(
+        """
+        INSERT INTO user_timelines (user_id, tweet_id, author_id)
+        SELECT DISTINCT users_follow.user_follower_id, tweets.id, tweets.author_id
+        FROM users_follow
+        JOIN tweets ON tweets.author_id = users_follow.user_following_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_user_timelines_tweet_id", table_name="user_timelines")
+    op.drop_index(
+        "ix_user_timelines_user_id_author_id", table_name="user_timelines"
+    )
+    op.drop_table("user_timelines")
+    op.drop_column("users", "fanout_on_read")
@@ -0,0 +1,102 @@
+"""Add follow counters to users
+
+Revision ID: 5d1a8f3e6b27
+Revises: 9b4e7c2a1f05
+Create Date: 2026-10-18 15:02:44.183520
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5d1a8f3e6b27"
+down_revision: Union[str, None] = "9b4e7c2a1f05"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column(
+            "followers_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.add_column(
+        "users",
+        sa.Column(
+            "following_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.create_index(
+        "ix_users_follow_following_id_id",
+        "users_follow",
+        ["user_following_id", "id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_users_follow_follower_id_id",
+        "users_follow",
+        ["user_follower_id", "id"],
+        unique=False,
+    )
+    op.execute(
+        """
+        UPDATE users SET
+            followers_count = (
+                SELECT count(*) FROM users_follow
+                WHERE users_follow.user_following_id = users.id
+            ),
+            following_count = (
+                SELECT count(*) FROM users_follow
+                WHERE users_follow.user_follower_id = users.id
+            )
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION users_follow_count() RETURNS trigger AS $$
+        BEGIN
+            -- Rows are locked in the order of ids, so users who follow
+            -- each other at the same time do not deadlock
+            IF TG_OP = 'INSERT' THEN
+                PERFORM 1 FROM users
+                WHERE id IN (NEW.user_following_id, NEW.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users SET followers_count = followers_count + 1
+                WHERE id = NEW.user_following_id;
+                UPDATE users SET following_count = following_count + 1
+                WHERE id = NEW.user_follower_id;
+            ELSE
+                PERFORM 1 FROM users
+                WHERE id IN (OLD.user_following_id, OLD.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users SET followers_count = followers_count - 1
+                WHERE id = OLD.user_following_id;
+                UPDATE users SET following_count = following_count - 1
+                WHERE id = OLD.user_follower_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER users_follow_count
+        AFTER INSERT OR DELETE ON users_follow
+        FOR EACH ROW EXECUTE FUNCTION users_follow_count()
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER users_follow_count ON users_follow")
+    op.execute("DROP FUNCTION users_follow_count()")
+    op.drop_index("ix_users_follow_follower_id_id", table_name="users_follow")
+    op.drop_index("ix_users_follow_following_id_id", table_name="users_follow")
+    op.drop_column("users", "following_count")
+    op.drop_column("users", "followers_count")
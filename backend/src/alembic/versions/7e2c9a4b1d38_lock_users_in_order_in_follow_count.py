@@ -0,0 +1,59 @@
+"""Lock users in order of ids in users_follow_count
+
+Revision ID: 7e2c9a4b1d38
+Revises: d3a7f5c2b819
+Create Date: 2026-10-18 19:12:37.604118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7e2c9a4b1d38"
+down_revision: Union[str, None] = "d3a7f5c2b819"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The same function as 0c6f2b9d4e13 creates now, for the databases
+    # which were migrated before it was fixed
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION users_follow_count() RETURNS trigger AS $$
+        BEGIN
+            -- Rows are locked in the order of ids, so users who follow
+            -- each other at the same time do not deadlock
+            IF TG_OP = 'INSERT' THEN
+                PERFORM 1 FROM users
+                WHERE id IN (NEW.user_following_id, NEW.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users
+                SET followers_count = followers_count + 1, version = version + 1
+                WHERE id = NEW.user_following_id;
+                UPDATE users
+                SET following_count = following_count + 1, version = version + 1
+                WHERE id = NEW.user_follower_id;
+            ELSE
+                PERFORM 1 FROM users
+                WHERE id IN (OLD.user_following_id, OLD.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users
+                SET followers_count = followers_count - 1, version = version + 1
+                WHERE id = OLD.user_following_id;
+                UPDATE users
+                SET following_count = following_count - 1, version = version + 1
+                WHERE id = OLD.user_follower_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+
+
+def downgrade() -> None:
+    # The function of the previous revision is the same
+    pass
@@ -0,0 +1,66 @@
+"""Add like_count to tweets
+
+Revision ID: 8a41c6d2e5b7
+Revises: 3f9d2a7c41e8
+Create Date: 2026-10-18 11:02:15.604729
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8a41c6d2e5b7"
+down_revision: Union[str, None] = "3f9d2a7c41e8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "like_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.execute(
+        """
+        UPDATE tweets SET like_count = counts.like_count
+        FROM (
+            SELECT tweet_id, count(*) AS like_count
+            FROM tweet_likes GROUP BY tweet_id
+        ) AS counts
+        WHERE tweets.id = counts.tweet_id
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION tweet_likes_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE tweets SET like_count = like_count + 1
+                WHERE id = NEW.tweet_id;
+            ELSE
+                UPDATE tweets SET like_count = like_count - 1
+                WHERE id = OLD.tweet_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER tweet_likes_count
+        AFTER INSERT OR DELETE ON tweet_likes
+        FOR EACH ROW EXECUTE FUNCTION tweet_likes_count()
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER tweet_likes_count ON tweet_likes")
+    op.execute("DROP FUNCTION tweet_likes_count()")
+    op.drop_column("tweets", "like_count")
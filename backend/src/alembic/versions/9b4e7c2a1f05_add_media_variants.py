@@ -0,0 +1,44 @@
+"""Add media variants
+
+Revision ID: 9b4e7c2a1f05
+Revises: e52b8f1d9c46
+Create Date: 2026-10-18 14:12:37.604821
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9b4e7c2a1f05"
+down_revision: Union[str, None] = "e52b8f1d9c46"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "media_variants",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("media_id", sa.Integer(), nullable=False),
+        sa.Column("width", sa.Integer(), nullable=False),
+        sa.Column("height", sa.Integer(), nullable=False),
+        sa.Column("media_path", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["media_id"], ["medias.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "media_id", "width", name="uq_media_variants_media_id_width"
+        ),
+    )
+    op.create_index(
+        op.f("ix_media_variants_id"), "media_variants", ["id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_media_variants_id"), table_name="media_variants")
+    op.drop_table("media_variants")
@@ -0,0 +1,34 @@
+"""Add claimed_at to medias
+
+Revision ID: a4f81c6e2d57
+Revises: 7e2c9a4b1d38
+Create Date: 2026-10-18 19:40:52.318746
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a4f81c6e2d57"
+down_revision: Union[str, None] = "7e2c9a4b1d38"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "medias",
+        sa.Column(
+            "claimed_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("medias", "claimed_at")
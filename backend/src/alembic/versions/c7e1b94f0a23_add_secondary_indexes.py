@@ -0,0 +1,98 @@
+"""Add secondary indexes and unique constraints
+
+Revision ID: c7e1b94f0a23
+Revises: 8a41c6d2e5b7
+Create Date: 2026-10-18 12:20:37.915402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c7e1b94f0a23"
+down_revision: Union[str, None] = "8a41c6d2e5b7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Remove duplicates which were allowed before, the earliest row is kept
+    for table, columns in (
+        ("users_follow", ("user_follower_id", "user_following_id")),
+        ("tweet_likes", ("tweet_id", "user_id")),
+        ("tweet_medias", ("tweet_id", "media_id")),
+    ):
+        condition = " AND ".join(f"a.{c} = b.{c}" for c in columns)
+        op.execute(
+            f"DELETE FROM {table} a USING {table} b "
+            f"WHERE a.id > b.id AND {condition}"
+        )
+
+    op.create_index(
+        "ix_users_fanout_on_read",
+        "users",
+        ["id"],
+        unique=False,
+        postgresql_where=sa.text("fanout_on_read"),
+    )
+    op.create_unique_constraint(
+        "uq_users_follow_follower_id_following_id",
+        "users_follow",
+        ["user_follower_id", "user_following_id"],
+    )
+    op.create_index(
+        "ix_users_follow_following_id_follower_id",
+        "users_follow",
+        ["user_following_id", "user_follower_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tweets_author_id_id", "tweets", ["author_id", "id"], unique=False
+    )
+    op.create_unique_constraint(
+        "uq_tweet_medias_tweet_id_media_id",
+        "tweet_medias",
+        ["tweet_id", "media_id"],
+    )
+    op.create_index(
+        "ix_tweet_medias_media_id", "tweet_medias", ["media_id"], unique=False
+    )
+    op.create_unique_constraint(
+        "uq_tweet_likes_tweet_id_user_id",
+        "tweet_likes",
+        ["tweet_id", "user_id"],
+    )
+    op.create_index(
+        "ix_tweet_likes_tweet_id_id",
+        "tweet_likes",
+        ["tweet_id", "id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tweet_likes_user_id", "tweet_likes", ["user_id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tweet_likes_user_id", table_name="tweet_likes")
+    op.drop_index("ix_tweet_likes_tweet_id_id", table_name="tweet_likes")
+    op.drop_constraint(
+        "uq_tweet_likes_tweet_id_user_id", "tweet_likes", type_="unique"
+    )
+    op.drop_index("ix_tweet_medias_media_id", table_name="tweet_medias")
+    op.drop_constraint(
+        "uq_tweet_medias_tweet_id_media_id", "tweet_medias", type_="unique"
+    )
+    op.drop_index("ix_tweets_author_id_id", table_name="tweets")
+    op.drop_index(
+        "ix_users_follow_following_id_follower_id", table_name="users_follow"
+    )
+    op.drop_constraint(
+        "uq_users_follow_follower_id_following_id",
+        "users_follow",
+        type_="unique",
+    )
+    op.drop_index("ix_users_fanout_on_read", table_name="users")
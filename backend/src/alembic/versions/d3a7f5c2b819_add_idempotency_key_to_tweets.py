@@ -0,0 +1,37 @@
+"""Add idempotency key to tweets
+
+Revision ID: d3a7f5c2b819
+Revises: 0c6f2b9d4e13
+Create Date: 2026-10-18 17:42:09.318254
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d3a7f5c2b819"
+down_revision: Union[str, None] = "0c6f2b9d4e13"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column("idempotency_key", sa.String(length=64), nullable=True),
+    )
+    op.create_index(
+        "uq_tweets_author_id_idempotency_key",
+        "tweets",
+        ["author_id", "idempotency_key"],
+        unique=True,
+        postgresql_where=sa.text("idempotency_key IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("uq_tweets_author_id_idempotency_key", table_name="tweets")
+    op.drop_column("tweets", "idempotency_key")
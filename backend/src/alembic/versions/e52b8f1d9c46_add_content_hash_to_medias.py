@@ -0,0 +1,73 @@
+"""Add content hash and reference count to medias
+
+Revision ID: e52b8f1d9c46
+Revises: c7e1b94f0a23
+Create Date: 2026-10-18 13:41:09.527183
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e52b8f1d9c46"
+down_revision: Union[str, None] = "c7e1b94f0a23"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "medias", sa.Column("sha256", sa.String(length=64), nullable=True)
+    )
+    op.add_column(
+        "medias",
+        sa.Column(
+            "ref_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.create_unique_constraint("uq_medias_sha256", "medias", ["sha256"])
+    op.execute(
+        """
+        UPDATE medias SET ref_count = counts.ref_count
+        FROM (
+            SELECT media_id, count(*) AS ref_count
+            FROM tweet_medias GROUP BY media_id
+        ) AS counts
+        WHERE medias.id = counts.media_id
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION tweet_medias_ref_count() RETURNS trigger
+        AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE medias SET ref_count = ref_count + 1
+                WHERE id = NEW.media_id;
+            ELSE
+                UPDATE medias SET ref_count = ref_count - 1
+                WHERE id = OLD.media_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER tweet_medias_ref_count
+        AFTER INSERT OR DELETE ON tweet_medias
+        FOR EACH ROW EXECUTE FUNCTION tweet_medias_ref_count()
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER tweet_medias_ref_count ON tweet_medias")
+    op.execute("DROP FUNCTION tweet_medias_ref_count()")
+    op.drop_constraint("uq_medias_sha256", "medias", type_="unique")
+    op.drop_column("medias", "ref_count")
+    op.drop_column("medias", "sha256")
@@ -1,11 +1,22 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 import logging
 
 from tweets_api.routes import router as r1
 from users_api.routes import router as r2
 from medias_api.routes import router as r3
 from main_api.routes import router as r4
+from conf import DEBUG, MEDIA_MAX_SIZE
+from database.models import dispose_engines
 from handlers import http_exception_handler
+from middlewares import (
+    BodySizeLimitMiddleware,
+    RateLimitMiddleware,
+    ReadYourWritesMiddleware,
+)
+from instrumentation import InstrumentationMiddleware
+from medias_api.variants import pipeline
+from tweets_api.events import hub
 
 
 def init_app():
@@ -14,7 +25,7 @@ def init_app():
 
     :return: instance of FastAPI
     """
-    app = FastAPI(debug=True)
+    app = FastAPI(debug=DEBUG, default_response_class=ORJSONResponse)
 
     app.include_router(r1, prefix="/api/tweets")
     app.include_router(r2, prefix="/api/users")
@@ -22,6 +33,24 @@ def init_app():
     app.include_router(r4, prefix="/api")
 
     app.add_exception_handler(HTTPException, http_exception_handler)
+    app.add_event_handler("startup", pipeline.start)
+    app.add_event_handler("shutdown", pipeline.stop)
+    app.add_event_handler("startup", hub.start)
+    app.add_event_handler("shutdown", hub.stop)
+    # After the handlers which may use the database
+    app.add_event_handler("shutdown", dispose_engines)
+    # Multipart overhead is small, so limit of the body is a bit higher
+    app.add_middleware(
+        BodySizeLimitMiddleware,
+        max_size=MEDIA_MAX_SIZE + 64 * 1024,
+        path_prefix="/api/medias",
+    )
+    app.add_middleware(ReadYourWritesMiddleware)
+    # Rejects requests before they are read and before they wait for
+    # connections of the pool
+    app.add_middleware(RateLimitMiddleware)
+    # The outermost one, to measure everything else
+    app.add_middleware(InstrumentationMiddleware)
 
     logging.info("FastAPI application initialized")
 
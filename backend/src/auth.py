@@ -0,0 +1,55 @@
+from fastapi import Depends, Header, HTTPException
+from sqlalchemy import event, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import NamedTuple
+
+from cache import TTLCache
+from conf import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+from database.models import User, get_session
+from instrumentation import phase
+
+
+class Principal(NamedTuple):
+    """
+    Authenticated user: only the columns which are needed to authorize
+    the request.
+    """
+
+    id: int
+    name: str
+
+
+principals = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
+async def get_current_user(
+    api_key: str = Header(..., convert_underscores=True),
+    session: AsyncSession = Depends(get_session),
+) -> Principal:
+    """
+    FastAPI dependency to authenticate the user by header 'api-key'.
+
+    :param api_key: str (header 'api-key' to select the user)
+    :param session: AsyncSession (session of the request)
+    :return: Principal (id and name of the user)
+    :raise HTTPException: if there is no user with this api-key
+    """
+    with phase("auth"):
+        principal = principals.get(api_key)
+        if principal is None:
+            row = await User.get_principal(session, api_key=api_key)
+            if not row:
+                raise HTTPException(
+                    status_code=400, detail="No such user with this api-key"
+                )
+            principal = Principal(*row)
+            principals.set(api_key, principal)
+    return principal
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_principal(mapper, connection, target: User):
+    history = inspect(target).attrs.api_key.history
+    for api_key in (target.api_key, *history.deleted):
+        principals.discard(api_key)
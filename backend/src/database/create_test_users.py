@@ -1,21 +1,23 @@
 import asyncio
 import logging
+from sqlalchemy.ext.asyncio import AsyncSession
+
 from database.models import User, UserFollow, async_session
 
 
-async def add_user(_id: int):
+async def add_user(session: AsyncSession, _id: int):
     user = User(name=f"user_{_id}", api_key=f"api_key_{_id}")
-    await user.add()
+    await user.add(session)
 
 
-async def add_followers(_id):
+async def add_followers(session: AsyncSession, _id):
     following = UserFollow(user_follower_id=_id, user_following_id=_id - 1)
-    await following.add()
+    await following.add(session)
 
 
-async def add_test_user():
+async def add_test_user(session: AsyncSession):
     user = User(name="Test", api_key="test")
-    await user.add()
+    await user.add(session)
 
 
 async def create_test_users():
@@ -25,18 +27,20 @@ async def create_test_users():
     from sqlalchemy import select
 
     logging.info("Starting creating 5 test users")
-    user = await User.get(_id=1)
-    if not user:
-        logging.info("Users not exists, adding...")
-        users_tasks = [add_user(_id) for _id in range(1, 6)]
-        await asyncio.gather(*users_tasks)
-        logging.info("Users successfully added")
-        following_tasks = [add_followers(_id) for _id in range(2, 6)]
-        logging.info("Following successfully added")
-        await asyncio.gather(*following_tasks)
-        await add_test_user()
-    else:
-        logging.info("Users exists, skipping adding.")
+    async with async_session() as session:
+        user = await User.get(session, _id=1)
+        if not user:
+            logging.info("Users not exists, adding...")
+            for _id in range(1, 6):
+                await add_user(session, _id)
+            logging.info("Users successfully added")
+            for _id in range(2, 6):
+                await add_followers(session, _id)
+            logging.info("Following successfully added")
+            await add_test_user(session)
+            await session.commit()
+        else:
+            logging.info("Users exists, skipping adding.")
 
 
 if __name__ == "__main__":
@@ -1,100 +1,469 @@
+import os
+from datetime import timedelta
+from starlette.requests import Request
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
     AsyncSession,
     async_sessionmaker,
 )
-from sqlalchemy.orm import declarative_base, relationship, joinedload
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, select, and_
+from sqlalchemy.orm import (
+    declarative_base,
+    relationship,
+    selectinload,
+    aliased,
+)
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Boolean,
+    DateTime,
+    ForeignKey,
+    Text,
+    Index,
+    UniqueConstraint,
+    select,
+    update,
+    delete,
+    union,
+    func,
+    literal,
+    literal_column,
+    text,
+    false,
+    true,
+    exists,
+    and_,
+    event,
+    DDL,
+)
+from sqlalchemy.dialects.postgresql import (
+    insert,
+    aggregate_order_by,
+    ARRAY,
+    JSON,
+)
+from sqlalchemy.engine import Row
 from sqlalchemy.exc import IntegrityError
 
-from typing import Optional, List, Iterable
-from conf import POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_DB
+from typing import Optional, List, Dict, AsyncGenerator
+from database.pool import engine_options
+from database.routing import (
+    RoutingSession,
+    choose_replica,
+    mark_written,
+    replica_engines,
+)
+from conf import (
+    POSTGRES_USER,
+    POSTGRES_PASSWORD,
+    POSTGRES_HOST,
+    POSTGRES_DB,
+    READ_YOUR_WRITES_COOKIE,
+    MEDIA_CLAIM_GRACE,
+    TIMELINE_FANOUT_LIMIT,
+    TIMELINE_BACKFILL_SIZE,
+)
 
 
 url = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}"
-engine = create_async_engine(url)
+engine = create_async_engine(url, **engine_options())
 Base = declarative_base()
 async_session = async_sessionmaker(
-    bind=engine, expire_on_commit=False, class_=AsyncSession
+    bind=engine,
+    expire_on_commit=False,
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
 )
 
 
+def _reset_pools_after_fork():
+    """
+    Drop pooled connections inherited by a forked worker process (e.g. of
+    gunicorn with --preload) without closing them: they are used by the
+    parent, and the worker opens its own ones.
+    """
+    for pool_engine in (engine, *replica_engines):
+        pool_engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+async def dispose_engines():
+    """
+    Close pooled connections of the worker on shutdown.
+    """
+    for pool_engine in (engine, *replica_engines):
+        await pool_engine.dispose()
+
+
+async def get_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """
+    FastAPI dependency which provides one session per request, so all
+    queries of the request share one connection and one transaction.
+
+    Model methods only flush their changes: the route commits the session
+    when the request succeeded, otherwise the transaction is rolled back
+    when the session is closed.
+
+    Reads of GET requests go to a read replica, if replicas are configured,
+    except for the user who has written something just before.
+    """
+    writer = request.headers.get("api-key")
+    async with async_session() as session:
+        session.info["writer"] = writer
+        session.info["state"] = request.state
+        if request.method == "GET":
+            session.info["replica"] = choose_replica(
+                writer, request.cookies.get(READ_YOUR_WRITES_COOKIE)
+            )
+        yield session
+
+
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index(
+            "ix_users_fanout_on_read",
+            "id",
+            postgresql_where=text("fanout_on_read"),
+        ),
+    )
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String(50))
     api_key = Column(String(50), unique=True)
+    fanout_on_read = Column(
+        Boolean, nullable=False, default=False, server_default=false()
+    )
+    # Maintained by the `users_follow_count` trigger on `users_follow`
+    followers_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    following_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Bumped with the counters, a version stamp of the profile for ETags
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # Loaded only on demand (see `User.get`): users are loaded with every
+    # tweet and like, and their followers can be counted in millions.
     followers = relationship(
         "User",
         secondary="users_follow",
         primaryjoin="User.id == UserFollow.user_following_id",
         secondaryjoin="User.id == UserFollow.user_follower_id",
         backref="following",
-        lazy="joined",
     )
 
     @classmethod
     async def get(
-        cls, api_key: str = None, _id: int = None
+        cls,
+        session: AsyncSession,
+        api_key: str = None,
+        _id: int = None,
+        with_follows: bool = True,
     ) -> Optional["User"]:
+        """
+        Get the user by api-key or id.
+
+        With `with_follows=True` the `followers` and `following` lists are
+        loaded too, otherwise only the counters are available.
+        """
         if api_key:
-            query = (
-                select(User)
-                .options(
-                    joinedload(User.followers), joinedload(User.following)
-                )
-                .filter(User.api_key == api_key)
-            )
+            query = select(User).filter(User.api_key == api_key)
         elif _id:
-            query = (
-                select(User)
-                .options(
-                    joinedload(User.followers), joinedload(User.following)
-                )
-                .filter(User.id == _id)
-            )
+            query = select(User).filter(User.id == _id)
         else:
             raise ValueError("One of arguments (api_key, _id) must be set")
-        async with async_session() as session:
-            user = await session.execute(query)
-            return user.scalar()
-
-    async def get_feed(self) -> Iterable["Tweet"]:
-        async with async_session() as session:
-            following_user_ids = [user.id for user in self.following]
-            following_user_ids.append(self.id)
-            query = (
-                select(Tweet)
-                .filter(Tweet.author_id.in_(following_user_ids))
-                .order_by(Tweet.id.desc())
+        if with_follows:
+            query = query.options(
+                selectinload(User.followers), selectinload(User.following)
             )
-            feed = await session.execute(query)
-            return feed.scalars().unique()
+        user = await session.execute(query)
+        return user.scalar()
 
-    async def add(self):
-        async with async_session() as session:
-            session.add(self)
-            await session.commit()
-            return self
+    @classmethod
+    async def get_version(
+        cls, session: AsyncSession, user_id: int
+    ) -> Optional[int]:
+        """
+        Get version stamp of the profile, None if there is no such user.
+        """
+        return await session.scalar(
+            select(User.version).filter(User.id == user_id)
+        )
+
+    @classmethod
+    async def get_principal(
+        cls, session: AsyncSession, api_key: str
+    ) -> Optional[Row]:
+        """
+        Get only id and name of the user by api-key, without relationships.
+        """
+        query = select(User.id, User.name).filter(User.api_key == api_key)
+        principal = await session.execute(query)
+        return principal.first()
+
+    @classmethod
+    async def get_feed(
+        cls,
+        session: AsyncSession,
+        user_id: int,
+        limit: int = None,
+        before: int = None,
+        after: int = None,
+        compact: bool = False,
+        likes_sample: int = 0,
+    ) -> List[dict]:
+        """
+        Get tweets of the user and of everyone the user follows, newest first.
+
+        The feed is read from the materialized timeline of the user, merged
+        with the user's own tweets and with tweets of followed authors whose
+        tweets are not fanned out on write (see `UserTimeline.fan_out`).
+
+        Without `limit` the whole feed is returned. Otherwise, it is a page
+        selected by keyset on `Tweet.id`: `before` takes tweets older than
+        the given id, `after` takes tweets newer than it.
+
+        Tweets are selected by a single Core query which projects only the
+        needed columns and aggregates attachments and likes into arrays, so
+        no ORM instances are created: every row is a ready `TweetOut` (or
+        `CompactTweetOut` with `compact=True`, where `likes` is a sample of
+        at most `likes_sample` latest likers).
+        """
+        page = cls._feed_page(
+            (Tweet.id, Tweet.content, Tweet.author_id, Tweet.like_count),
+            user_id,
+            limit,
+            before,
+            after,
+        ).subquery("page")
+        query = _tweet_rows_query(page, user_id, compact, likes_sample)
+        feed = await session.execute(query)
+        return [dict(tweet) for tweet in feed.mappings()]
+
+    @classmethod
+    async def get_feed_stamp(
+        cls,
+        session: AsyncSession,
+        user_id: int,
+        limit: int = None,
+        before: int = None,
+        after: int = None,
+    ) -> Row:
+        """
+        Get a version stamp of the feed (or of its page) without loading it:
+        number of tweets, the latest tweet id and the sum of tweet versions.
+        It changes when a tweet is added or removed, or a like is set or
+        removed.
+        """
+        page = cls._feed_page(
+            (Tweet.id, Tweet.version), user_id, limit, before, after
+        ).subquery()
+        query = select(
+            func.count(), func.max(page.c.id), func.sum(page.c.version)
+        )
+        stamp = await session.execute(query)
+        return stamp.one()
+
+    @classmethod
+    def _feed_page(cls, columns: tuple, user_id, limit, before, after):
+        """
+        Select `columns` of the feed page, see `User.get_feed`.
+        """
+        pulled_authors = (
+            select(UserFollow.user_following_id)
+            .join(User, User.id == UserFollow.user_following_id)
+            .filter(
+                UserFollow.user_follower_id == user_id,
+                User.fanout_on_read == true(),
+            )
+        )
+        feed_ids = union(
+            _keyset_page(
+                select(UserTimeline.tweet_id).filter(
+                    UserTimeline.user_id == user_id
+                ),
+                UserTimeline.tweet_id,
+                limit,
+                before,
+                after,
+            ),
+            _keyset_page(
+                select(Tweet.id).filter(Tweet.author_id == user_id),
+                Tweet.id,
+                limit,
+                before,
+                after,
+            ),
+            _keyset_page(
+                select(Tweet.id).filter(Tweet.author_id.in_(pulled_authors)),
+                Tweet.id,
+                limit,
+                before,
+                after,
+            ),
+        ).subquery()
+        return _keyset_page(
+            select(*columns).join(feed_ids, Tweet.id == feed_ids.c.tweet_id),
+            Tweet.id,
+            limit,
+            before,
+            after,
+        )
+
+    async def add(self, session: AsyncSession) -> "User":
+        session.add(self)
+        await session.flush()
+        return self
+
+
+def _tweet_rows_query(page, user_id: int, compact: bool, likes_sample: int):
+    """
+    Project tweets of the `page` subquery (with `id`, `content`, `author_id`
+    and `like_count` columns) into rows of `TweetOut` or `CompactTweetOut`
+    shape, newest first, see `User.get_feed`.
+    """
+    liker = aliased(User)
+    variants = (
+        select(
+            _json_array(
+                func.json_build_object(
+                    "width",
+                    MediaVariant.width,
+                    "height",
+                    MediaVariant.height,
+                    "url",
+                    MediaVariant.media_path,
+                ),
+                MediaVariant.width,
+            )
+        )
+        .filter(MediaVariant.media_id == Media.id)
+        .scalar_subquery()
+    )
+    medias = (
+        select(
+            func.array_agg(
+                aggregate_order_by(Media.media_path, TweetMedia.id)
+            ).label("paths"),
+            _json_array(
+                func.json_build_object(
+                    "url", Media.media_path, "variants", variants
+                ),
+                TweetMedia.id,
+            ).label("variants"),
+        )
+        .join(Media, Media.id == TweetMedia.media_id)
+        .filter(TweetMedia.tweet_id == page.c.id)
+        .lateral("medias")
+    )
+    if compact:
+        # A sample of the latest likers, newest first
+        likers = (
+            select(liker.id, liker.name, TweetLike.id.label("like_id"))
+            .join(liker, liker.id == TweetLike.user_id)
+            .filter(TweetLike.tweet_id == page.c.id)
+            .order_by(TweetLike.id.desc())
+            .limit(likes_sample)
+            .correlate(page)
+            .lateral("likers")
+        )
+        likes = select(
+            _json_array(
+                func.json_build_object(
+                    "id", likers.c.id, "name", likers.c.name
+                ),
+                likers.c.like_id.desc(),
+            ).label("likes")
+        ).lateral("likes")
+        liked_by_me = exists().where(
+            TweetLike.tweet_id == page.c.id, TweetLike.user_id == user_id
+        )
+        tweet_columns = (
+            page.c.like_count,
+            liked_by_me.label("liked_by_me"),
+            likes.c.likes,
+        )
+    else:
+        likes = (
+            select(
+                _json_array(
+                    func.json_build_object("id", liker.id, "name", liker.name),
+                    TweetLike.id,
+                ).label("likes")
+            )
+            .join(liker, liker.id == TweetLike.user_id)
+            .filter(TweetLike.tweet_id == page.c.id)
+            .lateral("likes")
+        )
+        tweet_columns = (likes.c.likes,)
+    return (
+        select(
+            page.c.id,
+            page.c.content,
+            func.json_build_object(
+                "id", User.id, "name", User.name, type_=JSON
+            ).label("author"),
+            func.coalesce(medias.c.paths, literal([], ARRAY(String))).label(
+                "attachments"
+            ),
+            medias.c.variants.label("attachment_variants"),
+            *tweet_columns,
+        )
+        .join(User, User.id == page.c.author_id)
+        .join(medias, true())
+        .join(likes, true())
+        .order_by(page.c.id.desc())
+    )
+
+
+def _json_array(element, order_by):
+    """
+    Aggregate `element` into a JSON array ordered by `order_by`, which is
+    empty rather than null when there are no rows.
+    """
+    return func.coalesce(
+        func.json_agg(aggregate_order_by(element, order_by)),
+        literal_column("'[]'::json"),
+        type_=JSON,
+    )
 
-    async def dump(self):
-        schema = {
-            "id": self.id,
-            "name": self.name,
-            "followers": [
-                {"id": f_user.id, "name": f_user.name}
-                for f_user in self.followers
-            ],
-            "following": [
-                {"id": f_user.id, "name": f_user.name}
-                for f_user in self.following
-            ],
-        }
-        return schema
+
+def _keyset_page(query, column, limit=None, before=None, after=None):
+    """
+    Apply keyset bounds, order and limit on `column` to the query.
+
+    Rows are ordered by `column` descending, or ascending if `after` is set.
+    """
+    if before:
+        query = query.filter(column < before)
+    if after:
+        query = query.filter(column > after).order_by(column.asc())
+    else:
+        query = query.order_by(column.desc())
+    if limit:
+        query = query.limit(limit)
+    return query
 
 
 class UserFollow(Base):
     __tablename__ = "users_follow"
+    __table_args__ = (
+        UniqueConstraint(
+            "user_follower_id",
+            "user_following_id",
+            name="uq_users_follow_follower_id_following_id",
+        ),
+        Index(
+            "ix_users_follow_following_id_follower_id",
+            "user_following_id",
+            "user_follower_id",
+        ),
+        Index("ix_users_follow_following_id_id", "user_following_id", "id"),
+        Index("ix_users_follow_follower_id_id", "user_follower_id", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_follower_id = Column(
         Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
@@ -105,84 +474,647 @@ class UserFollow(Base):
 
     @classmethod
     async def get(
-        cls, user_follower_id: int, user_following_id: int
+        cls,
+        session: AsyncSession,
+        user_follower_id: int,
+        user_following_id: int,
     ) -> "UserFollow":
-        async with async_session() as session:
-            query = select(UserFollow).filter(
-                and_(
-                    UserFollow.user_follower_id == user_follower_id,
-                    UserFollow.user_following_id == user_following_id,
-                )
+        query = select(UserFollow).filter(
+            and_(
+                UserFollow.user_follower_id == user_follower_id,
+                UserFollow.user_following_id == user_following_id,
+            )
+        )
+        follow = await session.execute(query)
+        return follow.scalar()
+
+    @classmethod
+    async def get_followers(
+        cls,
+        session: AsyncSession,
+        user_id: int,
+        limit: int,
+        before: int = None,
+        after: int = None,
+    ) -> List[Row]:
+        """
+        Get a page of followers of the user, the latest follows first.
+
+        :return: list (rows of `follow_id`, `id` and `name` of the users)
+        """
+        return await cls._get_page(
+            session,
+            UserFollow.user_following_id,
+            UserFollow.user_follower_id,
+            user_id,
+            limit,
+            before,
+            after,
+        )
+
+    @classmethod
+    async def get_following(
+        cls,
+        session: AsyncSession,
+        user_id: int,
+        limit: int,
+        before: int = None,
+        after: int = None,
+    ) -> List[Row]:
+        """
+        Get a page of users followed by the user, the latest follows first.
+
+        :return: list (rows of `follow_id`, `id` and `name` of the users)
+        """
+        return await cls._get_page(
+            session,
+            UserFollow.user_follower_id,
+            UserFollow.user_following_id,
+            user_id,
+            limit,
+            before,
+            after,
+        )
+
+    @classmethod
+    async def get_following_ids(
+        cls, session: AsyncSession, user_id: int
+    ) -> List[int]:
+        query = select(UserFollow.user_following_id).filter(
+            UserFollow.user_follower_id == user_id
+        )
+        following_ids = await session.scalars(query)
+        return following_ids.all()
+
+    @classmethod
+    async def _get_page(
+        cls, session, user_column, other_column, user_id, limit, before, after
+    ) -> List[Row]:
+        query = _keyset_page(
+            select(UserFollow.id.label("follow_id"), User.id, User.name)
+            .join(User, User.id == other_column)
+            .filter(user_column == user_id),
+            UserFollow.id,
+            limit,
+            before,
+            after,
+        )
+        rows = list(await session.execute(query))
+        if after:
+            rows.reverse()
+        return rows
+
+    async def add(self, session: AsyncSession) -> Optional["UserFollow"]:
+        if await _add_all(session, [self]):
+            return self
+
+    @classmethod
+    async def follow(
+        cls,
+        session: AsyncSession,
+        user_follower_id: int,
+        user_following_id: int,
+    ) -> Optional[bool]:
+        """
+        Follow the user by single `INSERT ... ON CONFLICT DO NOTHING`.
+
+        :return: True if the follow was created, False if it already
+            exists, None if there is no user with `user_following_id`
+        """
+        query = (
+            insert(UserFollow)
+            .values(
+                user_follower_id=user_follower_id,
+                user_following_id=user_following_id,
+            )
+            .on_conflict_do_nothing()
+            .returning(UserFollow.id)
+        )
+        try:
+            async with session.begin_nested():
+                follow_id = await session.scalar(query)
+        except IntegrityError:
+            return None
+        return follow_id is not None
+
+    @classmethod
+    async def follow_many(
+        cls,
+        session: AsyncSession,
+        user_follower_id: int,
+        user_following_ids: List[int],
+    ) -> Optional[Dict[int, Optional[bool]]]:
+        """
+        Follow the users by single `INSERT ... SELECT ... ON CONFLICT DO
+        NOTHING` statement, which checks their existence too.
+
+        :return: dict (user id -> True if the follow was created, False if it
+            already exists, None if there is no such user), None if a user
+            was deleted meanwhile
+        """
+        targets = (
+            select(User.id)
+            .filter(User.id.in_(user_following_ids))
+            .cte("targets")
+        )
+        inserted = (
+            insert(UserFollow)
+            .from_select(
+                ["user_follower_id", "user_following_id"],
+                select(literal(user_follower_id), targets.c.id),
             )
-            follow = await session.execute(query)
-            return follow.scalar()
-
-    async def add(self) -> "UserFollow":
-        async with async_session() as session:
-            try:
-                session.add(self)
-                await session.commit()
-                return self
-            except IntegrityError:
-                await session.rollback()
-
-    async def delete(self) -> bool:
-        async with async_session() as session:
-            try:
-                await session.delete(self)
-                await session.commit()
-                return True
-            except IntegrityError:
-                pass
-            return False
+            .on_conflict_do_nothing()
+            .returning(UserFollow.user_following_id)
+            .cte("inserted")
+        )
+        query = select(
+            targets.c.id, inserted.c.user_following_id.is_not(None)
+        ).outerjoin(inserted, inserted.c.user_following_id == targets.c.id)
+        return await _insert_many(session, query, user_following_ids)
+
+    @classmethod
+    async def unfollow(
+        cls,
+        session: AsyncSession,
+        user_follower_id: int,
+        user_following_id: int,
+    ) -> Optional[bool]:
+        """
+        Unfollow the user by single `DELETE ... RETURNING` statement.
+
+        :return: True if the follow was deleted, False if it did not exist,
+            None if there is no user with `user_following_id`
+        """
+        query = delete(UserFollow).filter(
+            and_(
+                UserFollow.user_follower_id == user_follower_id,
+                UserFollow.user_following_id == user_following_id,
+            )
+        )
+        return await _delete_if_exists(
+            session,
+            query.returning(UserFollow.id),
+            User.id == user_following_id,
+        )
+
+
+async def _add_all(session: AsyncSession, instances: list) -> bool:
+    """
+    Add the instances inside a savepoint, so a constraint violation does
+    not abort the transaction of the request.
+
+    :return: bool (False if the instances violate a constraint)
+    """
+    try:
+        async with session.begin_nested():
+            session.add_all(instances)
+    except IntegrityError:
+        return False
+    return True
+
+
+async def _insert_many(
+    session: AsyncSession, query, ids: List[int]
+) -> Optional[Dict[int, Optional[bool]]]:
+    """
+    Execute a query of `(id, created)` rows of existing parents, which
+    inserts the children in the same statement, inside a savepoint.
+
+    :return: dict (id -> created flag, None if the parent does not exist),
+        None if a parent was deleted meanwhile
+    """
+    mark_written(session.sync_session)
+    try:
+        async with session.begin_nested():
+            rows = await session.execute(query)
+    except IntegrityError:
+        return None
+    results = dict.fromkeys(ids)
+    results.update(rows.tuples().all())
+    return results
+
+
+async def _delete_if_exists(
+    session: AsyncSession, query, exists_condition
+) -> Optional[bool]:
+    """
+    Execute `DELETE ... RETURNING` query and check the existence of the
+    parent row in the same statement.
+
+    :return: True if rows were deleted, False if nothing was deleted,
+        None if the parent row does not exist
+    """
+    mark_written(session.sync_session)
+    deleted = query.cte("deleted")
+    statement = select(
+        select(func.count()).select_from(deleted).scalar_subquery(),
+        exists().where(exists_condition),
+    )
+    result = await session.execute(statement)
+    deleted_count, parent_exists = result.one()
+    if deleted_count:
+        return True
+    return False if parent_exists else None
 
 
 class Tweet(Base):
     __tablename__ = "tweets"
+    __table_args__ = (
+        Index("ix_tweets_author_id_id", "author_id", "id"),
+        Index(
+            "uq_tweets_author_id_idempotency_key",
+            "author_id",
+            "idempotency_key",
+            unique=True,
+            postgresql_where=text("idempotency_key IS NOT NULL"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     content = Column(Text)
     author_id = Column(
         Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
     )
+    # Maintained by the `tweet_likes_count` trigger on `tweet_likes`
+    like_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Bumped with `like_count`, a version stamp of the likes for ETags
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # Header 'Idempotency-Key' of the request which added the tweet
+    idempotency_key = Column(String(64))
     author = relationship("User", lazy="joined")
-    medias = relationship("Media", secondary="tweet_medias", lazy="joined")
-    likes = relationship("User", secondary="tweet_likes", lazy="joined")
+    # Collections are loaded by separate `IN` queries: joining both of them
+    # would return medias x likes rows for every tweet. They are in the
+    # order of the links, as in the rows of `User.get_feed`.
+    medias = relationship(
+        "Media",
+        secondary="tweet_medias",
+        order_by="TweetMedia.id",
+        lazy="selectin",
+    )
+    likes = relationship(
+        "User",
+        secondary="tweet_likes",
+        order_by="TweetLike.id",
+        lazy="selectin",
+    )
 
     @classmethod
-    async def get(cls, pk) -> "Tweet":
-        async with async_session() as session:
-            query = select(Tweet).filter(Tweet.id == pk)
-            tweet = await session.execute(query)
-            return tweet.scalar()
-
-    async def add(self) -> "Tweet":
-        async with async_session() as session:
+    async def get(cls, session: AsyncSession, pk) -> "Tweet":
+        query = select(Tweet).filter(Tweet.id == pk)
+        tweet = await session.execute(query)
+        return tweet.scalar()
+
+    @classmethod
+    async def get_many(
+        cls,
+        session: AsyncSession,
+        ids: List[int],
+        user_id: int,
+        compact: bool = False,
+        likes_sample: int = 0,
+    ) -> List[dict]:
+        """
+        Get tweets by ids with a single query, as rows of `User.get_feed`.
+        Missing tweets are skipped.
+
+        :return: list (tweets in the order of `ids`)
+        """
+        page = (
+            select(Tweet.id, Tweet.content, Tweet.author_id, Tweet.like_count)
+            .filter(Tweet.id.in_(ids))
+            .subquery("page")
+        )
+        query = _tweet_rows_query(page, user_id, compact, likes_sample)
+        rows = await session.execute(query)
+        tweets = {tweet["id"]: dict(tweet) for tweet in rows.mappings()}
+        return [tweets[pk] for pk in ids if pk in tweets]
+
+    @classmethod
+    async def get_like_counters(
+        cls, session: AsyncSession, ids: List[int]
+    ) -> List[Row]:
+        """
+        :return: list (rows of `id`, `author_id` and `like_count` of tweets)
+        """
+        query = select(Tweet.id, Tweet.author_id, Tweet.like_count).filter(
+            Tweet.id.in_(ids)
+        )
+        return list(await session.execute(query))
+
+    async def add(self, session: AsyncSession) -> Optional["Tweet"]:
+        """
+        Add the tweet. A tweet with `idempotency_key` is not added if its
+        author has already added one with the key (the request is retried).
+
+        :return: Tweet (the added tweet) or None (if it is not added, see
+            `get_by_idempotency_key`)
+        """
+        if self.idempotency_key is None:
             session.add(self)
-            await session.commit()
+            await session.flush()
+            return self
+        query = (
+            insert(Tweet)
+            .values(
+                content=self.content,
+                author_id=self.author_id,
+                idempotency_key=self.idempotency_key,
+            )
+            .on_conflict_do_nothing(
+                index_elements=["author_id", "idempotency_key"],
+                index_where=Tweet.idempotency_key.isnot(None),
+            )
+            .returning(Tweet.id)
+        )
+        # Waits for a concurrent request with the same key to finish
+        self.id = await session.scalar(query)
+        if self.id is not None:
             return self
 
-    async def delete(self):
-        async with async_session() as session:
-            await session.delete(self)
-            await session.commit()
+    @classmethod
+    async def get_by_idempotency_key(
+        cls, session: AsyncSession, author_id: int, idempotency_key: str
+    ) -> Optional[Row]:
+        """
+        :return: Row (`id`, `content` and `media_ids` of the tweet, in the
+            order of attachment) or None
+        """
+        media_ids = (
+            select(
+                func.array_agg(
+                    aggregate_order_by(TweetMedia.media_id, TweetMedia.id)
+                )
+            )
+            .filter(TweetMedia.tweet_id == Tweet.id)
+            .scalar_subquery()
+        )
+        query = select(
+            Tweet.id,
+            Tweet.content,
+            func.coalesce(media_ids, literal([], ARRAY(Integer))).label(
+                "media_ids"
+            ),
+        ).filter(
+            Tweet.author_id == author_id,
+            Tweet.idempotency_key == idempotency_key,
+        )
+        result = await session.execute(query)
+        return result.first()
+
+    @classmethod
+    async def get_author_id(
+        cls, session: AsyncSession, pk: int
+    ) -> Optional[int]:
+        """
+        :return: int (id of the author of the tweet) or None
+        """
+        query = select(Tweet.author_id).filter(Tweet.id == pk)
+        return await session.scalar(query)
+
+    @classmethod
+    async def delete(cls, session: AsyncSession, pk: int) -> List[str]:
+        """
+        Delete the tweet together with its medias which are not attached to
+        any other tweet anymore and were not handed out by an upload in the
+        last MEDIA_CLAIM_GRACE seconds. Likes and timeline entries are
+        deleted by the database cascades.
+
+        :return: list (paths of deleted medias and their variants, their
+            files can be removed)
+        """
+        query = (
+            delete(TweetMedia)
+            .filter(TweetMedia.tweet_id == pk)
+            .returning(TweetMedia.media_id)
+        )
+        media_ids = list(await session.scalars(query))
+        await session.execute(delete(Tweet).filter(Tweet.id == pk))
+        media_paths = []
+        if media_ids:
+            unreferenced = select(Media.id).filter(
+                Media.id.in_(media_ids),
+                Media.ref_count == 0,
+                Media.claimed_at
+                < func.now() - timedelta(seconds=MEDIA_CLAIM_GRACE),
+            )
+            query = (
+                delete(MediaVariant)
+                .filter(MediaVariant.media_id.in_(unreferenced))
+                .returning(MediaVariant.media_path)
+            )
+            media_paths.extend(await session.scalars(query))
+            query = (
+                delete(Media)
+                .filter(Media.id.in_(unreferenced))
+                .returning(Media.media_path)
+            )
+            media_paths.extend(await session.scalars(query))
+        return media_paths
+
+
+class UserTimeline(Base):
+    """
+    Materialized home timeline: ids of tweets pushed to the followers of
+    their author when the tweet is created.
+    """
+
+    __tablename__ = "user_timelines"
+    __table_args__ = (
+        Index("ix_user_timelines_user_id_author_id", "user_id", "author_id"),
+        Index("ix_user_timelines_tweet_id", "tweet_id"),
+    )
+
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    tweet_id = Column(
+        Integer,
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    author_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+
+    @classmethod
+    async def fan_out(cls, session: AsyncSession, tweet: Tweet):
+        """
+        Push the tweet into timelines of all followers of its author.
+
+        Authors with more than TIMELINE_FANOUT_LIMIT followers are switched
+        to fan-out on read: their tweets are not copied, and the feed query
+        selects them from `tweets` directly.
+        """
+        fanout_on_read = await session.scalar(
+            select(User.fanout_on_read).filter(User.id == tweet.author_id)
+        )
+        if fanout_on_read is None or fanout_on_read:
+            return
+        followers = (
+            select(UserFollow.id)
+            .filter(UserFollow.user_following_id == tweet.author_id)
+            .limit(TIMELINE_FANOUT_LIMIT + 1)
+            .subquery()
+        )
+        followers_count = await session.scalar(
+            select(func.count()).select_from(followers)
+        )
+        if followers_count > TIMELINE_FANOUT_LIMIT:
+            query = (
+                update(User)
+                .filter(User.id == tweet.author_id)
+                .values(fanout_on_read=True)
+            )
+            await session.execute(query)
+        else:
+            query = insert(UserTimeline).from_select(
+                ["user_id", "tweet_id", "author_id"],
+                select(
+                    UserFollow.user_follower_id,
+                    literal(tweet.id),
+                    literal(tweet.author_id),
+                ).filter(UserFollow.user_following_id == tweet.author_id),
+            )
+            await session.execute(query.on_conflict_do_nothing())
+
+    @classmethod
+    async def backfill(
+        cls, session: AsyncSession, user_id: int, author_ids: List[int]
+    ):
+        """
+        Copy the latest TIMELINE_BACKFILL_SIZE tweets of every author into
+        the timeline of the user who has just followed them.
+        """
+        authors = select(User.id).filter(User.id.in_(author_ids)).subquery()
+        latest_tweets = (
+            select(Tweet.id, Tweet.author_id)
+            .filter(Tweet.author_id == authors.c.id)
+            .order_by(Tweet.id.desc())
+            .limit(TIMELINE_BACKFILL_SIZE)
+            .lateral()
+        )
+        query = insert(UserTimeline).from_select(
+            ["user_id", "tweet_id", "author_id"],
+            select(
+                literal(user_id), latest_tweets.c.id, latest_tweets.c.author_id
+            ).select_from(authors.join(latest_tweets, true())),
+        )
+        await session.execute(query.on_conflict_do_nothing())
+
+    @classmethod
+    async def remove_author(
+        cls, session: AsyncSession, user_id: int, author_id: int
+    ):
+        """
+        Remove tweets of the author from the timeline of the user.
+        """
+        query = delete(UserTimeline).filter(
+            and_(
+                UserTimeline.user_id == user_id,
+                UserTimeline.author_id == author_id,
+            )
+        )
+        await session.execute(query)
 
 
 class Media(Base):
     __tablename__ = "medias"
+    __table_args__ = (UniqueConstraint("sha256", name="uq_medias_sha256"),)
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     media_path = Column(String, nullable=False)
+    # SHA-256 of the content, the same file is stored only once
+    sha256 = Column(String(64))
+    # Number of tweets which the media is attached to, maintained by the
+    # `tweet_medias_ref_count` trigger on `tweet_medias`
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # When the media was last handed out by an upload, it is not collected
+    # for MEDIA_CLAIM_GRACE seconds after that
+    claimed_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+    variants = relationship(
+        "MediaVariant", order_by="MediaVariant.width", lazy="selectin"
+    )
 
-    async def add(self) -> "Media":
-        async with async_session() as session:
-            session.add(self)
-            await session.commit()
+    @classmethod
+    async def claim(cls, session: AsyncSession, sha256: str) -> Optional[int]:
+        """
+        Hand out the media with this content to an uploader again: it is
+        marked as claimed now, so it is not collected while the uploader
+        attaches it, even if the tweets which have it are deleted.
+
+        :return: int (id of the media) or None if there is no such media
+        """
+        query = (
+            update(Media)
+            .filter(Media.sha256 == sha256)
+            .values(claimed_at=func.now())
+            .returning(Media.id)
+        )
+        return await session.scalar(query)
+
+    async def add(self, session: AsyncSession) -> Optional["Media"]:
+        if await _add_all(session, [self]):
             return self
 
 
+class MediaVariant(Base):
+    """
+    Resized copy of an image media, generated in background after upload.
+    """
+
+    __tablename__ = "media_variants"
+    __table_args__ = (
+        UniqueConstraint(
+            "media_id", "width", name="uq_media_variants_media_id_width"
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    media_id = Column(
+        Integer, ForeignKey("medias.id", ondelete="CASCADE"), nullable=False
+    )
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    media_path = Column(String, nullable=False)
+
+    @classmethod
+    async def add_many(
+        cls, session: AsyncSession, variants: List["MediaVariant"]
+    ) -> Optional[List["MediaVariant"]]:
+        """
+        Add variants of medias and bump versions of the tweets with these
+        medias, since the variants are rendered in them (and feed stamps
+        must change).
+        """
+        if not await _add_all(session, variants):
+            return None
+        media_ids = {variant.media_id for variant in variants}
+        await session.execute(
+            update(Tweet)
+            .where(
+                Tweet.id.in_(
+                    select(TweetMedia.tweet_id).filter(
+                        TweetMedia.media_id.in_(media_ids)
+                    )
+                )
+            )
+            .values(version=Tweet.version + 1)
+        )
+        return variants
+
+
 class TweetMedia(Base):
     __tablename__ = "tweet_medias"
+    __table_args__ = (
+        UniqueConstraint(
+            "tweet_id", "media_id", name="uq_tweet_medias_tweet_id_media_id"
+        ),
+        Index("ix_tweet_medias_media_id", "media_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     tweet_id = Column(
@@ -192,34 +1124,52 @@ class TweetMedia(Base):
         Integer, ForeignKey("medias.id", ondelete="CASCADE"), nullable=False
     )
 
-    async def add(self) -> Optional["TweetMedia"]:
-        async with async_session() as session:
-            try:
-                session.add(self)
-                await session.commit()
-                return self
-            except IntegrityError:
-                await session.rollback()
+    async def add(self, session: AsyncSession) -> Optional["TweetMedia"]:
+        if await _add_all(session, [self]):
+            return self
 
     @classmethod
     async def add_many(
-        self, tweet_id: int, media_ids: List[int]
-    ) -> Optional[List["TweetMedia"]]:
-        instances = [
-            TweetMedia(tweet_id=tweet_id, media_id=media_id)
-            for media_id in media_ids
-        ]
-        async with async_session() as session:
-            try:
-                session.add_all(instances)
-                await session.commit()
-                return instances
-            except IntegrityError:
-                await session.rollback()
+        cls, session: AsyncSession, tweet_id: int, media_ids: List[int]
+    ) -> bool:
+        """
+        Attach medias to the tweet, in the order of `media_ids`, with one
+        statement which inserts links only to the existing medias.
+
+        :return: bool (False if some medias do not exist or are deleted
+            meanwhile, then the request has to be rolled back)
+        """
+        media_ids = list(dict.fromkeys(media_ids))
+        existing = (
+            select(literal(tweet_id), Media.id)
+            .filter(Media.id.in_(media_ids))
+            .order_by(
+                func.array_position(
+                    literal(media_ids, ARRAY(Integer)), Media.id
+                )
+            )
+            # Medias deleted after the statement started are skipped rather
+            # than failing the foreign key (and the transaction)
+            .with_for_update(read=True, key_share=True)
+        )
+        query = (
+            insert(TweetMedia)
+            .from_select(["tweet_id", "media_id"], existing)
+            .returning(TweetMedia.id)
+        )
+        inserted = await session.scalars(query)
+        return len(inserted.all()) == len(media_ids)
 
 
 class TweetLike(Base):
     __tablename__ = "tweet_likes"
+    __table_args__ = (
+        UniqueConstraint(
+            "tweet_id", "user_id", name="uq_tweet_likes_tweet_id_user_id"
+        ),
+        Index("ix_tweet_likes_tweet_id_id", "tweet_id", "id"),
+        Index("ix_tweet_likes_user_id", "user_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     tweet_id = Column(
@@ -230,27 +1180,203 @@ class TweetLike(Base):
     )
 
     @classmethod
-    async def get(self, tweet_id: int, user_id: int):
-        async with async_session() as session:
-            query = select(TweetLike).filter(
-                and_(
-                    TweetLike.tweet_id == tweet_id,
-                    TweetLike.user_id == user_id,
-                )
+    async def get(self, session: AsyncSession, tweet_id: int, user_id: int):
+        query = select(TweetLike).filter(
+            and_(
+                TweetLike.tweet_id == tweet_id,
+                TweetLike.user_id == user_id,
+            )
+        )
+        like = await session.execute(query)
+        return like.scalar()
+
+    @classmethod
+    async def like(
+        cls, session: AsyncSession, tweet_id: int, user_id: int
+    ) -> Optional[bool]:
+        """
+        Set like by single `INSERT ... ON CONFLICT DO NOTHING` statement.
+
+        :return: True if the like was set, False if it is already set,
+            None if there is no tweet with `tweet_id`
+        """
+        query = (
+            insert(TweetLike)
+            .values(tweet_id=tweet_id, user_id=user_id)
+            .on_conflict_do_nothing()
+            .returning(TweetLike.id)
+        )
+        try:
+            async with session.begin_nested():
+                like_id = await session.scalar(query)
+        except IntegrityError:
+            return None
+        return like_id is not None
+
+    @classmethod
+    async def like_many(
+        cls, session: AsyncSession, tweet_ids: List[int], user_id: int
+    ) -> Optional[Dict[int, Optional[bool]]]:
+        """
+        Set likes by single `INSERT ... SELECT ... ON CONFLICT DO NOTHING`
+        statement, which checks existence of the tweets too.
+
+        :return: dict (tweet id -> True if the like was set, False if it is
+            already set, None if there is no such tweet), None if a tweet
+            was deleted meanwhile
+        """
+        targets = (
+            select(Tweet.id).filter(Tweet.id.in_(tweet_ids)).cte("targets")
+        )
+        inserted = (
+            insert(TweetLike)
+            .from_select(
+                ["tweet_id", "user_id"],
+                select(targets.c.id, literal(user_id)),
             )
-            like = await session.execute(query)
-            return like.scalar()
-
-    async def add(self):
-        async with async_session() as session:
-            try:
-                session.add(self)
-                await session.commit()
-                return self
-            except IntegrityError:
-                await session.rollback()
-
-    async def delete(self):
-        async with async_session() as session:
-            await session.delete(self)
-            await session.commit()
+            .on_conflict_do_nothing()
+            .returning(TweetLike.tweet_id)
+            .cte("inserted")
+        )
+        query = select(
+            targets.c.id, inserted.c.tweet_id.is_not(None)
+        ).outerjoin(inserted, inserted.c.tweet_id == targets.c.id)
+        return await _insert_many(session, query, tweet_ids)
+
+    @classmethod
+    async def unlike(
+        cls, session: AsyncSession, tweet_id: int, user_id: int
+    ) -> Optional[bool]:
+        """
+        Remove like by single `DELETE ... RETURNING` statement.
+
+        :return: True if the like was removed, False if it was not set,
+            None if there is no tweet with `tweet_id`
+        """
+        query = delete(TweetLike).filter(
+            and_(TweetLike.tweet_id == tweet_id, TweetLike.user_id == user_id)
+        )
+        return await _delete_if_exists(
+            session, query.returning(TweetLike.id), Tweet.id == tweet_id
+        )
+
+
+# Keeps `tweets.like_count` in the same transaction as the like itself, so
+# the counter is right for every writer, including cascade deletes.
+event.listen(
+    TweetLike.__table__,
+    "after_create",
+    DDL(
+        """
+        CREATE OR REPLACE FUNCTION tweet_likes_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE tweets
+                SET like_count = like_count + 1, version = version + 1
+                WHERE id = NEW.tweet_id;
+            ELSE
+                UPDATE tweets
+                SET like_count = like_count - 1, version = version + 1
+                WHERE id = OLD.tweet_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    ),
+)
+event.listen(
+    TweetLike.__table__,
+    "after_create",
+    DDL(
+        """
+        CREATE TRIGGER tweet_likes_count
+        AFTER INSERT OR DELETE ON tweet_likes
+        FOR EACH ROW EXECUTE FUNCTION tweet_likes_count()
+        """
+    ),
+)
+
+# Keeps `users.followers_count` and `users.following_count`. Both rows are
+# locked in the order of ids first: users who follow each other at the same
+# time would lock them in opposite orders and deadlock.
+event.listen(
+    UserFollow.__table__,
+    "after_create",
+    DDL(
+        """
+        CREATE OR REPLACE FUNCTION users_follow_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM 1 FROM users
+                WHERE id IN (NEW.user_following_id, NEW.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users
+                SET followers_count = followers_count + 1, version = version + 1
+                WHERE id = NEW.user_following_id;
+                UPDATE users
+                SET following_count = following_count + 1, version = version + 1
+                WHERE id = NEW.user_follower_id;
+            ELSE
+                PERFORM 1 FROM users
+                WHERE id IN (OLD.user_following_id, OLD.user_follower_id)
+                ORDER BY id FOR NO KEY UPDATE;
+                UPDATE users
+                SET followers_count = followers_count - 1, version = version + 1
+                WHERE id = OLD.user_following_id;
+                UPDATE users
+                SET following_count = following_count - 1, version = version + 1
+                WHERE id = OLD.user_follower_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    ),
+)
+event.listen(
+    UserFollow.__table__,
+    "after_create",
+    DDL(
+        """
+        CREATE TRIGGER users_follow_count
+        AFTER INSERT OR DELETE ON users_follow
+        FOR EACH ROW EXECUTE FUNCTION users_follow_count()
+        """
+    ),
+)
+
+# Keeps `medias.ref_count`, medias which are not referenced anymore are
+# collected by `Tweet.delete`.
+event.listen(
+    TweetMedia.__table__,
+    "after_create",
+    DDL(
+        """
+        CREATE OR REPLACE FUNCTION tweet_medias_ref_count() RETURNS trigger
+        AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE medias SET ref_count = ref_count + 1
+                WHERE id = NEW.media_id;
+            ELSE
+                UPDATE medias SET ref_count = ref_count - 1
+                WHERE id = OLD.media_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    ),
+)
+event.listen(
+    TweetMedia.__table__,
+    "after_create",
+    DDL(
+        """
+        CREATE TRIGGER tweet_medias_ref_count
+        AFTER INSERT OR DELETE ON tweet_medias
+        FOR EACH ROW EXECUTE FUNCTION tweet_medias_ref_count()
+        """
+    ),
+)
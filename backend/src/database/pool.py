@@ -0,0 +1,165 @@
+import orjson
+import time
+import uuid
+from typing import Any, Dict
+
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from conf import (
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_CACHE_SIZE,
+    DB_STATEMENT_TIMEOUT,
+    DB_IDLE_IN_TRANSACTION_TIMEOUT,
+    DB_APPLICATION_NAME,
+    DB_PGBOUNCER,
+)
+
+
+class PoolMetrics:
+    """
+    Counters of connection checkouts from the pool.
+
+    Wait time is the time spent to get a connection: waiting for a free one
+    or opening a new one.
+    """
+
+    # Weight of a checkout in the recent wait time, which also halves every
+    # RECENT_WAIT_HALF_LIFE seconds, so it falls when there are no checkouts
+    RECENT_WAIT_WEIGHT = 0.1
+    RECENT_WAIT_HALF_LIFE = 1.0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._recent_wait_time = 0.0
+        self._observed_at = time.monotonic()
+
+    def observe_wait(self, wait_time: float):
+        self.checkouts += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        now = time.monotonic()
+        recent = self.recent_wait_time(now)
+        self._recent_wait_time = (
+            recent + (wait_time - recent) * self.RECENT_WAIT_WEIGHT
+        )
+        self._observed_at = now
+
+    def recent_wait_time(self, now: float = None) -> float:
+        """
+        Moving average of the wait time of recent checkouts, seconds.
+        """
+        elapsed = (now or time.monotonic()) - self._observed_at
+        return self._recent_wait_time * 0.5 ** (
+            elapsed / self.RECENT_WAIT_HALF_LIFE
+        )
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Default pool of async engines which collects `PoolMetrics`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self) -> "InstrumentedPool":
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        overflow = self._overflow
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            self.metrics.observe_wait(time.perf_counter() - start)
+        if self._overflow > overflow and self.overflow() > 0:
+            self.metrics.overflows += 1
+        return connection
+
+
+def engine_options(**overrides) -> Dict[str, Any]:
+    """
+    Keyword arguments of `create_async_engine` from the configuration.
+
+    In PgBouncer mode prepared statements are neither cached by asyncpg nor
+    by SQLAlchemy, and they get unique names, because the next statement
+    can be executed by another server connection.
+
+    JSON columns (like aggregates of `User.get_feed`) are decoded by orjson.
+
+    :param overrides: arguments to replace the configured ones
+    :return: dict (arguments of `create_async_engine`)
+    """
+    server_settings = {"application_name": DB_APPLICATION_NAME}
+    if DB_STATEMENT_TIMEOUT:
+        server_settings["statement_timeout"] = str(DB_STATEMENT_TIMEOUT)
+    if DB_IDLE_IN_TRANSACTION_TIMEOUT:
+        server_settings["idle_in_transaction_session_timeout"] = str(
+            DB_IDLE_IN_TRANSACTION_TIMEOUT
+        )
+    connect_args = {"server_settings": server_settings}
+    if DB_PGBOUNCER:
+        connect_args.update(
+            statement_cache_size=0,
+            prepared_statement_cache_size=0,
+            prepared_statement_name_func=_statement_name,
+        )
+    else:
+        connect_args["prepared_statement_cache_size"] = DB_STATEMENT_CACHE_SIZE
+    return {
+        "poolclass": InstrumentedPool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "connect_args": connect_args,
+        "json_deserializer": orjson.loads,
+        **overrides,
+    }
+
+
+def _statement_name() -> str:
+    return f"__asyncpg_{uuid.uuid4()}__"
+
+
+def pool_status(engine: AsyncEngine) -> Dict[str, Any]:
+    """
+    Current usage of the pool of the engine together with its metrics.
+    """
+    pool = engine.pool
+    status = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+    }
+    metrics = getattr(pool, "metrics", None)
+    if metrics:
+        status.update(
+            checkouts=metrics.checkouts,
+            overflows=metrics.overflows,
+            timeouts=metrics.timeouts,
+            wait_time=metrics.wait_time,
+            max_wait_time=metrics.max_wait_time,
+            recent_wait_time=metrics.recent_wait_time(),
+        )
+    return status
@@ -0,0 +1,89 @@
+import random
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.orm import Session
+
+from cache import TTLCache
+from conf import (
+    POSTGRES_REPLICA_URLS,
+    READ_YOUR_WRITES_WINDOW,
+    READ_YOUR_WRITES_SIZE,
+)
+from database.pool import engine_options
+
+replica_engines = [
+    create_async_engine(url, **engine_options())
+    for url in POSTGRES_REPLICA_URLS
+]
+# Keys of writers (api-keys) whose reads must see their own writes, in this
+# worker process; other workers see the cookie READ_YOUR_WRITES_COOKIE
+recent_writers = TTLCache(
+    maxsize=READ_YOUR_WRITES_SIZE, ttl=READ_YOUR_WRITES_WINDOW
+)
+
+
+def choose_replica(
+    writer: Optional[str], written_until: Optional[str] = None
+) -> Optional[AsyncEngine]:
+    """
+    Choose a replica for the read-only request, or None if it must be
+    served by the primary: there are no replicas, or the writer has written
+    something less than READ_YOUR_WRITES_WINDOW seconds ago.
+
+    :param writer: str (api-key of the user, if any)
+    :param written_until: str (value of cookie READ_YOUR_WRITES_COOKIE, the
+        time until the reads of the client go to the primary, if any)
+    """
+    if not replica_engines:
+        return None
+    if writer and recent_writers.get(writer):
+        return None
+    if written_until:
+        try:
+            if float(written_until) > time.time():
+                return None
+        except ValueError:
+            pass
+    return random.choice(replica_engines)
+
+
+def mark_written(session: Session):
+    """
+    Mark that the session writes, for statements which are not detected by
+    `RoutingSession.get_bind` (like DML in CTEs of a SELECT).
+    """
+    session.info["wrote"] = True
+
+
+class RoutingSession(Session):
+    """
+    Session which sends reads to the replica in `info["replica"]`, if it is
+    set, and everything else to the primary.
+
+    A session which has written marks `info["writer"]` in `recent_writers`
+    on commit, and sets `written_until` of the request state in
+    `info["state"]` for `ReadYourWritesMiddleware`.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if self._flushing or getattr(clause, "is_dml", False):
+            self.info["wrote"] = True
+        elif replica is not None:
+            return replica.sync_engine
+        return super().get_bind(mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _remember_writer(session: Session):
+    if not session.info.pop("wrote", False):
+        return
+    writer = session.info.get("writer")
+    if writer:
+        recent_writers.set(writer, True)
+    state = session.info.get("state")
+    if state is not None:
+        state.written_until = time.time() + READ_YOUR_WRITES_WINDOW
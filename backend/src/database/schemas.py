@@ -1,7 +1,98 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Annotated, Optional, List, TypedDict
+
+from conf import BATCH_MAX_SIZE
+from pagination import MAX_PK
+
+
+# Id of a row, out of range ids would fail in Postgres instead of not found
+Pk = Annotated[int, Field(ge=0, le=MAX_PK)]
 
 
 class TweetIn(BaseModel):
     tweet_data: str
     tweet_media_ids: Optional[List[int]]
+
+
+class LikesBatchIn(BaseModel):
+    tweet_ids: List[Pk] = Field(min_length=1, max_length=BATCH_MAX_SIZE)
+
+
+class FollowBatchIn(BaseModel):
+    user_ids: List[Pk] = Field(min_length=1, max_length=BATCH_MAX_SIZE)
+
+
+# Response schemas are TypedDicts: they are typed, but built as plain dict
+# literals without validation, which orjson serializes fastest (see
+# `ORJSONResponse`). Builders accept anything with the needed attributes:
+# ORM instances or result rows. Tweets have no builders, rows of
+# `User.get_feed` already have their shape.
+
+
+class UserOut(TypedDict):
+    id: int
+    name: str
+
+
+class MediaVariantOut(TypedDict):
+    width: int
+    height: int
+    url: str
+
+
+class AttachmentOut(TypedDict):
+    url: str
+    variants: List[MediaVariantOut]
+
+
+class TweetOut(TypedDict):
+    id: int
+    content: str
+    author: UserOut
+    attachments: List[str]
+    attachment_variants: List[AttachmentOut]
+    likes: List[UserOut]
+
+
+class CompactTweetOut(TypedDict):
+    id: int
+    content: str
+    author: UserOut
+    attachments: List[str]
+    attachment_variants: List[AttachmentOut]
+    like_count: int
+    liked_by_me: bool
+    likes: List[UserOut]
+
+
+class CompactProfileOut(TypedDict):
+    id: int
+    name: str
+    followers_count: int
+    following_count: int
+
+
+class ProfileOut(CompactProfileOut):
+    followers: List[UserOut]
+    following: List[UserOut]
+
+
+def build_user(user) -> UserOut:
+    return {"id": user.id, "name": user.name}
+
+
+def build_compact_profile(user) -> CompactProfileOut:
+    return {
+        "id": user.id,
+        "name": user.name,
+        "followers_count": user.followers_count,
+        "following_count": user.following_count,
+    }
+
+
+def build_profile(user) -> ProfileOut:
+    return {
+        **build_compact_profile(user),
+        "followers": [build_user(f_user) for f_user in user.followers],
+        "following": [build_user(f_user) for f_user in user.following],
+    }
@@ -0,0 +1,37 @@
+import hashlib
+
+from fastapi import Request, Response
+
+
+def make_etag(*parts) -> str:
+    """
+    Make weak ETag from a version stamp of the response.
+
+    :param parts: everything the response depends on (version stamps,
+        id of the user, query parameters)
+    :return: str (weak ETag)
+    """
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=8)
+    return f'W/"{digest.hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Check header 'If-None-Match' of the request by weak comparison.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == opaque_tag
+        for tag in if_none_match.split(",")
+    )
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(
+        status_code=304, headers={"ETag": etag, "Cache-Control": cache_control}
+    )
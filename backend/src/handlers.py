@@ -1,4 +1,4 @@
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi import HTTPException, Request
 
 
@@ -8,4 +8,4 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         "error_type": "HttpException",
         "error_message": exc.detail,
     }
-    return JSONResponse(status_code=exc.status_code, content=response)
+    return ORJSONResponse(status_code=exc.status_code, content=response)
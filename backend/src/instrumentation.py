@@ -0,0 +1,340 @@
+import bisect
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from conf import (
+    METRICS_BUCKETS,
+    SLOW_REQUESTS_SIZE,
+    SLOW_REQUEST_THRESHOLD,
+    SLOW_REQUEST_MAX_STATEMENTS,
+)
+
+
+class RequestStats:
+    """
+    Database usage and timings of phases of one request.
+    """
+
+    __slots__ = ("queries", "rows", "db_time", "statements", "phases")
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0.0
+        # (SQL, seconds) of the first SLOW_REQUEST_MAX_STATEMENTS queries
+        self.statements: List[Tuple[str, float]] = []
+        self.phases: Dict[str, float] = {}
+
+    def server_timing(self, total: float) -> str:
+        """
+        Value of header 'Server-Timing', durations are in milliseconds.
+        """
+        metrics = [
+            f'db;dur={self.db_time * 1e3:.1f};desc="{self.queries} queries"'
+        ]
+        metrics.extend(
+            f"{name};dur={duration * 1e3:.1f}"
+            for name, duration in self.phases.items()
+        )
+        metrics.append(f"app;dur={total * 1e3:.1f}")
+        return ", ".join(metrics)
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    "request_stats", default=None
+)
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a phase of the current request, it is reported in 'Server-Timing'
+    and the slow log. Queries of the phase are included in `db` as well.
+    Phases of routes: `auth`, `query` (loading of the rows, with their
+    processing in Python) and `serialize` (rendering of the response).
+    """
+    stats = _request_stats.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.phases[name] = stats.phases.get(name, 0.0) + (
+                time.perf_counter() - started
+            )
+
+
+# Listens on all engines: the primary, replicas and the test ones
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, *args):
+    if _request_stats.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, *args):
+    stats = _request_stats.get()
+    started = conn.info.get("query_started")
+    if stats is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats.queries += 1
+    stats.db_time += elapsed
+    # asyncpg cursor adapter buffers the whole result of a query
+    rows = getattr(cursor, "_rows", None)
+    stats.rows += len(rows) if rows else max(cursor.rowcount, 0)
+    if len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.statements.append((statement, elapsed))
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # A failed query has no `after_cursor_execute`, its start time must not
+    # be taken by the next query of the connection
+    conn = context.connection
+    started = conn.info.get("query_started") if conn is not None else None
+    if started:
+        started.pop()
+
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        # The last one counts observations above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Per-route metrics of requests of this worker process, rendered in
+    Prometheus text format.
+    """
+
+    def __init__(self, buckets: List[float] = METRICS_BUCKETS):
+        self.buckets = sorted(buckets)
+        self.durations: Dict[Tuple[str, str], Histogram] = {}
+        self.responses: Dict[Tuple[str, str, int], int] = {}
+        self.queries: Dict[Tuple[str, str], int] = {}
+        self.rows: Dict[Tuple[str, str], int] = {}
+        self.db_time: Dict[Tuple[str, str], float] = {}
+
+    def observe(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        duration: Optional[float],
+        stats: RequestStats,
+    ):
+        """
+        :param duration: float (seconds, None for streams, which last as
+            long as the client is connected and are not timed)
+        """
+        key = (method, route)
+        if duration is not None:
+            histogram = self.durations.get(key)
+            if histogram is None:
+                histogram = self.durations[key] = Histogram(self.buckets)
+            histogram.observe(duration)
+        status_key = (method, route, status)
+        self.responses[status_key] = self.responses.get(status_key, 0) + 1
+        self.queries[key] = self.queries.get(key, 0) + stats.queries
+        self.rows[key] = self.rows.get(key, 0) + stats.rows
+        self.db_time[key] = self.db_time.get(key, 0.0) + stats.db_time
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_request_duration_seconds Duration of requests",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), histogram in sorted(self.durations.items()):
+            labels = _labels(method=method, route=route)
+            cumulative = 0
+            bounds = [*(str(bucket) for bucket in self.buckets), "+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f"http_request_duration_seconds_bucket"
+                    f'{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f"http_request_duration_seconds_sum{{{labels}}} "
+                f"{histogram.sum}"
+            )
+            lines.append(
+                f"http_request_duration_seconds_count{{{labels}}} "
+                f"{histogram.count}"
+            )
+        lines += [
+            "# HELP http_responses_total Responses by status",
+            "# TYPE http_responses_total counter",
+        ]
+        for (method, route, status), count in sorted(self.responses.items()):
+            labels = _labels(method=method, route=route, status=status)
+            lines.append(f"http_responses_total{{{labels}}} {count}")
+        for name, values, help_text in (
+            ("db_queries_total", self.queries, "Database queries"),
+            ("db_rows_total", self.rows, "Rows returned or changed"),
+            ("db_seconds_total", self.db_time, "Time of database queries"),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (method, route), value in sorted(values.items()):
+                labels = _labels(method=method, route=route)
+                lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def render_gauges(prefix: str, values: dict) -> str:
+    """
+    Render numeric values as Prometheus gauges named `<prefix>_<key>`.
+    """
+    lines = []
+    for key, value in values.items():
+        lines += [f"# TYPE {prefix}_{key} gauge", f"{prefix}_{key} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def _labels(**labels) -> str:
+    escaped = {
+        name: str(value).replace("\\", "\\\\").replace('"', '\\"')
+        for name, value in labels.items()
+    }
+    return ",".join(f'{name}="{value}"' for name, value in escaped.items())
+
+
+class SlowLog:
+    """
+    The slowest `size` requests slower than `threshold` seconds. A request
+    is logged with its SQL when it gets into them.
+    """
+
+    def __init__(
+        self,
+        size: int = SLOW_REQUESTS_SIZE,
+        threshold: float = SLOW_REQUEST_THRESHOLD,
+    ):
+        self.size = size
+        self.threshold = threshold
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+
+    def record(self, method: str, path: str, duration: float, stats):
+        if duration < self.threshold or not self.size:
+            return
+        entry = (duration, next(self._counter), method, path, stats)
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, entry)
+        elif duration > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+        else:
+            return
+        statements = "\n".join(
+            f"  {elapsed * 1e3:8.1f} ms  {statement}"
+            for statement, elapsed in stats.statements
+        )
+        phases = "".join(
+            f", {name} {elapsed * 1e3:.1f} ms"
+            for name, elapsed in stats.phases.items()
+        )
+        logging.warning(
+            f"Slow request {method} {path}: {duration * 1e3:.1f} ms, "
+            f"{stats.queries} queries in {stats.db_time * 1e3:.1f} ms"
+            f"{phases}\n{statements}"
+        )
+
+    def slowest(self) -> List[tuple]:
+        """
+        :return: list (duration, method, path and stats of the requests,
+            the slowest first)
+        """
+        return [
+            (duration, method, path, stats)
+            for duration, _, method, path, stats in sorted(
+                self._heap, reverse=True
+            )
+        ]
+
+
+metrics = Metrics()
+slow_log = SlowLog()
+
+
+class InstrumentationMiddleware:
+    """
+    Collect database usage and phase timings of every request, report them
+    in header 'Server-Timing', add them to `metrics` and `slow_log`.
+    Durations of event streams are neither observed nor logged as slow.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        registry: Optional[Metrics] = None,
+        slow_requests: Optional[SlowLog] = None,
+    ):
+        self.app = app
+        # Module objects are looked up when the middleware stack is built
+        self.metrics = registry or metrics
+        self.slow_log = slow_requests or slow_log
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        started = time.perf_counter()
+        status = 500
+        streaming = False
+
+        async def timed_send(message: Message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                content_type = dict(message.get("headers", [])).get(
+                    b"content-type", b""
+                )
+                streaming = content_type.startswith(b"text/event-stream")
+                timing = stats.server_timing(time.perf_counter() - started)
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"server-timing", timing.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            _request_stats.reset(token)
+            duration = time.perf_counter() - started
+            # Route templates keep the number of metrics bounded
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            self.metrics.observe(
+                scope["method"],
+                route_path,
+                status,
+                None if streaming else duration,
+                stats,
+            )
+            if not streaming:
+                self.slow_log.record(
+                    scope["method"], scope["path"], duration, stats
+                )
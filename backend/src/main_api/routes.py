@@ -1,5 +1,10 @@
 from fastapi import APIRouter
 from fastapi.openapi.docs import get_swagger_ui_html
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+
+from database.models import engine
+from database.pool import pool_status
+from instrumentation import metrics, render_gauges
 
 router = APIRouter()
 
@@ -7,3 +12,29 @@ router = APIRouter()
 @router.get("/docs")
 async def get_swagger_docs():
     return get_swagger_ui_html(openapi_url="/openapi.yml", title="Twitter")
+
+
+@router.get("/pool")
+async def get_pool_status() -> ORJSONResponse:
+    """
+    Get usage of the database connection pool of this worker process.
+
+    :return: ORJSONResponse (checked out connections, overflow and counters of
+        checkouts, overflow events, timeouts and wait time in seconds, the
+        recent wait time which sheds load, see `RateLimitMiddleware`)
+    """
+    response = {"result": True, "pool": pool_status(engine)}
+    return ORJSONResponse(content=response)
+
+
+@router.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+    """
+    Get metrics of this worker process in Prometheus text format: per-route
+    histograms of request duration, responses by status, database queries,
+    rows and time, and usage of the connection pool.
+
+    :return: PlainTextResponse (metrics)
+    """
+    content = metrics.render() + render_gauges("db_pool", pool_status(engine))
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
@@ -1,24 +1,68 @@
-from fastapi import APIRouter, UploadFile, File
-from fastapi.responses import JSONResponse
-import aiofiles
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-import uuid
 import os
-from database.models import Media
+from auth import Principal, get_current_user
+from conf import MEDIA_URL
+from database.models import Media, get_session
+from medias_api.storage import (
+    MediaTooLarge,
+    save_upload,
+    commit_upload,
+    discard_upload,
+)
+from medias_api.variants import pipeline
 
 
 router = APIRouter()
 
 
 @router.post("")
-async def post_tweet_media(file: UploadFile = File(...)) -> JSONResponse:
-    media_content = await file.read()
-    filename, file_extension = os.path.splitext(file.filename)
-    unique_filename = "{}_{}{}".format(filename, uuid.uuid4(), file_extension)
-    media_path = f"/medias/{unique_filename}"
-    media = Media(media_path=media_path)
-    media = await media.add()
-    async with aiofiles.open(media_path, mode="wb") as media_file:
-        await media_file.write(media_content)
-    response = {"result": True, "media_id": media.id}
-    return JSONResponse(content=response, status_code=201)
+async def post_tweet_media(
+    file: UploadFile = File(...),
+    user: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Upload media to attach it to a tweet later.
+
+    Medias are addressed by SHA-256 of their content: if the same file was
+    already uploaded, its media is returned (and kept from collection for
+    MEDIA_CLAIM_GRACE seconds) and no file is written. A new
+    file is streamed to disk by chunks and saved into database only when it
+    is completely written, then resized copies of images are generated in
+    background.
+
+    :param file: UploadFile (media file)
+    :param user: Principal (user authenticated by header 'api-key')
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (id of the media)
+    """
+    try:
+        stored = await save_upload(file)
+    except MediaTooLarge:
+        raise HTTPException(status_code=413, detail="Media is too large")
+    media_id = await Media.claim(session, stored.sha256)
+    if media_id:
+        await session.commit()
+        await discard_upload(stored.temp_path)
+    else:
+        file_extension = os.path.splitext(file.filename)[1].lower()
+        filename = f"{stored.sha256}{file_extension}"
+        file_path = await commit_upload(stored, filename)
+        media = Media(
+            media_path=f"{MEDIA_URL}/{filename}", sha256=stored.sha256
+        )
+        # The same content may be uploaded concurrently, then the first
+        # media wins and the file written by both is the same
+        added = await media.add(session)
+        if added:
+            await session.commit()
+            pipeline.submit(media_id=added.id, file_path=file_path)
+            media_id = added.id
+        else:
+            media_id = await Media.claim(session, stored.sha256)
+            await session.commit()
+    response = {"result": True, "media_id": media_id}
+    return ORJSONResponse(content=response, status_code=201)
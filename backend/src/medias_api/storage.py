@@ -0,0 +1,80 @@
+import hashlib
+import os
+import uuid
+from typing import Iterable, NamedTuple
+
+import aiofiles
+import aiofiles.os
+from fastapi import UploadFile
+
+from conf import MEDIA_ROOT, MEDIA_MAX_SIZE, MEDIA_CHUNK_SIZE
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class StoredMedia(NamedTuple):
+    temp_path: str
+    size: int
+    sha256: str
+
+
+async def save_upload(file: UploadFile) -> StoredMedia:
+    """
+    Copy uploaded file into a temporary file in MEDIA_ROOT by chunks of
+    MEDIA_CHUNK_SIZE, so memory used per upload does not depend on the size
+    of the file. SHA-256 of the content is computed on the way.
+
+    The file must be moved to its place by `commit_upload` or removed by
+    `discard_upload`.
+
+    :param file: UploadFile (uploaded file)
+    :return: StoredMedia (temporary path, size and hash of the file)
+    :raise MediaTooLarge: if the file is larger than MEDIA_MAX_SIZE
+    """
+    temp_path = os.path.join(MEDIA_ROOT, f".{uuid.uuid4()}.part")
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, mode="wb") as media_file:
+            while chunk := await file.read(MEDIA_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MEDIA_MAX_SIZE:
+                    raise MediaTooLarge()
+                sha256.update(chunk)
+                await media_file.write(chunk)
+    except BaseException:
+        await discard_upload(temp_path)
+        raise
+    return StoredMedia(
+        temp_path=temp_path, size=size, sha256=sha256.hexdigest()
+    )
+
+
+async def commit_upload(stored: StoredMedia, filename: str) -> str:
+    """
+    Move completely written upload to MEDIA_ROOT under the given name.
+
+    :return: str (path of the file)
+    """
+    file_path = os.path.join(MEDIA_ROOT, filename)
+    await aiofiles.os.replace(stored.temp_path, file_path)
+    return file_path
+
+
+async def discard_upload(temp_path: str):
+    if await aiofiles.os.path.exists(temp_path):
+        await aiofiles.os.remove(temp_path)
+
+
+async def remove_media_files(media_paths: Iterable[str]):
+    """
+    Remove files of deleted medias.
+
+    :param media_paths: Iterable (`Media.media_path` of deleted medias)
+    """
+    for media_path in media_paths:
+        file_path = os.path.join(MEDIA_ROOT, os.path.basename(media_path))
+        if await aiofiles.os.path.exists(file_path):
+            await aiofiles.os.remove(file_path)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from conf import (
+    MEDIA_URL,
+    MEDIA_VARIANT_WIDTHS,
+    MEDIA_VARIANT_QUALITY,
+    MEDIA_WORKERS,
+    MEDIA_QUEUE_SIZE,
+)
+from database.models import MediaVariant, async_session
+from medias_api.storage import remove_media_files
+
+
+def render_variants(
+    file_path: str, widths: List[int], quality: int
+) -> List[Tuple[int, int, str]]:
+    """
+    Write WebP copies of the image resized to the given widths next to it.
+    Runs in a worker process, images are never upscaled.
+
+    :param file_path: str (path of the original image)
+    :param widths: list (widths of the variants)
+    :param quality: int (WebP quality)
+    :return: list (width, height and filename of every written variant)
+    """
+    variants = []
+    try:
+        image = Image.open(file_path)
+    except UnidentifiedImageError:
+        return variants
+    with image:
+        image = ImageOps.exif_transpose(image)
+        mode = "RGBA" if image.has_transparency_data else "RGB"
+        image = image.convert(mode)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        for width in sorted(set(widths)):
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            filename = f"{name}_{width}w.webp"
+            variant_path = os.path.join(os.path.dirname(file_path), filename)
+            temp_path = f"{variant_path}.part"
+            image.resize((width, height), Image.LANCZOS).save(
+                temp_path, format="WEBP", quality=quality
+            )
+            os.replace(temp_path, variant_path)
+            variants.append((width, height, filename))
+    return variants
+
+
+class VariantsPipeline:
+    """
+    In-process queue of uploaded medias waiting for their variants.
+
+    Workers are asyncio tasks which render the variants in a process pool,
+    so resizing does not block the event loop, and save them into database.
+    """
+
+    def __init__(
+        self,
+        workers: int = MEDIA_WORKERS,
+        queue_size: int = MEDIA_QUEUE_SIZE,
+        widths: List[int] = MEDIA_VARIANT_WIDTHS,
+        quality: int = MEDIA_VARIANT_QUALITY,
+    ):
+        self.workers = workers
+        self.widths = widths
+        self.quality = quality
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+        logging.info("Media variants pipeline started")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    async def join(self):
+        """
+        Wait until every submitted media is processed.
+        """
+        await self.queue.join()
+
+    def submit(self, media_id: int, file_path: str) -> bool:
+        """
+        Schedule generation of variants for the media. It is skipped when
+        the pipeline is not running or the queue is full: the original file
+        is served anyway.
+
+        :param media_id: int (id of the media)
+        :param file_path: str (path of the original file)
+        :return: bool (True if the media is scheduled)
+        """
+        if not self._tasks:
+            return False
+        try:
+            self.queue.put_nowait((media_id, file_path))
+        except asyncio.QueueFull:
+            logging.warning(f"Media variants queue is full, skip {media_id}")
+            return False
+        return True
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            media_id, file_path = await self.queue.get()
+            try:
+                rendered = await loop.run_in_executor(
+                    self._executor,
+                    render_variants,
+                    file_path,
+                    self.widths,
+                    self.quality,
+                )
+                variants = [
+                    MediaVariant(
+                        media_id=media_id,
+                        width=width,
+                        height=height,
+                        media_path=f"{MEDIA_URL}/{filename}",
+                    )
+                    for width, height, filename in rendered
+                ]
+                if not variants:
+                    continue
+                async with async_session() as session:
+                    added = await MediaVariant.add_many(session, variants)
+                    await session.commit()
+                # The media can be deleted while variants are rendered
+                if not added:
+                    await remove_media_files(
+                        variant.media_path for variant in variants
+                    )
+            except Exception:
+                logging.exception(f"Failed to make variants of {media_id}")
+            finally:
+                self.queue.task_done()
+
+
+pipeline = VariantsPipeline()
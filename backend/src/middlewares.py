@@ -0,0 +1,247 @@
+import hashlib
+import json
+import math
+from typing import Optional
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import database.models
+import database.routing
+import ratelimit
+from cache import TTLCache
+from conf import (
+    SHED_POOL_WAIT,
+    READ_YOUR_WRITES_WINDOW,
+    READ_YOUR_WRITES_COOKIE,
+)
+
+
+class BodySizeLimitMiddleware:
+    """
+    Reject request bodies larger than `max_size` bytes for paths starting
+    with `path_prefix`. The body is counted while it is received, so an
+    upload is stopped as soon as it crosses the limit: 413 is answered, and
+    the application sees the client disconnected.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int, path_prefix: str = "/"):
+        self.app = app
+        self.max_size = max_size
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(
+            self.path_prefix
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                await _send_error(send, 400, "Invalid header Content-Length")
+                return
+            if content_length > self.max_size:
+                await _send_error(send, 413, "Request body is too large")
+                return
+
+        received = 0
+        rejected = False
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    rejected = True
+                    if not response_started:
+                        await _send_error(
+                            send, 413, "Request body is too large"
+                        )
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def tracking_send(message: Message):
+            nonlocal response_started
+            # The response to the disconnect is dropped, 413 is sent
+            if rejected:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except Exception:
+            # Errors of reading the rest of the body
+            if not rejected:
+                raise
+
+
+class RateLimitMiddleware:
+    """
+    Limit requests of every client by `ratelimit.RateLimiter`: 429 when the
+    bucket of the client is empty. Clients are told apart by header
+    'api-key' (its hash, so buckets do not hold api-keys), requests without
+    it by the address. The api-key is not authenticated here: a wrong one
+    gets a bucket of its own and then 400 from the route.
+
+    Shed load: 503 while the recent wait time for a connection of the pool
+    of any of `engines` (the primary and the replicas by default) is longer
+    than `max_pool_wait` seconds, new requests would only wait longer than
+    the ones which already wait.
+
+    Both responses have header 'Retry-After'. Routes which cost nothing
+    (metrics, docs) are neither limited nor shed.
+    """
+
+    # Routes matched by method and path, paths have ids in them
+    ROUTE_CACHE_SIZE = 10000
+    ROUTE_CACHE_TTL = 3600
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        limiter: Optional[ratelimit.RateLimiter] = None,
+        engines: Optional[list] = None,
+        max_pool_wait: float = SHED_POOL_WAIT,
+    ):
+        self.app = app
+        # Module objects are looked up when the middleware stack is built
+        self.limiter = limiter or ratelimit.limiter
+        self.engines = engines or [
+            database.models.engine,
+            *database.routing.replica_engines,
+        ]
+        self.max_pool_wait = max_pool_wait
+        self._route_paths = TTLCache(
+            maxsize=self.ROUTE_CACHE_SIZE, ttl=self.ROUTE_CACHE_TTL
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        cost = self.limiter.cost(scope["method"], self._route_path(scope))
+        if not cost:
+            await self.app(scope, receive, send)
+            return
+
+        if self.max_pool_wait:
+            wait = self._pool_wait_time()
+            if wait > self.max_pool_wait:
+                await _send_error(send, 503, "Server is overloaded", wait)
+                return
+
+        wait = await self.limiter.take(self._client_key(scope), cost)
+        if wait:
+            await _send_error(send, 429, "Too many requests", wait)
+            return
+        await self.app(scope, receive, send)
+
+    def _route_path(self, scope: Scope) -> str:
+        """
+        Path of the route of the request, "" if there is no such route.
+        Routing happens after middlewares, so the route is matched here too.
+        """
+        cache_key = (scope["method"], scope["path"])
+        route_path = self._route_paths.get(cache_key)
+        if route_path is None:
+            route_path = next(
+                (
+                    route.path
+                    for route in scope["app"].router.routes
+                    if route.matches(scope)[0] == Match.FULL
+                ),
+                "",
+            )
+            self._route_paths.set(cache_key, route_path)
+        return route_path
+
+    def _pool_wait_time(self) -> float:
+        """
+        The longest recent wait time for a connection among the pools.
+        """
+        return max(
+            (
+                engine.pool.metrics.recent_wait_time()
+                for engine in self.engines
+                if getattr(engine.pool, "metrics", None)
+            ),
+            default=0.0,
+        )
+
+    @staticmethod
+    def _client_key(scope: Scope) -> str:
+        api_key = dict(scope["headers"]).get(b"api-key")
+        if api_key:
+            return f"api-key:{hashlib.sha256(api_key).hexdigest()}"
+        # Behind the proxy all clients share its address
+        return f"address:{(scope.get('client') or ('',))[0]}"
+
+
+class ReadYourWritesMiddleware:
+    """
+    Set cookie READ_YOUR_WRITES_COOKIE on responses of requests which have
+    written to the database (see `database.routing.RoutingSession`), so
+    the next reads of the client go to the primary whichever worker
+    process serves them.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "GET":
+            await self.app(scope, receive, send)
+            return
+
+        async def marking_send(message: Message):
+            if message["type"] == "http.response.start":
+                # Request state, `request.state.written_until` of routes
+                written_until = scope.get("state", {}).get("written_until")
+                if written_until:
+                    cookie = (
+                        f"{READ_YOUR_WRITES_COOKIE}={written_until:.3f}; "
+                        f"Max-Age={math.ceil(READ_YOUR_WRITES_WINDOW)}; "
+                        "Path=/api; HttpOnly; SameSite=Lax"
+                    )
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"set-cookie", cookie.encode()),
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, marking_send)
+
+
+async def _send_error(
+    send: Send, status: int, message: str, retry_after: float = None
+):
+    body = json.dumps(
+        {
+            "result": False,
+            "error_type": "HttpException",
+            "error_message": message,
+        }
+    ).encode()
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    if retry_after is not None:
+        seconds = max(1, math.ceil(retry_after))
+        headers.append((b"retry-after", str(seconds).encode()))
+    await send(
+        {"type": "http.response.start", "status": status, "headers": headers}
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,33 @@
+import base64
+import binascii
+
+# Primary keys are `integer` columns
+MAX_PK = 2**31 - 1
+
+
+def encode_cursor(pk: int) -> str:
+    """
+    Encode the primary key of the last item of the page into opaque cursor.
+
+    :param pk: int (primary key of the boundary item)
+    :return: str (url-safe cursor)
+    """
+    return base64.urlsafe_b64encode(str(pk).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Decode cursor created by `encode_cursor` back into primary key.
+
+    :param cursor: str (cursor from the query string)
+    :return: int (primary key of the boundary item)
+    :raise ValueError: if cursor is malformed
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        pk = int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not 1 <= pk <= MAX_PK:
+        raise ValueError("Invalid cursor")
+    return pk
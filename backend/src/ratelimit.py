@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from conf import (
+    RATE_LIMIT_RATE,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_COSTS,
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_REDIS_URL,
+    RATE_LIMIT_MEMORY_SIZE,
+)
+
+
+def refill(
+    tokens: float,
+    updated: float,
+    now: float,
+    rate: float,
+    burst: float,
+    cost: float,
+) -> Tuple[float, float]:
+    """
+    Take `cost` tokens from a bucket which had `tokens` at time `updated`
+    and gains `rate` tokens per second up to `burst`.
+
+    :return: tuple (tokens left, seconds to wait until there are enough
+        tokens or 0 if they are taken)
+    """
+    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBackend:
+    """
+    Buckets in this worker process. The least recently used buckets are
+    dropped when there are more than `maxsize` of them (as if they are
+    full).
+    """
+
+    def __init__(self, maxsize: int = RATE_LIMIT_MEMORY_SIZE):
+        self.maxsize = maxsize
+        self._buckets: OrderedDict = OrderedDict()
+
+    async def take(
+        self, key: str, cost: float, rate: float, burst: float
+    ) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens, wait = refill(tokens, updated, now, rate, burst, cost)
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# The same as `refill`, in one round trip and atomic for all workers; time
+# is of the Redis server, and the result is a string, since Redis truncates
+# Lua numbers to integers
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call(
+    "HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now)
+)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """
+    Buckets shared by all worker processes in Redis, they expire when they
+    are full again. Keys are hashed, so api-keys are not stored. Requests
+    are allowed when Redis fails with `errors`.
+
+    :param client: redis.asyncio.Redis or `LocalRedis`
+    """
+
+    def __init__(
+        self, client, prefix: str = "ratelimit:", errors: tuple = (OSError,)
+    ):
+        self.prefix = prefix
+        self.errors = errors
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(
+        self, key: str, cost: float, rate: float, burst: float
+    ) -> float:
+        try:
+            wait = await self._script(
+                keys=[self.prefix + hashlib.sha1(key.encode()).hexdigest()],
+                args=[rate, burst, cost],
+            )
+        except self.errors:
+            logging.exception("Rate limit is not checked")
+            return 0.0
+        return float(wait)
+
+
+class LocalRedis:
+    """
+    In-process fake of the Redis client of `RedisBackend`, for development
+    and tests: the token bucket script is run by `refill`. Buckets do not
+    expire.
+    """
+
+    def __init__(self):
+        self.data: Dict[str, Dict[str, bytes]] = {}
+
+    def register_script(self, script: str):
+        if script != TOKEN_BUCKET_SCRIPT:
+            raise ValueError("Only the token bucket script is supported")
+        return self._token_bucket
+
+    async def _token_bucket(self, keys: list, args: list) -> bytes:
+        rate, burst, cost = (float(arg) for arg in args)
+        now = time.time()
+        bucket = self.data.get(keys[0], {})
+        tokens, wait = refill(
+            float(bucket.get("tokens", burst)),
+            float(bucket.get("updated", now)),
+            now,
+            rate,
+            burst,
+            cost,
+        )
+        self.data[keys[0]] = {
+            "tokens": str(tokens).encode(),
+            "updated": str(now).encode(),
+        }
+        return str(wait).encode()
+
+
+def make_backend(name: str = RATE_LIMIT_BACKEND):
+    """
+    Backend of buckets by its name: "memory", "redis" or "local".
+    """
+    if name == "memory":
+        return MemoryBackend()
+    if name == "local":
+        return RedisBackend(LocalRedis())
+    if name == "redis":
+        # Optional dependency, only for the shared backend
+        import redis.asyncio
+
+        return RedisBackend(
+            redis.asyncio.from_url(RATE_LIMIT_REDIS_URL),
+            errors=(redis.RedisError, OSError),
+        )
+    raise ValueError(f"Unknown rate limit backend {name}")
+
+
+class RateLimiter:
+    """
+    Token bucket per client: `rate` tokens per second up to `burst`, and a
+    request takes the cost of its route (`costs` by "METHOD /path" of the
+    route, 1 by default).
+    """
+
+    def __init__(
+        self,
+        backend,
+        rate: float = RATE_LIMIT_RATE,
+        burst: float = RATE_LIMIT_BURST,
+        costs: Dict[str, int] = RATE_LIMIT_COSTS,
+    ):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs
+
+    def cost(self, method: str, route_path: str) -> int:
+        return self.costs.get(f"{method} {route_path}", 1)
+
+    async def take(self, key: str, cost: int) -> float:
+        """
+        :return: float (seconds to wait before the request is allowed, 0 if
+            it is allowed now)
+        """
+        if not self.rate or not cost:
+            return 0.0
+        # A request which costs more than a bucket holds would never pass
+        cost = min(cost, self.burst)
+        return await self.backend.take(key, cost, self.rate, self.burst)
+
+
+limiter = RateLimiter(make_backend())
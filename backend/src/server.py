@@ -0,0 +1,92 @@
+"""
+Production server: uvicorn with SERVER_WORKERS worker processes serving
+`asgi:app`, configured by SERVER_* variables (see `conf`).
+
+Every worker imports the application itself, so it has its own engines,
+pools (sized to fit DB_MAX_CONNECTIONS together) and event hub (set STREAM_PG_NOTIFY=true to deliver live feed events
+between workers). On SIGTERM workers stop accepting connections, close
+live feed streams and finish running requests for SERVER_GRACEFUL_TIMEOUT
+seconds, then pooled connections are closed. Run from the `src` directory:
+
+    python server.py
+"""
+import logging
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+from conf import (
+    DEBUG,
+    DB_MAX_CONNECTIONS,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS,
+    SERVER_LOOP,
+    SERVER_HTTP,
+    SERVER_KEEPALIVE,
+    SERVER_BACKLOG,
+    SERVER_GRACEFUL_TIMEOUT,
+    SERVER_ACCESS_LOG,
+    STREAM_PG_NOTIFY,
+)
+
+
+class Server(uvicorn.Server):
+    async def shutdown(self, sockets=None):
+        # Streams never end by themselves and would wait for the timeout
+        from tweets_api.events import hub
+
+        hub.drain()
+        await super().shutdown(sockets)
+
+
+def get_config(**overrides) -> uvicorn.Config:
+    """
+    Configuration of uvicorn from `conf`.
+
+    :param overrides: arguments of `uvicorn.Config` to replace the
+        configured ones
+    """
+    options = {
+        "host": SERVER_HOST,
+        "port": SERVER_PORT,
+        "workers": SERVER_WORKERS,
+        "loop": SERVER_LOOP,
+        "http": SERVER_HTTP,
+        "timeout_keep_alive": SERVER_KEEPALIVE,
+        "backlog": SERVER_BACKLOG,
+        "timeout_graceful_shutdown": SERVER_GRACEFUL_TIMEOUT,
+        "access_log": SERVER_ACCESS_LOG,
+        "log_level": "debug" if DEBUG else "info",
+        "server_header": False,
+        **overrides,
+    }
+    return uvicorn.Config("asgi:app", **options)
+
+
+def main():
+    config = get_config()
+    server = Server(config)
+    connections = config.workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW + 1)
+    if connections > DB_MAX_CONNECTIONS:
+        logging.warning(
+            f"{config.workers} workers can open {connections} connections "
+            f"to the database, more than DB_MAX_CONNECTIONS "
+            f"({DB_MAX_CONNECTIONS})"
+        )
+    if config.workers > 1:
+        if not STREAM_PG_NOTIFY:
+            logging.warning(
+                "Live feed events reach only streams of the worker which "
+                "made them, set STREAM_PG_NOTIFY=true"
+            )
+        socket = config.bind_socket()
+        Multiprocess(config, target=server.run, sockets=[socket]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    main()
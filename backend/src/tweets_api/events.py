@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from typing import Optional, Set
+
+import asyncpg
+import orjson
+
+from conf import STREAM_QUEUE_SIZE, STREAM_PG_NOTIFY, STREAM_PG_CHANNEL
+from database.models import engine
+
+
+class Subscription:
+    """
+    Queue of events for one stream: events of tweets of `authors` only.
+    """
+
+    def __init__(self, authors: Set[int], queue_size: int):
+        self.authors = authors
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # Set when an event is dropped because the client reads too slowly,
+        # the client has to reload the feed then
+        self.overflowed = False
+
+    def put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class EventHub:
+    """
+    In-process pub/sub of tweet events for live feed streams.
+
+    Events are dicts with `type` ("tweet" or "like"), `tweet_id` and
+    `author_id` of the tweet. They are published after the transaction
+    which made them is committed.
+
+    With `dsn` the hub is bridged by Postgres LISTEN/NOTIFY: events are
+    sent to the channel and every worker process (this one too) delivers
+    them to its streams when they come back. When the connection is lost,
+    events are delivered locally while it is reconnected.
+    """
+
+    # Seconds before reconnecting of the listener, doubled after every
+    # failed attempt
+    RECONNECT_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30.0
+
+    def __init__(
+        self,
+        queue_size: int = STREAM_QUEUE_SIZE,
+        dsn: Optional[str] = None,
+        channel: str = STREAM_PG_CHANNEL,
+    ):
+        self.queue_size = queue_size
+        self.dsn = dsn
+        self.channel = channel
+        self._subscriptions: Set[Subscription] = set()
+        self._connection: Optional[asyncpg.Connection] = None
+        # One connection runs one query at a time
+        self._lock = asyncio.Lock()
+        self._reconnecting: Optional[asyncio.Task] = None
+        self._stopped = False
+
+    async def start(self):
+        if not self.dsn:
+            return
+        self._stopped = False
+        await self._connect()
+        logging.info(f"Tweet events are bridged by channel {self.channel}")
+
+    async def stop(self):
+        self._stopped = True
+        if self._reconnecting:
+            self._reconnecting.cancel()
+            self._reconnecting = None
+        if self._connection:
+            connection, self._connection = self._connection, None
+            await connection.close()
+
+    async def _connect(self):
+        connection = await asyncpg.connect(self.dsn)
+        await connection.add_listener(self.channel, self._on_notify)
+        connection.add_termination_listener(self._on_termination)
+        self._connection = connection
+
+    def _on_termination(self, connection):
+        if connection is not self._connection or self._stopped:
+            return
+        # Events are delivered locally until the listener is back
+        self._connection = None
+        logging.warning(f"Listener of channel {self.channel} is lost")
+        self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_DELAY
+        while not self._stopped:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+                continue
+            logging.info(f"Listener of channel {self.channel} is restored")
+            self._reconnecting = None
+            return
+
+    @property
+    def listening(self) -> bool:
+        """
+        Whether published events can reach any stream: publishers can skip
+        preparing events when it is false.
+        """
+        return bool(self._subscriptions) or self._connection is not None
+
+    def subscribe(self, authors: Set[int]) -> Subscription:
+        subscription = Subscription(authors, self.queue_size)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    def drain(self):
+        """
+        End all streams (the server is shutting down): `None` is put to
+        their queues, and clients reconnect.
+        """
+        for subscription in self._subscriptions:
+            subscription.put(None)
+
+    async def publish(self, event: dict):
+        if self._connection:
+            try:
+                async with self._lock:
+                    await self._connection.execute(
+                        "SELECT pg_notify($1, $2)",
+                        self.channel,
+                        orjson.dumps(event).decode(),
+                    )
+                return
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                logging.exception("Tweet event is delivered only locally")
+        self._deliver(event)
+
+    def _deliver(self, event: dict):
+        for subscription in self._subscriptions:
+            if event["author_id"] in subscription.authors:
+                subscription.put(event)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._deliver(orjson.loads(payload))
+
+
+hub = EventHub(
+    dsn=(
+        engine.url.set(drivername="postgresql").render_as_string(
+            hide_password=False
+        )
+        if STREAM_PG_NOTIFY
+        else None
+    )
+)
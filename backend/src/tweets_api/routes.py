@@ -1,123 +1,427 @@
-from fastapi import APIRouter, Header, HTTPException, Path
-from fastapi.responses import JSONResponse
-from database.models import Tweet, TweetMedia, User, TweetLike
-from database.schemas import TweetIn
+import asyncio
+import orjson
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+)
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncGenerator, List, Optional, Set
+
+from auth import Principal, get_current_user
+from conf import (
+    BATCH_MAX_SIZE,
+    FEED_PAGE_SIZE,
+    FEED_MAX_PAGE_SIZE,
+    FEED_LIKES_SAMPLE_SIZE,
+    FEED_MAX_LIKES_SAMPLE_SIZE,
+    STREAM_KEEPALIVE,
+)
+from database.models import (
+    Tweet,
+    TweetMedia,
+    User,
+    UserFollow,
+    TweetLike,
+    UserTimeline,
+    get_session,
+)
+from database.schemas import TweetIn, LikesBatchIn
+from etag import make_etag, etag_matches, not_modified
+from instrumentation import phase
+from medias_api.storage import remove_media_files
+from pagination import MAX_PK, encode_cursor, decode_cursor
+from tweets_api.events import hub
 
 router = APIRouter()
 
+FEED_CACHE_CONTROL = "private, no-cache"
+# Statuses of batch items by their result, as of the single requests
+BATCH_STATUSES = {True: 201, False: 200, None: 404}
+
 
 @router.post("")
 async def post_add_new_tweet(
-    _tweet: TweetIn, api_key: str = Header(..., convert_underscores=True)
-) -> JSONResponse:
-    user = await User.get(api_key=api_key)
-    if not user:
-        raise HTTPException(
-            status_code=404, detail="No such user with this api-key"
+    _tweet: TweetIn,
+    user: Principal = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, max_length=64),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Add a tweet with attached medias, in one transaction.
+
+    With header 'Idempotency-Key' a retried request does not add the tweet
+    again: the tweet which was added with the key is returned with status
+    200 instead of 201.
+
+    :param _tweet: TweetIn (content and ids of uploaded medias)
+    :param user: Principal (user authenticated by header 'api-key')
+    :param idempotency_key: str (unique key of the tweet chosen by client)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (id of the tweet)
+    :raise HTTPException: if some medias do not exist, or the key is used
+        for another tweet
+    """
+    tweet = Tweet(
+        content=_tweet.tweet_data,
+        author_id=user.id,
+        idempotency_key=idempotency_key,
+    )
+    if not await tweet.add(session):
+        added = await Tweet.get_by_idempotency_key(
+            session, author_id=user.id, idempotency_key=idempotency_key
         )
-    tweet = Tweet(content=_tweet.tweet_data, author_id=user.id)
-    tweet = await tweet.add()
+        media_ids = list(dict.fromkeys(_tweet.tweet_media_ids or []))
+        if (
+            not added
+            or added.content != _tweet.tweet_data
+            or added.media_ids != media_ids
+        ):
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key is already used for another tweet",
+            )
+        response = {"result": True, "tweet_id": added.id}
+        return ORJSONResponse(content=response)
     if _tweet.tweet_media_ids:
-        medias = await TweetMedia.add_many(
-            tweet_id=tweet.id, media_ids=_tweet.tweet_media_ids
-        )
-        if not medias:
+        if not await TweetMedia.add_many(
+            session, tweet_id=tweet.id, media_ids=_tweet.tweet_media_ids
+        ):
             raise HTTPException(
                 status_code=400, detail="Medias with this id is not exists"
             )
+    await UserTimeline.fan_out(session, tweet)
+    await session.commit()
+    await hub.publish(
+        {"type": "tweet", "tweet_id": tweet.id, "author_id": user.id}
+    )
     response = {"result": True, "tweet_id": tweet.id}
-    return JSONResponse(content=response, status_code=201)
+    return ORJSONResponse(content=response, status_code=201)
 
 
 @router.delete("/{pk}")
 async def delete_tweet(
-    pk: int = Path(...), api_key: str = Header(..., convert_underscores=True)
-) -> JSONResponse:
-    user = await User.get(api_key=api_key)
-    tweet = await Tweet.get(pk=pk)
-    if not user:
-        raise HTTPException(
-            status_code=400, detail="No such user with this api-key"
-        )
-    if not tweet:
+    pk: int = Path(...),
+    user: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    author_id = await Tweet.get_author_id(session, pk=pk)
+    if author_id is None:
         raise HTTPException(
             status_code=404, detail="No such tweet with this id"
         )
-    if not tweet.author.id == user.id:
+    if not author_id == user.id:
         raise HTTPException(
             status_code=403, detail="No such permission for this action"
         )
-    await tweet.delete()
+    deleted_media_paths = await Tweet.delete(session, pk=pk)
+    await session.commit()
+    await remove_media_files(deleted_media_paths)
     response = {"result": True}
-    return JSONResponse(content=response)
+    return ORJSONResponse(content=response)
 
 
 @router.get("")
 async def get_user_feed(
-    api_key: str = Header(..., convert_underscores=True)
-) -> JSONResponse:
-    user = await User.get(api_key=api_key)
-    if not user:
+    request: Request,
+    user: Principal = Depends(get_current_user),
+    ids: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=FEED_MAX_PAGE_SIZE),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    compact: bool = Query(False),
+    likes_sample: int = Query(
+        FEED_LIKES_SAMPLE_SIZE, ge=0, le=FEED_MAX_LIKES_SAMPLE_SIZE
+    ),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Get feed of the current user.
+
+    Without query parameters the whole feed is returned. If `limit` or one
+    of the cursors is passed, the feed is paginated by keyset and the
+    response contains `next_cursor` to continue in the same direction
+    (null when there are no more tweets).
+
+    Every tweet contains `attachment_variants`: its attachments together with
+    resized copies of the images, which are generated in background and can
+    be missing for a while after upload.
+
+    In compact mode tweets contain `like_count`, `liked_by_me` and only the
+    latest `likes_sample` likers instead of all of them.
+
+    The response has ETag made from a version stamp of the feed, which is
+    selected before the feed itself: 304 is returned if it matches header
+    'If-None-Match'.
+
+    With `ids` the given tweets are returned instead of the feed, in the
+    same order, and ids of missing tweets are listed in `not_found`.
+
+    :param request: Request (to check header 'If-None-Match')
+    :param user: Principal (user authenticated by header 'api-key')
+    :param ids: str (comma separated ids of tweets to get instead of feed)
+    :param limit: int (size of the page)
+    :param before: str (cursor, select tweets older than it)
+    :param after: str (cursor, select tweets newer than it)
+    :param compact: bool (return like counters instead of all likers)
+    :param likes_sample: int (max number of likers per tweet in compact mode)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (tweets of the feed)
+    """
+    if ids is not None:
+        if limit or before or after:
+            raise HTTPException(
+                status_code=400, detail="Tweets by ids are not paginated"
+            )
+        return await _get_tweets_by_ids(
+            session, ids, user.id, compact, likes_sample
+        )
+    if before and after:
         raise HTTPException(
-            status_code=400, detail="No such user with this api-key"
+            status_code=400, detail="Only one of before, after can be set"
+        )
+    paginated = bool(limit or before or after)
+    try:
+        before_id = decode_cursor(before) if before else None
+        after_id = decode_cursor(after) if after else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if paginated and not limit:
+        limit = FEED_PAGE_SIZE
+    with phase("query"):
+        stamp = await User.get_feed_stamp(
+            session,
+            user_id=user.id,
+            limit=limit,
+            before=before_id,
+            after=after_id,
+        )
+    etag = make_etag("feed", user.id, *stamp, str(request.query_params))
+    if etag_matches(request, etag):
+        return not_modified(etag, FEED_CACHE_CONTROL)
+    with phase("query"):
+        feed = await User.get_feed(
+            session,
+            user_id=user.id,
+            limit=limit,
+            before=before_id,
+            after=after_id,
+            compact=compact,
+            likes_sample=likes_sample,
         )
-    feed = await user.get_feed()
-    serialized_tweet = [
-        {
-            "id": tweet.id,
-            "content": tweet.content,
-            "author": {"id": tweet.author.id, "name": tweet.author.name},
-            "attachments": [media.media_path for media in tweet.medias],
-            "likes": [
-                {"id": user.id, "name": user.name} for user in tweet.likes
-            ],
-        }
-        for tweet in feed
-    ]
-    response = {"result": True, "tweets": serialized_tweet}
-    return JSONResponse(content=response)
+    response = {"result": True, "tweets": feed}
+    if paginated:
+        next_cursor = None
+        if len(feed) == limit:
+            boundary = feed[0] if after else feed[-1]
+            next_cursor = encode_cursor(boundary["id"])
+        response["next_cursor"] = next_cursor
+    headers = {"ETag": etag, "Cache-Control": FEED_CACHE_CONTROL}
+    # The body is rendered when the response is created
+    with phase("serialize"):
+        return ORJSONResponse(content=response, headers=headers)
 
 
-@router.post("/{pk}/likes")
-async def post_set_like(
-    pk: int = Path(...), api_key: str = Header(..., convert_underscores=True)
-) -> JSONResponse:
-    user = await User.get(api_key=api_key)
-    tweet = await Tweet.get(pk=pk)
-    if not user:
+async def _get_tweets_by_ids(
+    session: AsyncSession,
+    ids: str,
+    user_id: int,
+    compact: bool,
+    likes_sample: int,
+) -> ORJSONResponse:
+    try:
+        tweet_ids = list(dict.fromkeys(int(pk) for pk in ids.split(",")))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid ids")
+    if not all(0 <= pk <= MAX_PK for pk in tweet_ids):
+        raise HTTPException(status_code=400, detail="Invalid ids")
+    if len(tweet_ids) > BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"At most {BATCH_MAX_SIZE} ids can be set"
+        )
+    with phase("query"):
+        tweets = await Tweet.get_many(
+            session,
+            ids=tweet_ids,
+            user_id=user_id,
+            compact=compact,
+            likes_sample=likes_sample,
+        )
+    found = {tweet["id"] for tweet in tweets}
+    response = {
+        "result": True,
+        "tweets": tweets,
+        "not_found": [pk for pk in tweet_ids if pk not in found],
+    }
+    with phase("serialize"):
+        return ORJSONResponse(content=response)
+
+
+@router.post("/likes:batch")
+async def post_set_likes_batch(
+    batch: LikesBatchIn,
+    user: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Set likes to several tweets by a single statement.
+
+    :param batch: LikesBatchIn (ids of the tweets)
+    :param user: Principal (user authenticated by header 'api-key')
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (status of every tweet like of `POST
+        /api/tweets/{pk}/likes`: 201 if like was set, 200 if it is already
+        set, 404 if there is no such tweet)
+    """
+    tweet_ids = list(dict.fromkeys(batch.tweet_ids))
+    results = await TweetLike.like_many(
+        session, tweet_ids=tweet_ids, user_id=user.id
+    )
+    if results is None:
         raise HTTPException(
-            status_code=403, detail="No such user with this api key"
+            status_code=409, detail="Tweets were changed, try again"
         )
-    if not tweet:
+    created = [tweet_id for tweet_id in tweet_ids if results[tweet_id]]
+    await _publish_likes(session, tweet_ids=created, delta=1)
+    response = {
+        "result": True,
+        "results": [
+            {"tweet_id": tweet_id, "status": BATCH_STATUSES[result]}
+            for tweet_id, result in results.items()
+        ],
+    }
+    return ORJSONResponse(content=response)
+
+
+@router.post("/{pk}/likes")
+async def post_set_like(
+    pk: int = Path(...),
+    user: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Set like to the tweet. Repeated requests do not change anything.
+
+    :param pk: int (id of the tweet)
+    :param user: Principal (user authenticated by header 'api-key')
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (201 if like was set, 200 if it is already set)
+    """
+    created = await TweetLike.like(session, tweet_id=pk, user_id=user.id)
+    if created:
+        await _publish_likes(session, tweet_ids=[pk], delta=1)
+    else:
+        await session.commit()
+    if created is None:
         raise HTTPException(
-            status_code=404, detail="No such tweet with this api key"
+            status_code=404, detail="No such tweet with this id"
         )
-    _like = await TweetLike.get(user_id=user.id, tweet_id=tweet.id)
-    if _like:
-        raise HTTPException(status_code=403, detail="Like already set")
-    like = TweetLike(user_id=user.id, tweet_id=tweet.id)
-    await like.add()
     response = {"result": True}
-    return JSONResponse(content=response, status_code=201)
+    return ORJSONResponse(
+        content=response, status_code=201 if created else 200
+    )
 
 
 @router.delete("/{pk}/likes")
 async def delete_like(
-    pk: int = Path(...), api_key: str = Header(..., convert_underscores=True)
-) -> JSONResponse:
-    user = await User.get(api_key=api_key)
-    tweet = await Tweet.get(pk=pk)
-    if not user:
-        raise HTTPException(
-            status_code=403, detail="No such user with this api key"
-        )
-    if not tweet:
+    pk: int = Path(...),
+    user: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Remove like from the tweet. Repeated requests do not change anything.
+
+    :param pk: int (id of the tweet)
+    :param user: Principal (user authenticated by header 'api-key')
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (successful result if like is not set anymore)
+    """
+    deleted = await TweetLike.unlike(session, tweet_id=pk, user_id=user.id)
+    if deleted:
+        await _publish_likes(session, tweet_ids=[pk], delta=-1)
+    else:
+        await session.commit()
+    if deleted is None:
         raise HTTPException(
-            status_code=404, detail="No such tweet with this api key"
+            status_code=404, detail="No such tweet with this id"
         )
-    like = await TweetLike.get(user_id=user.id, tweet_id=tweet.id)
-    if not like:
-        raise HTTPException(status_code=403, detail="Like is not set")
-    await like.delete()
     response = {"result": True}
-    return JSONResponse(content=response)
+    return ORJSONResponse(content=response)
+
+
+async def _publish_likes(
+    session: AsyncSession, tweet_ids: List[int], delta: int
+):
+    """
+    Commit the changed likes and publish their events with new counters.
+    """
+    counters = []
+    if hub.listening:
+        counters = await Tweet.get_like_counters(session, ids=tweet_ids)
+    await session.commit()
+    for counter in counters:
+        await hub.publish(
+            {
+                "type": "like",
+                "tweet_id": counter.id,
+                "author_id": counter.author_id,
+                "delta": delta,
+                "like_count": counter.like_count,
+            }
+        )
+
+
+@router.get("/stream")
+async def get_feed_stream(
+    user: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> StreamingResponse:
+    """
+    Stream updates of the feed of the current user as server-sent events:
+    `tweet` when a new tweet is posted and `like` when like count of a tweet
+    is changed (with `delta` and the new `like_count`), for tweets of the
+    user and of the authors the user follows at the moment of connecting.
+
+    `reset` is sent and the stream is closed when the client does not keep
+    up with the events: the feed has to be reloaded then.
+    The stream is closed without `reset` when the server shuts down.
+
+    :param user: Principal (user authenticated by header 'api-key')
+    :param session: AsyncSession (session of the request)
+    :return: StreamingResponse (text/event-stream)
+    """
+    authors = set(await UserFollow.get_following_ids(session, user.id))
+    authors.add(user.id)
+    # The session would hold a pooled connection while the stream is open
+    await session.close()
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(
+        _stream_events(authors),
+        media_type="text/event-stream",
+        headers=headers,
+    )
+
+
+async def _stream_events(authors: Set[int]) -> AsyncGenerator[str, None]:
+    subscription = hub.subscribe(authors)
+    try:
+        while not subscription.overflowed:
+            try:
+                event = await asyncio.wait_for(
+                    subscription.queue.get(), STREAM_KEEPALIVE
+                )
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                return
+            data = orjson.dumps(event).decode()
+            yield f"event: {event['type']}\ndata: {data}\n\n"
+        yield "event: reset\ndata: {}\n\n"
+    finally:
+        hub.unsubscribe(subscription)
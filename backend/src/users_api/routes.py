@@ -1,99 +1,290 @@
-from fastapi import APIRouter, Header, Path, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Path, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import User, UserFollow
+from typing import Optional
+
+from auth import Principal, get_current_user
+from conf import (
+    FOLLOWS_PAGE_SIZE,
+    FOLLOWS_MAX_PAGE_SIZE,
+    PROFILE_CACHE_MAX_AGE,
+)
+from database.models import User, UserFollow, UserTimeline, get_session
+from database.schemas import (
+    FollowBatchIn,
+    build_profile,
+    build_compact_profile,
+    build_user,
+)
+from etag import make_etag, etag_matches, not_modified
+from instrumentation import phase
+from pagination import encode_cursor, decode_cursor
 
 router = APIRouter()
 
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+PUBLIC_CACHE_CONTROL = f"public, max-age={PROFILE_CACHE_MAX_AGE}"
+# Statuses of batch items by their result, as of the single requests
+BATCH_STATUSES = {True: 201, False: 200, None: 404}
+
 
 @router.get("/me")
 async def get_user_me(
-    api_key: str = Header(..., convert_underscores=True)
-) -> JSONResponse:
+    request: Request,
+    principal: Principal = Depends(get_current_user),
+    compact: bool = Query(False),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
     """
     Get information about the current user.
-    :param api_key: str (header 'api-key' to select the user)
-    :return: JSONResponse (information about user if it exists)
+    Answers 304 if ETag of the profile matches header 'If-None-Match'.
+    :param request: Request (to check header 'If-None-Match')
+    :param principal: Principal (user authenticated by header 'api-key')
+    :param compact: bool (only counters instead of followers and following)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (information about user if it exists)
     """
-    user = await User.get(api_key=api_key)
-    if not user:
-        raise HTTPException(
-            status_code=400, detail="No such user with this api-key"
-        )
-    serialized_user = await user.dump()
-    response = {"result": True, "user": serialized_user}
-    return JSONResponse(content=response)
+    not_found = HTTPException(
+        status_code=400, detail="No such user with this api-key"
+    )
+    return await _get_profile(
+        request,
+        session,
+        principal.id,
+        compact,
+        PRIVATE_CACHE_CONTROL,
+        not_found,
+    )
 
 
 @router.get("/{pk}")
-async def get_user(pk: int = Path(...)) -> JSONResponse:
+async def get_user(
+    request: Request,
+    pk: int = Path(...),
+    compact: bool = Query(False),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
     """
-    Get information about requested user by id
+    Get information about requested user by id.
+    The response is public, it can be cached for PROFILE_CACHE_MAX_AGE
+    seconds and revalidated by ETag.
 
+    :param request: Request (to check header 'If-None-Match')
     :param pk: str (primary key of user)
-    :return: JSONResponse (information about user)
+    :param compact: bool (only counters instead of followers and following)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (information about user)
     """
-    user = await User.get(_id=pk)
+    not_found = HTTPException(
+        status_code=404, detail="No such user with this id"
+    )
+    return await _get_profile(
+        request, session, pk, compact, PUBLIC_CACHE_CONTROL, not_found
+    )
+
+
+async def _get_profile(
+    request, session, user_id, compact, cache_control, not_found
+) -> ORJSONResponse:
+    with phase("query"):
+        version = await User.get_version(session, user_id)
+    if version is None:
+        raise not_found
+    etag = make_etag("profile", user_id, version, compact)
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    with phase("query"):
+        user = await User.get(session, _id=user_id, with_follows=not compact)
     if not user:
+        raise not_found
+    with phase("serialize"):
+        if compact:
+            serialized_user = build_compact_profile(user)
+        else:
+            serialized_user = build_profile(user)
+        response = {"result": True, "user": serialized_user}
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        return ORJSONResponse(content=response, headers=headers)
+
+
+@router.get("/{pk}/followers")
+async def get_user_followers(
+    pk: int = Path(...),
+    limit: int = Query(FOLLOWS_PAGE_SIZE, ge=1, le=FOLLOWS_MAX_PAGE_SIZE),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Get followers of the user by pages, the latest follows first.
+
+    :param pk: int (id of the user)
+    :param limit: int (size of the page)
+    :param before: str (cursor, select earlier follows)
+    :param after: str (cursor, select later follows)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (followers and `next_cursor` of the next page)
+    """
+    return await _get_follows_page(
+        UserFollow.get_followers, session, pk, limit, before, after
+    )
+
+
+@router.get("/{pk}/following")
+async def get_user_following(
+    pk: int = Path(...),
+    limit: int = Query(FOLLOWS_PAGE_SIZE, ge=1, le=FOLLOWS_MAX_PAGE_SIZE),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Get users followed by the user by pages, the latest follows first.
+
+    :param pk: int (id of the user)
+    :param limit: int (size of the page)
+    :param before: str (cursor, select earlier follows)
+    :param after: str (cursor, select later follows)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (followed users and `next_cursor` of the next page)
+    """
+    return await _get_follows_page(
+        UserFollow.get_following, session, pk, limit, before, after
+    )
+
+
+async def _get_follows_page(
+    get_page, session, pk, limit, before, after
+) -> ORJSONResponse:
+    if before and after:
+        raise HTTPException(
+            status_code=400, detail="Only one of before, after can be set"
+        )
+    try:
+        before_id = decode_cursor(before) if before else None
+        after_id = decode_cursor(after) if after else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = await get_page(
+        session, user_id=pk, limit=limit, before=before_id, after=after_id
+    )
+    # Existence of the user is checked only when there is nothing to show
+    if not rows and not await session.get(User, pk):
         raise HTTPException(
             status_code=404, detail="No such user with this id"
         )
-    serialized_user = await user.dump()
-    response = {"result": True, "user": serialized_user}
-    return JSONResponse(content=response)
+    next_cursor = None
+    if len(rows) == limit:
+        boundary = rows[0] if after else rows[-1]
+        next_cursor = encode_cursor(boundary.follow_id)
+    response = {
+        "result": True,
+        "users": [build_user(row) for row in rows],
+        "next_cursor": next_cursor,
+    }
+    return ORJSONResponse(content=response)
+
+
+@router.post("/follow:batch")
+async def user_follow_batch(
+    batch: FollowBatchIn,
+    user_follower: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> ORJSONResponse:
+    """
+    Follow several users by a single statement.
+
+    :param batch: FollowBatchIn (ids of users to follow)
+    :param user_follower: Principal (user authenticated by header api-key)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (status of every follow of `POST
+        /api/users/{pk}/follow`: 201 if follow was created, 200 if it exists,
+        404 if there is no such user)
+    """
+    user_ids = list(dict.fromkeys(batch.user_ids))
+    results = await UserFollow.follow_many(
+        session, user_follower_id=user_follower.id, user_following_ids=user_ids
+    )
+    if results is None:
+        raise HTTPException(
+            status_code=409, detail="Users were changed, try again"
+        )
+    created = [user_id for user_id in user_ids if results[user_id]]
+    if created:
+        await UserTimeline.backfill(
+            session, user_id=user_follower.id, author_ids=created
+        )
+        await session.commit()
+    response = {
+        "result": True,
+        "results": [
+            {"user_id": user_id, "status": BATCH_STATUSES[result]}
+            for user_id, result in results.items()
+        ],
+    }
+    return ORJSONResponse(content=response)
 
 
 @router.post("/{pk}/follow")
 async def user_follow(
-    pk: int = Path(...), api_key: str = Header(..., convert_underscores=True)
+    pk: int = Path(...),
+    user_follower: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Follow other users. Follows user with current api-key to user with pk in path.
+    Repeated requests do not change anything.
 
     :param pk: int (id of user to follow)
-    :param api_key: str (header api-key, identification of user)
-    :return: JSONResponse (successful follow or not)
+    :param user_follower: Principal (user authenticated by header api-key)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (201 if follow was created, 200 if it exists)
     """
-    user_follower = await User.get(api_key=api_key)
-    if not user_follower:
-        raise HTTPException(
-            status_code=400, detail="No such user with this api-key"
-        )
-    follow = UserFollow(
-        user_follower_id=user_follower.id, user_following_id=pk
+    created = await UserFollow.follow(
+        session, user_follower_id=user_follower.id, user_following_id=pk
     )
-    follow = await follow.add()
-    if not follow:
+    if created is None:
         raise HTTPException(
             status_code=404, detail="No such user with this id"
         )
+    if created:
+        await UserTimeline.backfill(
+            session, user_id=user_follower.id, author_ids=[pk]
+        )
+        await session.commit()
     response = {"result": True}
-    return JSONResponse(content=response, status_code=201)
+    return ORJSONResponse(
+        content=response, status_code=201 if created else 200
+    )
 
 
 @router.delete("/{pk}/follow")
 async def user_follow(
-    pk: int = Path(...), api_key: str = Header(..., convert_underscores=True)
+    pk: int = Path(...),
+    user_follower: Principal = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Unfollow other users. Unfollows user with current api-key from user with pk in path.
+    Repeated requests do not change anything.
 
     :param pk: int (id of user to unfollow)
-    :param api_key: str (header api-key, identification of user)
-    :return: JSONResponse (successful unfollow or not)
+    :param user_follower: Principal (user authenticated by header api-key)
+    :param session: AsyncSession (session of the request)
+    :return: ORJSONResponse (successful unfollow or not)
     """
-    user_follower = await User.get(api_key=api_key)
-    if not user_follower:
-        raise HTTPException(
-            status_code=400, detail="No such user with this api-key"
-        )
-    follow = await UserFollow.get(
-        user_follower_id=user_follower.id, user_following_id=pk
+    deleted = await UserFollow.unfollow(
+        session, user_follower_id=user_follower.id, user_following_id=pk
     )
-    deleted = await follow.delete()
-    if not deleted:
+    if deleted is None:
         raise HTTPException(
             status_code=404, detail="No such user with this id"
         )
+    if deleted:
+        await UserTimeline.remove_author(
+            session, user_id=user_follower.id, author_id=pk
+        )
+        await session.commit()
     response = {"result": True}
-    return JSONResponse(content=response)
+    return ORJSONResponse(content=response)
@@ -1,9 +1,13 @@
+import collections
+import difflib
 import pytest
 from httpx import AsyncClient
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio.engine import create_async_engine
 from typing import AsyncGenerator
 import asyncio
 
+import ratelimit
 from app import init_app
 from database.models import Base, async_session, User
 from conf import (
@@ -28,6 +32,15 @@ async def async_client() -> AsyncGenerator[AsyncClient, None]:
         yield test_client
 
 
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    """
+    Requests of tests are not rate limited, tests of the limiter use their
+    own ones.
+    """
+    monkeypatch.setattr(ratelimit.limiter, "rate", 0)
+
+
 @pytest.fixture(autouse=True, scope="session")
 async def init_db():
     async with engine_test.begin() as conn:
@@ -63,3 +76,146 @@ async def user_test() -> AsyncGenerator["User", None]:
 @pytest.fixture
 async def as_session():
     return async_session
+
+
+@pytest.fixture
+def fetched_rows():
+    """
+    Count rows returned by the test database while the fixture is active.
+    """
+    counter = {"statements": 0, "rows": 0}
+
+    def after_cursor_execute(conn, cursor, statement, *args):
+        counter["statements"] += 1
+        # asyncpg cursor adapter buffers the whole result before it is read
+        counter["rows"] += len(getattr(cursor, "_rows", None) or [])
+
+    event.listen(
+        engine_test.sync_engine, "after_cursor_execute", after_cursor_execute
+    )
+    yield counter
+    event.remove(
+        engine_test.sync_engine, "after_cursor_execute", after_cursor_execute
+    )
+
+
+@pytest.fixture
+def executed_statements():
+    """
+    Collect statements with their parameters sent to the test database
+    while the fixture is active.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    event.listen(
+        engine_test.sync_engine, "before_cursor_execute", before_cursor_execute
+    )
+    yield statements
+    event.remove(
+        engine_test.sync_engine, "before_cursor_execute", before_cursor_execute
+    )
+
+
+class QueryGuard:
+    """
+    Upper bound of statements sent to the test database in a block:
+
+        with query_guard(3, "GET /api/tweets") as log:
+            await async_client.get("/api/tweets", headers=headers)
+
+    The test fails when the block sends more statements. The failure shows
+    the log of the block: as a diff from `reference` (the log of another
+    block, e.g. the same request with a smaller page) if it is given, and
+    the statements which are repeated, usual suspects of N+1 queries.
+    """
+
+    def __init__(self, max_queries: int, label: str, reference: list = None):
+        self.max_queries = max_queries
+        self.label = label
+        self.reference = reference
+        self.log = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, *args):
+        # Parameters are left out: the same query with other values matches
+        self.log.append(" ".join(statement.split()))
+
+    def __enter__(self) -> list:
+        event.listen(
+            engine_test.sync_engine,
+            "before_cursor_execute",
+            self._before_cursor_execute,
+        )
+        return self.log
+
+    def __exit__(self, exc_type, exc, traceback):
+        event.remove(
+            engine_test.sync_engine,
+            "before_cursor_execute",
+            self._before_cursor_execute,
+        )
+        if exc_type is None and len(self.log) > self.max_queries:
+            pytest.fail(self.report(), pytrace=False)
+
+    def report(self) -> str:
+        lines = [
+            f"{self.label}: {len(self.log)} statements, "
+            f"at most {self.max_queries} expected"
+        ]
+        if self.reference is not None:
+            lines += difflib.unified_diff(
+                self.reference,
+                self.log,
+                "reference",
+                self.label,
+                lineterm="",
+            )
+        else:
+            lines += [f"{i:3}. {sql}" for i, sql in enumerate(self.log, 1)]
+        repeated = [
+            (count, sql)
+            for sql, count in collections.Counter(self.log).items()
+            if count > 1
+        ]
+        if repeated:
+            lines.append("Repeated statements:")
+            lines += [f"{count:3}x {sql}" for count, sql in sorted(repeated)]
+        return "\n".join(lines)
+
+
+@pytest.fixture
+def query_guard():
+    """
+    Factory of `QueryGuard` blocks.
+    """
+    return QueryGuard
+
+
+@pytest.fixture
+def engine():
+    return engine_test
+
+
+@pytest.fixture(scope="session")
+async def replica_engine():
+    """
+    Engine of the second test database, which stands in for a read replica.
+    """
+    replica_db = f"{TEST_POSTGRES_DB}_replica"
+    async with engine_test.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        replica_exists = await conn.scalar(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": replica_db},
+        )
+        if not replica_exists:
+            await conn.execute(text(f'CREATE DATABASE "{replica_db}"'))
+    engine = create_async_engine(engine_test.url.set(database=replica_db))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield engine
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
@@ -1,6 +1,43 @@
 import pytest
+import asyncio
+import os
+import io
+import time
+import orjson
+from types import SimpleNamespace
+from httpx import AsyncClient
+from sqlalchemy.exc import DBAPIError, TimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+from PIL import Image
+from sqlalchemy import delete, event, select, text
 
-from database.models import UserFollow, Tweet, TweetLike
+import app
+import database.models
+import instrumentation
+import medias_api.storage
+import ratelimit
+import medias_api.routes
+import tweets_api.events
+import tweets_api.routes
+from tweets_api.events import EventHub
+from medias_api.variants import VariantsPipeline
+import database.pool
+import database.routing
+from cache import TTLCache
+from database.pool import engine_options, pool_status
+from auth import principals
+from pagination import MAX_PK, encode_cursor
+from database.models import (
+    async_session,
+    UserFollow,
+    Tweet,
+    TweetLike,
+    TweetMedia,
+    Media,
+    MediaVariant,
+    User,
+    UserTimeline,
+)
 
 
 async def test_get_users_me(async_client, user_test):
@@ -48,9 +85,12 @@ async def test_delete_users_id_follow(async_client, user_test, as_session):
     assert response.status_code == 200
     response_data = response.json()
     assert response_data.get("result")
-    _follow = await UserFollow.get(
-        user_follower_id=user_test.id, user_following_id=user_test.id + 1
-    )
+    async with as_session() as session:
+        _follow = await UserFollow.get(
+            session,
+            user_follower_id=user_test.id,
+            user_following_id=user_test.id + 1,
+        )
     assert not _follow
 
 
@@ -82,7 +122,8 @@ async def test_post_tweets(async_client, user_test, as_session):
     assert response.status_code == 201
     response_data = response.json()
     assert response_data.get("result")
-    tweet = await Tweet.get(pk=response_data.get("tweet_id"))
+    async with as_session() as session:
+        tweet = await Tweet.get(session, pk=response_data.get("tweet_id"))
     assert tweet.id
     assert tweet.author_id == user_test.id
     assert tweet.content == data.get("tweet_data")
@@ -121,10 +162,12 @@ async def test_post_tweets_pk_likes(async_client, as_session, user_test):
     assert response.status_code == 201
     response_data = response.json()
     assert response_data.get("result")
-    like = await TweetLike.get(
-        tweet_id=tweet.id,
-        user_id=user_test.id
-    )
+    async with as_session() as session:
+        like = await TweetLike.get(
+            session,
+            tweet_id=tweet.id,
+            user_id=user_test.id
+        )
     assert like.id
 
 
@@ -150,8 +193,1546 @@ async def test_delete_tweets_id_likes(async_client, as_session, user_test):
     assert response.status_code == 200
     response_data = response.json()
     assert response_data.get("result")
-    _like = await TweetLike.get(
-        tweet_id=tweet.id,
-        user_id=user_test.id
-    )
+    async with as_session() as session:
+        _like = await TweetLike.get(
+            session,
+            tweet_id=tweet.id,
+            user_id=user_test.id
+        )
     assert not _like
+
+
+async def test_get_tweets_paginated(async_client, as_session, user_test):
+    async with as_session() as session:
+        tweets = [
+            Tweet(content=f"Content {i}", author_id=user_test.id)
+            for i in range(5)
+        ]
+        session.add_all(tweets)
+        await session.commit()
+    tweet_ids = sorted((tweet.id for tweet in tweets), reverse=True)
+    headers = [("api-key", user_test.api_key)]
+    response = await async_client.get(
+        "/api/tweets", headers=headers, params={"limit": 2}
+    )
+    assert response.status_code == 200
+    response_data = response.json()
+    assert [t.get("id") for t in response_data.get("tweets")] == tweet_ids[:2]
+    next_cursor = response_data.get("next_cursor")
+    assert next_cursor
+    response = await async_client.get(
+        "/api/tweets",
+        headers=headers,
+        params={"limit": 3, "before": next_cursor},
+    )
+    response_data = response.json()
+    assert [t.get("id") for t in response_data.get("tweets")] == tweet_ids[2:]
+    response = await async_client.get(
+        "/api/tweets",
+        headers=headers,
+        params={"limit": 3, "before": response_data.get("next_cursor")},
+    )
+    response_data = response.json()
+    assert response_data.get("tweets") == []
+    assert response_data.get("next_cursor") is None
+    response = await async_client.get(
+        "/api/tweets", headers=headers, params={"before": "not-a-cursor"}
+    )
+    assert response.status_code == 400
+    response = await async_client.get(
+        "/api/tweets",
+        headers=headers,
+        params={"before": encode_cursor(MAX_PK + 1)},
+    )
+    assert response.status_code == 400
+    assert response.json().get("error_message") == "Invalid cursor"
+
+
+async def test_timeline_fan_out(async_client, as_session, user_test):
+    follower_headers = [("api-key", f"test_{user_test.id + 1}")]
+    await async_client.post(
+        f"/api/users/{user_test.id}/follow", headers=follower_headers
+    )
+    response = await async_client.post(
+        "/api/tweets",
+        headers=[("api-key", user_test.api_key)],
+        json={"tweet_data": "Some content", "tweet_media_ids": []},
+    )
+    tweet_id = response.json().get("tweet_id")
+    async with as_session() as session:
+        entry = await session.get(UserTimeline, (user_test.id + 1, tweet_id))
+    assert entry
+    response = await async_client.get("/api/tweets", headers=follower_headers)
+    tweets = response.json().get("tweets")
+    assert [tweet.get("id") for tweet in tweets] == [tweet_id]
+    await async_client.delete(
+        f"/api/users/{user_test.id}/follow", headers=follower_headers
+    )
+    response = await async_client.get("/api/tweets", headers=follower_headers)
+    assert response.json().get("tweets") == []
+
+
+async def test_timeline_fan_out_on_read(
+    async_client, as_session, user_test, monkeypatch
+):
+    monkeypatch.setattr(database.models, "TIMELINE_FANOUT_LIMIT", 0)
+    follower_headers = [("api-key", f"test_{user_test.id + 1}")]
+    await async_client.post(
+        f"/api/users/{user_test.id}/follow", headers=follower_headers
+    )
+    response = await async_client.post(
+        "/api/tweets",
+        headers=[("api-key", user_test.api_key)],
+        json={"tweet_data": "Some content", "tweet_media_ids": []},
+    )
+    tweet_id = response.json().get("tweet_id")
+    async with as_session() as session:
+        entry = await session.get(UserTimeline, (user_test.id + 1, tweet_id))
+        author = await session.get(User, user_test.id)
+    assert not entry
+    assert author.fanout_on_read
+    response = await async_client.get("/api/tweets", headers=follower_headers)
+    tweets = response.json().get("tweets")
+    assert [tweet.get("id") for tweet in tweets] == [tweet_id]
+
+
+async def test_get_tweets_rows_benchmark(
+    async_client, as_session, user_test, fetched_rows
+):
+    tweets_count, medias_per_tweet, likers_count = 20, 4, 100
+    async with as_session() as session:
+        likers = [
+            User(id=i, name=f"liker_{i}", api_key=f"liker_{i}")
+            for i in range(100, 100 + likers_count)
+        ]
+        tweets = [
+            Tweet(content=f"Content {i}", author_id=user_test.id)
+            for i in range(tweets_count)
+        ]
+        medias = [
+            Media(media_path=f"/medias/{i}.png")
+            for i in range(tweets_count * medias_per_tweet)
+        ]
+        session.add_all(likers + tweets + medias)
+        await session.flush()
+        for i, tweet in enumerate(tweets):
+            for media in medias[i * medias_per_tweet :][:medias_per_tweet]:
+                session.add(TweetMedia(tweet_id=tweet.id, media_id=media.id))
+            for liker in likers:
+                session.add(TweetLike(tweet_id=tweet.id, user_id=liker.id))
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    fetched_rows["rows"] = 0
+    started = time.perf_counter()
+    response = await async_client.get("/api/tweets", headers=headers)
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200
+    feed = response.json().get("tweets")
+    assert len(feed) == tweets_count
+    assert all(len(tweet.get("likes")) == likers_count for tweet in feed)
+    # Without multiplication the feed reads every tweet, media and like
+    # once, plus a few rows of the user lookup
+    expected_rows = tweets_count * (1 + medias_per_tweet + likers_count)
+    assert fetched_rows["rows"] <= expected_rows + 10
+    assert elapsed < 1
+    async with as_session() as session:
+        for instance in likers + medias:
+            await session.delete(instance)
+        await session.commit()
+
+
+async def test_get_tweets_compact(async_client, as_session, user_test):
+    async with as_session() as session:
+        tweet = Tweet(content="Some content", author_id=user_test.id)
+        session.add(tweet)
+        await session.flush()
+        session.add_all(
+            [
+                TweetLike(tweet_id=tweet.id, user_id=user_id)
+                for user_id in range(1, 4)
+            ]
+        )
+        await session.commit()
+        await session.refresh(tweet)
+    assert tweet.like_count == 3
+    headers = [("api-key", user_test.api_key)]
+    response = await async_client.get(
+        "/api/tweets",
+        headers=headers,
+        params={"compact": True, "likes_sample": 2},
+    )
+    assert response.status_code == 200
+    response_tweet = response.json().get("tweets").pop()
+    assert response_tweet.get("like_count") == 3
+    assert response_tweet.get("liked_by_me")
+    assert [like.get("id") for like in response_tweet.get("likes")] == [3, 2]
+    await async_client.delete(f"/api/tweets/{tweet.id}/likes", headers=headers)
+    response = await async_client.get(
+        "/api/tweets", headers=headers, params={"compact": True}
+    )
+    response_tweet = response.json().get("tweets").pop()
+    assert response_tweet.get("like_count") == 2
+    assert not response_tweet.get("liked_by_me")
+
+
+async def test_auth_cache(async_client, as_session, user_test, fetched_rows):
+    headers = [("api-key", user_test.api_key)]
+    response = await async_client.get("/api/tweets", headers=headers)
+    assert response.status_code == 200
+    assert principals.get(user_test.api_key) == (user_test.id, user_test.name)
+    fetched_rows["statements"] = 0
+    await async_client.get("/api/tweets", headers=headers)
+    cached_statements = fetched_rows["statements"]
+    principals.clear()
+    fetched_rows["statements"] = 0
+    await async_client.get("/api/tweets", headers=headers)
+    assert fetched_rows["statements"] == cached_statements + 1
+    async with as_session() as session:
+        user = await session.get(User, user_test.id)
+        user.api_key = "changed"
+        await session.commit()
+    assert principals.get(user_test.api_key) is None
+    response = await async_client.get("/api/tweets", headers=headers)
+    assert response.status_code == 400
+
+
+async def test_feed_and_likes_use_indexes(
+    async_client, as_session, user_test, executed_statements, engine
+):
+    first, last = 1000, 20999
+    seed_queries = (
+        "INSERT INTO users (id, name, api_key) "
+        f"SELECT i, 'user_' || i, 'key_' || i "
+        f"FROM generate_series({first}, {last}) AS i",
+        "INSERT INTO tweets (content, author_id) "
+        f"SELECT 'Content', {first} + i % {last - first + 1} "
+        "FROM generate_series(1, 50000) AS i",
+        "INSERT INTO users_follow (user_follower_id, user_following_id) "
+        f"SELECT u, {first} + (u * 7 + j) % {last - first + 1} "
+        f"FROM generate_series({first}, {last}) AS u, "
+        "generate_series(1, 2) AS j",
+        "INSERT INTO tweet_likes (tweet_id, user_id) "
+        "SELECT id, author_id FROM tweets "
+        f"WHERE author_id >= {first} AND id % 5 = 0",
+    )
+    async with as_session() as session:
+        for query in seed_queries:
+            await session.execute(text(query))
+        session.add(
+            UserFollow(user_follower_id=user_test.id, user_following_id=first)
+        )
+        tweet = Tweet(content="Some content", author_id=user_test.id)
+        session.add(tweet)
+        await session.commit()
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql("ANALYZE")
+    executed_statements.clear()
+
+    headers = [("api-key", user_test.api_key)]
+    await async_client.get("/api/tweets", headers=headers)
+    await async_client.get(
+        "/api/tweets", headers=headers, params={"limit": 10, "compact": True}
+    )
+    await async_client.post(f"/api/tweets/{tweet.id}/likes", headers=headers)
+    await async_client.delete(f"/api/tweets/{tweet.id}/likes", headers=headers)
+    await async_client.get(f"/api/users/{first}/followers")
+    await async_client.get(f"/api/users/{first}/following")
+    statements = list(executed_statements)
+    assert statements
+    async with engine.connect() as conn:
+        for statement, parameters in statements:
+            if statement.startswith(("SAVEPOINT", "RELEASE", "ROLLBACK")):
+                continue
+            plan = await conn.exec_driver_sql(
+                f"EXPLAIN {statement}", parameters
+            )
+            plan = "\n".join(row[0] for row in plan)
+            for table in ("tweets", "users_follow", "tweet_likes", "users"):
+                assert f"Seq Scan on {table} " not in plan, plan
+
+    async with as_session() as session:
+        await session.execute(text(f"DELETE FROM users WHERE id >= {first}"))
+        await session.commit()
+
+
+async def test_likes_are_idempotent(async_client, as_session, user_test):
+    async with as_session() as session:
+        tweet = Tweet(content="Some content", author_id=user_test.id)
+        session.add(tweet)
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    responses = await asyncio.gather(
+        *[
+            async_client.post(f"/api/tweets/{tweet.id}/likes", headers=headers)
+            for _ in range(5)
+        ]
+    )
+    assert sorted(r.status_code for r in responses) == [200] * 4 + [201]
+    async with as_session() as session:
+        likes = await session.scalars(
+            select(TweetLike).filter(TweetLike.tweet_id == tweet.id)
+        )
+        assert len(likes.all()) == 1
+        tweet = await session.get(Tweet, tweet.id)
+        assert tweet.like_count == 1
+    for _ in range(2):
+        response = await async_client.delete(
+            f"/api/tweets/{tweet.id}/likes", headers=headers
+        )
+        assert response.status_code == 200
+    response = await async_client.post(
+        f"/api/tweets/{tweet.id + 1}/likes", headers=headers
+    )
+    assert response.status_code == 404
+    response = await async_client.delete(
+        f"/api/tweets/{tweet.id + 1}/likes", headers=headers
+    )
+    assert response.status_code == 404
+
+
+async def test_follows_are_idempotent(async_client, user_test):
+    headers = [("api-key", user_test.api_key)]
+    url = f"/api/users/{user_test.id + 1}/follow"
+    response = await async_client.post(url, headers=headers)
+    assert response.status_code == 201
+    response = await async_client.post(url, headers=headers)
+    assert response.status_code == 200
+    for _ in range(2):
+        response = await async_client.delete(url, headers=headers)
+        assert response.status_code == 200
+    async with async_session() as session:
+        assert not await UserFollow.get(
+            session,
+            user_follower_id=user_test.id,
+            user_following_id=user_test.id + 1,
+        )
+    response = await async_client.post(
+        "/api/users/100/follow", headers=headers
+    )
+    assert response.status_code == 404
+    response = await async_client.delete(
+        "/api/users/100/follow", headers=headers
+    )
+    assert response.status_code == 404
+
+
+async def test_post_medias(async_client, user_test, tmp_path, monkeypatch):
+    monkeypatch.setattr(medias_api.storage, "MEDIA_ROOT", str(tmp_path))
+    monkeypatch.setattr(medias_api.storage, "MEDIA_CHUNK_SIZE", 1024)
+    headers = [("api-key", user_test.api_key)]
+    content = os.urandom(10 * 1024 + 1)
+    media_ids = []
+    for _ in range(2):
+        response = await async_client.post(
+            "/api/medias",
+            headers=headers,
+            files={"file": ("image.png", content, "image/png")},
+        )
+        assert response.status_code == 201
+        media_ids.append(response.json().get("media_id"))
+    assert media_ids[0] == media_ids[1]
+    async with async_session() as session:
+        media = await session.get(Media, media_ids[0])
+        await session.delete(media)
+        await session.commit()
+    filename = os.path.basename(media.media_path)
+    assert filename.startswith(media.sha256)
+    assert (tmp_path / filename).read_bytes() == content
+    assert os.listdir(tmp_path) == [filename]
+
+    monkeypatch.setattr(medias_api.storage, "MEDIA_MAX_SIZE", 10 * 1024)
+    response = await async_client.post(
+        "/api/medias",
+        headers=headers,
+        files={"file": ("image.png", content, "image/png")},
+    )
+    assert response.status_code == 413
+    assert os.listdir(tmp_path) == [filename]
+
+
+async def test_delete_tweet_collects_medias(
+    async_client, user_test, tmp_path, monkeypatch, executed_statements
+):
+    monkeypatch.setattr(medias_api.storage, "MEDIA_ROOT", str(tmp_path))
+    # Medias are collected right after they are detached
+    monkeypatch.setattr(database.models, "MEDIA_CLAIM_GRACE", 0)
+    headers = [("api-key", user_test.api_key)]
+    media_ids = []
+    for content in (b"shared", b"own"):
+        response = await async_client.post(
+            "/api/medias",
+            headers=headers,
+            files={"file": ("image.png", content, "image/png")},
+        )
+        media_ids.append(response.json().get("media_id"))
+    shared_id, own_id = media_ids
+    tweet_ids = []
+    for tweet_media_ids in ([shared_id, own_id], [shared_id]):
+        response = await async_client.post(
+            "/api/tweets",
+            headers=headers,
+            json={"tweet_data": "Media", "tweet_media_ids": tweet_media_ids},
+        )
+        tweet_ids.append(response.json().get("tweet_id"))
+    async with async_session() as session:
+        shared = await session.get(Media, shared_id)
+        own = await session.get(Media, own_id)
+    assert shared.ref_count == 2
+    assert own.ref_count == 1
+    liker_headers = [("api-key", f"test_{user_test.id + 1}")]
+    await async_client.post(
+        f"/api/tweets/{tweet_ids[0]}/likes", headers=liker_headers
+    )
+
+    executed_statements.clear()
+    response = await async_client.delete(
+        f"/api/tweets/{tweet_ids[0]}", headers=headers
+    )
+    assert response.status_code == 200
+    # Likers are not loaded, likes are deleted by the cascade
+    assert not [
+        statement
+        for statement, _ in executed_statements
+        if "tweet_likes" in statement
+    ]
+    async with async_session() as session:
+        assert await session.get(Media, own_id) is None
+        shared = await session.get(Media, shared_id)
+    assert shared.ref_count == 1
+    assert os.listdir(tmp_path) == [os.path.basename(shared.media_path)]
+
+    response = await async_client.delete(
+        f"/api/tweets/{tweet_ids[1]}", headers=headers
+    )
+    assert response.status_code == 200
+    async with async_session() as session:
+        assert await session.get(Media, shared_id) is None
+    assert os.listdir(tmp_path) == []
+
+
+async def test_deduplicated_media_is_not_collected(
+    async_client, user_test, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(medias_api.storage, "MEDIA_ROOT", str(tmp_path))
+    headers = [("api-key", user_test.api_key)]
+    other_headers = [("api-key", "test_1")]
+    files = {"file": ("image.png", b"claimed twice", "image/png")}
+    response = await async_client.post(
+        "/api/medias", headers=headers, files=files
+    )
+    media_id = response.json().get("media_id")
+    response = await async_client.post(
+        "/api/tweets",
+        headers=headers,
+        json={"tweet_data": "First", "tweet_media_ids": [media_id]},
+    )
+    tweet_id = response.json().get("tweet_id")
+    # The same content from another user, before the first tweet is deleted
+    response = await async_client.post(
+        "/api/medias", headers=other_headers, files=files
+    )
+    assert response.json().get("media_id") == media_id
+    await async_client.delete(f"/api/tweets/{tweet_id}", headers=headers)
+
+    response = await async_client.post(
+        "/api/tweets",
+        headers=other_headers,
+        json={"tweet_data": "Second", "tweet_media_ids": [media_id]},
+    )
+    assert response.status_code == 201
+    assert len(os.listdir(tmp_path)) == 1
+    await async_client.delete(
+        f"/api/tweets/{response.json().get('tweet_id')}",
+        headers=other_headers,
+    )
+
+
+async def test_media_variants(async_client, user_test, tmp_path, monkeypatch):
+    monkeypatch.setattr(medias_api.storage, "MEDIA_ROOT", str(tmp_path))
+    # Medias are collected right after they are detached
+    monkeypatch.setattr(database.models, "MEDIA_CLAIM_GRACE", 0)
+    pipeline = VariantsPipeline(workers=1, widths=[16, 64, 200])
+    monkeypatch.setattr(medias_api.routes, "pipeline", pipeline)
+    await pipeline.start()
+    headers = [("api-key", user_test.api_key)]
+    image = io.BytesIO()
+    Image.new("RGB", (100, 50), "red").save(image, format="PNG")
+    media_ids = []
+    for content in (image.getvalue(), b"not an image"):
+        response = await async_client.post(
+            "/api/medias",
+            headers=headers,
+            files={"file": ("image.png", content, "image/png")},
+        )
+        assert response.status_code == 201
+        media_ids.append(response.json().get("media_id"))
+    await pipeline.join()
+    await pipeline.stop()
+
+    response = await async_client.post(
+        "/api/tweets",
+        headers=headers,
+        json={"tweet_data": "Variants", "tweet_media_ids": media_ids},
+    )
+    tweet_id = response.json().get("tweet_id")
+    response = await async_client.get("/api/tweets", headers=headers)
+    tweet = response.json().get("tweets")[0]
+    assert tweet["id"] == tweet_id
+    image_media, other_media = tweet["attachment_variants"]
+    assert [media["url"] for media in tweet["attachment_variants"]] == tweet[
+        "attachments"
+    ]
+    assert [
+        (variant["width"], variant["height"])
+        for variant in image_media["variants"]
+    ] == [(16, 8), (64, 32)]
+    assert other_media["variants"] == []
+    for variant in image_media["variants"]:
+        with Image.open(tmp_path / os.path.basename(variant["url"])) as file:
+            assert file.format == "WEBP"
+            assert file.width == variant["width"]
+
+    await async_client.delete(f"/api/tweets/{tweet_id}", headers=headers)
+    assert os.listdir(tmp_path) == []
+
+
+async def test_media_variants_feed_etag(
+    async_client, user_test, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(medias_api.storage, "MEDIA_ROOT", str(tmp_path))
+    # Medias are collected right after they are detached
+    monkeypatch.setattr(database.models, "MEDIA_CLAIM_GRACE", 0)
+    pipeline = VariantsPipeline(workers=1, widths=[16])
+    monkeypatch.setattr(medias_api.routes, "pipeline", pipeline)
+    headers = {"api-key": user_test.api_key}
+    image = io.BytesIO()
+    Image.new("RGB", (100, 50), "red").save(image, format="PNG")
+    response = await async_client.post(
+        "/api/medias",
+        headers=headers,
+        files={"file": ("image.png", image.getvalue(), "image/png")},
+    )
+    media_id = response.json().get("media_id")
+    response = await async_client.post(
+        "/api/tweets",
+        headers=headers,
+        json={"tweet_data": "Variants later", "tweet_media_ids": [media_id]},
+    )
+    tweet_id = response.json().get("tweet_id")
+    response = await async_client.get("/api/tweets", headers=headers)
+    etag = response.headers["etag"]
+    assert (
+        response.json()["tweets"][0]["attachment_variants"][0]["variants"]
+        == []
+    )
+
+    # Variants are rendered after the feed is cached by the client
+    (file_name,) = os.listdir(tmp_path)
+    await pipeline.start()
+    assert pipeline.submit(media_id, str(tmp_path / file_name))
+    await pipeline.join()
+    await pipeline.stop()
+    response = await async_client.get(
+        "/api/tweets", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    variants = response.json()["tweets"][0]["attachment_variants"][0][
+        "variants"
+    ]
+    assert [variant["width"] for variant in variants] == [16]
+
+    await async_client.delete(f"/api/tweets/{tweet_id}", headers=headers)
+
+
+async def test_post_medias_body_limit(user_test, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "MEDIA_MAX_SIZE", 1024)
+    monkeypatch.setattr(medias_api.storage, "MEDIA_ROOT", str(tmp_path))
+    application = app.init_app()
+    async with AsyncClient(app=application, base_url="http://test") as client:
+        response = await client.post(
+            "/api/medias",
+            headers=[("api-key", user_test.api_key)],
+            files={"file": ("image.png", os.urandom(256 * 1024), "image/png")},
+        )
+        assert response.status_code == 413
+        assert not response.json().get("result")
+
+        # Chunked, without Content-Length: the limit is counted
+        async def chunks():
+            yield (
+                b"--boundary\r\n"
+                b'Content-Disposition: form-data; name="file"; '
+                b'filename="image.png"\r\n'
+                b"Content-Type: image/png\r\n\r\n"
+            )
+            for _ in range(256):
+                yield os.urandom(1024)
+            yield b"\r\n--boundary--\r\n"
+
+        response = await client.post(
+            "/api/medias",
+            headers=[
+                ("api-key", user_test.api_key),
+                ("content-type", "multipart/form-data; boundary=boundary"),
+            ],
+            content=chunks(),
+        )
+        assert "content-length" not in response.request.headers
+        assert response.status_code == 413
+        assert os.listdir(tmp_path) == []
+        assert response.json() == {
+            "result": False,
+            "error_type": "HttpException",
+            "error_message": "Request body is too large",
+        }
+
+        response = await client.post(
+            "/api/medias",
+            headers=[
+                ("api-key", user_test.api_key),
+                ("content-length", "many"),
+            ],
+        )
+        assert response.status_code == 400
+        assert not response.json().get("result")
+
+
+async def test_request_uses_one_connection(
+    async_client, as_session, user_test, engine
+):
+    async with as_session() as session:
+        tweet = Tweet(content="Some content", author_id=user_test.id + 1)
+        session.add(tweet)
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    principals.clear()
+    checkouts = []
+
+    def on_checkout(*args):
+        checkouts.append(args)
+
+    event.listen(engine.sync_engine.pool, "checkout", on_checkout)
+    try:
+        response = await async_client.post(
+            f"/api/tweets/{tweet.id}/likes", headers=headers
+        )
+    finally:
+        event.remove(engine.sync_engine.pool, "checkout", on_checkout)
+    assert response.status_code == 201
+    assert len(checkouts) == 1
+
+
+async def test_post_tweets_is_atomic(async_client, as_session, user_test):
+    headers = [("api-key", user_test.api_key)]
+    data = {"tweet_data": "Atomic content", "tweet_media_ids": [100]}
+    response = await async_client.post(
+        "/api/tweets", headers=headers, json=data
+    )
+    assert response.status_code == 400
+    async with as_session() as session:
+        tweet = await session.scalar(
+            select(Tweet).filter(Tweet.content == "Atomic content")
+        )
+    assert tweet is None
+
+
+async def test_post_tweets_idempotency_key(
+    async_client, as_session, user_test
+):
+    async with as_session() as session:
+        medias = [Media(media_path=f"/medias/retry_{i}.png") for i in range(2)]
+        session.add_all(medias)
+        await session.commit()
+    media_ids = [medias[1].id, medias[0].id, medias[1].id]
+    headers = [("api-key", user_test.api_key), ("idempotency-key", "retry-1")]
+    data = {"tweet_data": "Retried content", "tweet_media_ids": media_ids}
+    responses = await asyncio.gather(
+        *(
+            async_client.post("/api/tweets", headers=headers, json=data)
+            for _ in range(2)
+        )
+    )
+    assert sorted(response.status_code for response in responses) == [
+        200,
+        201,
+    ]
+    tweet_id = responses[0].json()["tweet_id"]
+    assert responses[1].json()["tweet_id"] == tweet_id
+    response = await async_client.post(
+        "/api/tweets", headers=headers, json=data
+    )
+    assert response.status_code == 200
+    assert response.json()["tweet_id"] == tweet_id
+    async with as_session() as session:
+        tweets = await session.scalars(
+            select(Tweet.id).filter(Tweet.content == "Retried content")
+        )
+        assert tweets.all() == [tweet_id]
+        (tweet,) = await Tweet.get_many(session, [tweet_id], user_test.id)
+    # Medias are attached once, in the order of the request
+    assert tweet["attachments"] == [
+        "/medias/retry_1.png",
+        "/medias/retry_0.png",
+    ]
+
+    response = await async_client.post(
+        "/api/tweets",
+        headers=headers,
+        json={**data, "tweet_media_ids": [medias[0].id]},
+    )
+    assert response.status_code == 422
+    data["tweet_data"] = "Another content"
+    response = await async_client.post(
+        "/api/tweets", headers=headers, json=data
+    )
+    assert response.status_code == 422
+    # Keys are unique per author
+    response = await async_client.post(
+        "/api/tweets",
+        headers=[("api-key", "test_1"), ("idempotency-key", "retry-1")],
+        json=data,
+    )
+    assert response.status_code == 201
+
+
+async def test_attach_deleted_media(as_session, engine, user_test):
+    async with as_session() as session:
+        tweet = Tweet(content="Deleted media", author_id=user_test.id)
+        media = Media(media_path="/medias/deleted.png")
+        session.add_all([tweet, media])
+        await session.commit()
+    async with engine.connect() as conn:
+        await conn.execute(delete(Media).filter(Media.id == media.id))
+        async with as_session() as session:
+            # Waits for the deleting transaction
+            attach = asyncio.create_task(
+                TweetMedia.add_many(session, tweet.id, [media.id])
+            )
+            await asyncio.sleep(0.2)
+            await conn.commit()
+            assert not await attach
+            await session.rollback()
+    async with as_session() as session:
+        await session.execute(delete(Tweet).filter(Tweet.id == tweet.id))
+        await session.commit()
+
+
+async def test_pool_metrics(engine):
+    pool_engine = create_async_engine(
+        engine.url,
+        **engine_options(pool_size=1, max_overflow=1, pool_timeout=0.1),
+    )
+    async with pool_engine.connect() as first:
+        async with pool_engine.connect() as second:
+            await first.execute(text("SELECT 1"))
+            await second.execute(text("SELECT 1"))
+            status = pool_status(pool_engine)
+            assert status["checked_out"] == 2
+            assert status["overflow"] == 1
+            with pytest.raises(TimeoutError):
+                async with pool_engine.connect() as third:
+                    await third.execute(text("SELECT 1"))
+    status = pool_status(pool_engine)
+    await pool_engine.dispose()
+    assert status["checked_out"] == 0
+    assert status["checkouts"] == 3
+    assert status["overflows"] == 1
+    assert status["timeouts"] == 1
+    assert status["max_wait_time"] >= 0.1
+
+
+async def test_pgbouncer_mode(engine, monkeypatch):
+    monkeypatch.setattr(database.pool, "DB_PGBOUNCER", True)
+    options = engine_options()
+    assert options["connect_args"]["statement_cache_size"] == 0
+    pgbouncer_engine = create_async_engine(engine.url, **options)
+    async with pgbouncer_engine.connect() as conn:
+        for _ in range(2):
+            application_name = await conn.scalar(
+                text("SELECT current_setting('application_name')")
+            )
+            assert application_name == "twitter-clone"
+    await pgbouncer_engine.dispose()
+
+
+async def test_get_pool_status(async_client):
+    response = await async_client.get("/api/pool")
+    assert response.status_code == 200
+    assert {"checked_out", "overflow", "checkouts", "wait_time"} <= set(
+        response.json().get("pool")
+    )
+
+
+async def test_read_replica_routing(
+    async_client, user_test, replica_engine, monkeypatch
+):
+    monkeypatch.setattr(database.routing, "replica_engines", [replica_engine])
+    monkeypatch.setattr(
+        database.routing, "recent_writers", TTLCache(maxsize=10, ttl=60)
+    )
+    # The replica has the users, but their names differ from the primary
+    async with replica_engine.begin() as conn:
+        await conn.execute(
+            User.__table__.insert(),
+            [
+                {"id": i, "name": f"replica_{i}", "api_key": f"test_{i}"}
+                for i in range(1, 4)
+            ],
+        )
+    try:
+        headers = [("api-key", user_test.api_key)]
+        response = await async_client.get("/api/users/me", headers=headers)
+        assert response.json()["user"]["name"] == f"replica_{user_test.id}"
+
+        response = await async_client.post(
+            f"/api/users/{user_test.id + 1}/follow", headers=headers
+        )
+        assert response.status_code == 201
+        response = await async_client.get("/api/users/me", headers=headers)
+        user = response.json()["user"]
+        assert user["name"] == user_test.name
+        assert [f["id"] for f in user["following"]] == [user_test.id + 1]
+
+        # Another client, without the cookie of the writer
+        async_client.cookies.clear()
+        response = await async_client.get(
+            "/api/users/me", headers=[("api-key", "test_1")]
+        )
+        assert response.json()["user"]["name"] == "replica_1"
+
+        # Another worker process knows the writer by the cookie only
+        database.routing.recent_writers.clear()
+        response = await async_client.delete(
+            f"/api/users/{user_test.id + 1}/follow", headers=headers
+        )
+        assert response.status_code == 200
+        assert async_client.cookies.get("read_primary_until")
+        database.routing.recent_writers.clear()
+        response = await async_client.get("/api/users/me", headers=headers)
+        user = response.json()["user"]
+        assert user["name"] == user_test.name
+        assert user["following"] == []
+        async_client.cookies.clear()
+        response = await async_client.get("/api/users/me", headers=headers)
+        assert response.json()["user"]["name"] == f"replica_{user_test.id}"
+    finally:
+        async with replica_engine.begin() as conn:
+            await conn.execute(User.__table__.delete())
+
+
+async def test_follow_counters_and_lists(async_client, user_test):
+    headers = [("api-key", user_test.api_key)]
+    for pk in (user_test.id - 1, user_test.id + 1):
+        await async_client.post(f"/api/users/{pk}/follow", headers=headers)
+    response = await async_client.get(
+        "/api/users/me", headers=headers, params={"compact": True}
+    )
+    user = response.json().get("user")
+    assert user == {
+        "id": user_test.id,
+        "name": user_test.name,
+        "followers_count": 0,
+        "following_count": 2,
+    }
+    response = await async_client.get(f"/api/users/{user_test.id + 1}")
+    user = response.json().get("user")
+    assert user["followers_count"] == 1
+    assert user["followers"] == [{"id": user_test.id, "name": user_test.name}]
+
+    response = await async_client.get(
+        f"/api/users/{user_test.id}/following", params={"limit": 1}
+    )
+    response_data = response.json()
+    assert [u["id"] for u in response_data["users"]] == [user_test.id + 1]
+    response = await async_client.get(
+        f"/api/users/{user_test.id}/following",
+        params={"limit": 1, "before": response_data["next_cursor"]},
+    )
+    response_data = response.json()
+    assert [u["id"] for u in response_data["users"]] == [user_test.id - 1]
+    response = await async_client.get(
+        f"/api/users/{user_test.id}/following",
+        params={"limit": 1, "before": response_data["next_cursor"]},
+    )
+    assert response.json() == {
+        "result": True,
+        "users": [],
+        "next_cursor": None,
+    }
+
+    response = await async_client.get(f"/api/users/{user_test.id}/followers")
+    assert response.json().get("users") == []
+    response = await async_client.get("/api/users/100/followers")
+    assert response.status_code == 404
+
+    await async_client.delete(
+        f"/api/users/{user_test.id + 1}/follow", headers=headers
+    )
+    response = await async_client.get(
+        f"/api/users/{user_test.id + 1}", params={"compact": True}
+    )
+    assert response.json()["user"]["followers_count"] == 0
+
+
+async def test_mutual_follows_do_not_deadlock(as_session, user_test):
+    other_id = user_test.id + 1
+
+    async def toggle(follower_id: int, following_id: int):
+        for _ in range(50):
+            async with as_session() as session:
+                await UserFollow.follow(session, follower_id, following_id)
+                await session.commit()
+            async with as_session() as session:
+                await UserFollow.unfollow(session, follower_id, following_id)
+                await session.commit()
+
+    await asyncio.gather(
+        toggle(user_test.id, other_id), toggle(other_id, user_test.id)
+    )
+    async with as_session() as session:
+        counts = await session.execute(
+            select(User.followers_count, User.following_count).filter(
+                User.id.in_([user_test.id, other_id])
+            )
+        )
+        assert counts.all() == [(0, 0), (0, 0)]
+
+
+async def test_profile_etag(async_client, user_test):
+    url = f"/api/users/{user_test.id}"
+    response = await async_client.get(url)
+    assert response.headers["cache-control"].startswith("public, max-age=")
+    etag = response.headers["etag"]
+    assert etag.startswith('W/"')
+    response = await async_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    response = await async_client.get(
+        url, params={"compact": True}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+    await async_client.post(
+        f"/api/users/{user_test.id + 1}/follow",
+        headers=[("api-key", user_test.api_key)],
+    )
+    response = await async_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()["user"]["following"]) == 1
+
+
+async def test_feed_etag(async_client, as_session, user_test):
+    async with as_session() as session:
+        tweet = Tweet(content="Some content", author_id=user_test.id)
+        session.add(tweet)
+        await session.commit()
+    headers = {"api-key": user_test.api_key}
+    response = await async_client.get("/api/tweets", headers=headers)
+    assert response.headers["cache-control"] == "private, no-cache"
+    etag = response.headers["etag"]
+    response = await async_client.get(
+        "/api/tweets", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    liker_headers = {"api-key": "test_1"}
+    await async_client.post(
+        f"/api/tweets/{tweet.id}/likes", headers=liker_headers
+    )
+    response = await async_client.get(
+        "/api/tweets", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    await async_client.delete(
+        f"/api/tweets/{tweet.id}/likes", headers=liker_headers
+    )
+    response = await async_client.get(
+        "/api/tweets", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["tweets"][0]["likes"] == []
+
+
+async def test_feed_rows_match_orm_tweets(
+    as_session, user_test, executed_statements
+):
+    from benchmarks.serialization import (
+        build_dicts,
+        make_feed,
+        serialize_dicts,
+        serialize_rows,
+    )
+
+    feed = make_feed(tweets=3, likes=2, medias=2)
+    assert orjson.loads(serialize_rows(build_dicts(feed))) == orjson.loads(
+        serialize_dicts(feed)
+    )
+    async with as_session() as session:
+        tweets = [
+            Tweet(content=f"Tweet {i}", author_id=user_test.id)
+            for i in range(2)
+        ]
+        medias = [Media(media_path=f"/medias/rows_{i}.png") for i in range(2)]
+        session.add_all(tweets + medias)
+        await session.flush()
+        session.add_all(
+            [
+                MediaVariant(
+                    media_id=medias[0].id,
+                    width=width,
+                    height=width,
+                    media_path=f"/medias/rows_{width}w.webp",
+                )
+                for width in (64, 16)
+            ]
+            + [
+                TweetMedia(tweet_id=tweets[0].id, media_id=media.id)
+                for media in medias
+            ]
+            + [
+                TweetLike(tweet_id=tweets[0].id, user_id=user_id)
+                for user_id in (3, 1)
+            ]
+        )
+        await session.commit()
+    async with as_session() as session:
+        loaded = await session.scalars(
+            select(Tweet)
+            .filter(Tweet.author_id == user_test.id)
+            .order_by(Tweet.id.desc())
+        )
+        expected = build_dicts(loaded.unique())
+        executed_statements.clear()
+        rows = await User.get_feed(session, user_id=user_test.id)
+        assert len(executed_statements) == 1
+        compact_rows = await User.get_feed(
+            session, user_id=user_test.id, compact=True, likes_sample=1
+        )
+    assert rows == expected
+    assert rows[1]["attachments"] == [media.media_path for media in medias]
+    variants = rows[1]["attachment_variants"][0]["variants"]
+    assert [variant["width"] for variant in variants] == [16, 64]
+    assert rows[0]["attachments"] == rows[0]["likes"] == []
+    assert compact_rows[1] == {
+        **{key: rows[1][key] for key in rows[1] if key != "likes"},
+        "like_count": 2,
+        "liked_by_me": False,
+        "likes": [{"id": 1, "name": "test_1"}],
+    }
+    async with as_session() as session:
+        for tweet in tweets:
+            await session.execute(delete(Tweet).filter(Tweet.id == tweet.id))
+        for media in medias:
+            await session.execute(delete(Media).filter(Media.id == media.id))
+        await session.commit()
+
+
+async def test_feed_stream(async_client, user_test, monkeypatch):
+    hub = EventHub(queue_size=2)
+    monkeypatch.setattr(tweets_api.routes, "hub", hub)
+    headers = [("api-key", user_test.api_key)]
+    other_headers = [("api-key", "test_3")]
+    stream = asyncio.create_task(
+        async_client.get("/api/tweets/stream", headers=headers)
+    )
+    while not hub.listening:
+        await asyncio.sleep(0.01)
+    response = await async_client.post(
+        "/api/tweets",
+        headers=headers,
+        json={"tweet_data": "Live", "tweet_media_ids": []},
+    )
+    tweet_id = response.json().get("tweet_id")
+    await async_client.post(
+        f"/api/tweets/{tweet_id}/likes", headers=other_headers
+    )
+    # Not followed author
+    await async_client.post(
+        "/api/tweets",
+        headers=other_headers,
+        json={"tweet_data": "Hidden", "tweet_media_ids": []},
+    )
+    # The client does not read these in time, the stream is reset
+    for _ in range(3):
+        await hub.publish(
+            {"type": "tweet", "tweet_id": 0, "author_id": user_test.id}
+        )
+    response = await asyncio.wait_for(stream, 5)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (lines[0].removeprefix("event: "), orjson.loads(lines[1][6:]))
+        for lines in (
+            message.split("\n")
+            for message in response.text.split("\n\n")
+            if message
+        )
+    ]
+    assert events == [
+        ("tweet", {"type": "tweet", "tweet_id": tweet_id, "author_id": 2}),
+        (
+            "like",
+            {
+                "type": "like",
+                "tweet_id": tweet_id,
+                "author_id": 2,
+                "delta": 1,
+                "like_count": 1,
+            },
+        ),
+        ("tweet", {"type": "tweet", "tweet_id": 0, "author_id": 2}),
+        ("reset", {}),
+    ]
+    assert not hub.listening
+
+
+async def test_event_hub_pg_notify(engine):
+    dsn = engine.url.set(drivername="postgresql").render_as_string(
+        hide_password=False
+    )
+    hub = EventHub(dsn=dsn, channel="test_tweet_events")
+    await hub.start()
+    assert hub.listening
+    subscription = hub.subscribe({1})
+    for author_id in (2, 1):
+        await hub.publish(
+            {"type": "tweet", "tweet_id": 1, "author_id": author_id}
+        )
+    event = await asyncio.wait_for(subscription.queue.get(), 5)
+    assert event["author_id"] == 1
+    assert subscription.queue.empty()
+
+    # Publishes at once share the connection of the hub
+    await asyncio.gather(
+        *(
+            hub.publish({"type": "like", "tweet_id": pk, "author_id": 1})
+            for pk in (1, 2)
+        )
+    )
+    for _ in range(2):
+        await asyncio.wait_for(subscription.queue.get(), 5)
+
+    # A lost listener is reconnected, meanwhile events are delivered locally
+    hub.RECONNECT_DELAY = 0.05
+    pid = hub._connection.get_server_pid()
+    async with engine.connect() as conn:
+        await conn.execute(text(f"SELECT pg_terminate_backend({pid})"))
+    for _ in range(100):
+        if hub._connection is None:
+            break
+        await asyncio.sleep(0.01)
+    await hub.publish({"type": "tweet", "tweet_id": 3, "author_id": 1})
+    event = await asyncio.wait_for(subscription.queue.get(), 5)
+    assert event["tweet_id"] == 3
+    for _ in range(100):
+        if hub._connection is not None:
+            break
+        await asyncio.sleep(0.05)
+    assert hub._connection.get_server_pid() != pid
+    await hub.stop()
+
+
+async def test_server_drains_streams(monkeypatch):
+    import server
+
+    config = server.get_config(workers=1, port=0)
+    assert config.app == "asgi:app"
+    assert config.timeout_keep_alive == server.SERVER_KEEPALIVE
+    assert not config.access_log
+    monkeypatch.setattr(tweets_api.routes, "hub", EventHub())
+    monkeypatch.setattr(tweets_api.events, "hub", tweets_api.routes.hub)
+    stream = tweets_api.routes._stream_events({1})
+    reading = asyncio.ensure_future(stream.__anext__())
+    await asyncio.sleep(0)
+    instance = server.Server(config)
+    # Not started: without listening sockets and lifespan
+    instance.servers, instance.force_exit = [], True
+    await instance.shutdown()
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(reading, 1)
+    assert not tweets_api.routes.hub.listening
+
+
+async def test_batch_likes(
+    async_client, as_session, user_test, executed_statements
+):
+    async with as_session() as session:
+        tweets = [Tweet(content=f"Tweet {i}", author_id=1) for i in range(2)]
+        session.add_all(tweets)
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    tweet_ids = [tweets[0].id, tweets[1].id, tweets[0].id, 0]
+    executed_statements.clear()
+    response = await async_client.post(
+        "/api/tweets/likes:batch",
+        headers=headers,
+        json={"tweet_ids": tweet_ids},
+    )
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"tweet_id": tweets[0].id, "status": 201},
+        {"tweet_id": tweets[1].id, "status": 201},
+        {"tweet_id": 0, "status": 404},
+    ]
+    inserts = [
+        statement
+        for statement, _ in executed_statements
+        if "INSERT INTO tweet_likes" in statement
+    ]
+    assert len(inserts) == 1
+    response = await async_client.post(
+        "/api/tweets/likes:batch",
+        headers=headers,
+        json={"tweet_ids": [tweets[1].id]},
+    )
+    assert response.json()["results"] == [
+        {"tweet_id": tweets[1].id, "status": 200}
+    ]
+    response = await async_client.post(
+        "/api/tweets/likes:batch", headers=headers, json={"tweet_ids": []}
+    )
+    assert response.status_code == 422
+    response = await async_client.post(
+        "/api/tweets/likes:batch",
+        headers=headers,
+        json={"tweet_ids": [tweets[0].id, MAX_PK + 1]},
+    )
+    assert response.status_code == 422
+    async with as_session() as session:
+        for tweet in tweets:
+            tweet = await session.get(Tweet, tweet.id)
+            assert tweet.like_count == 1
+            await session.delete(tweet)
+        await session.commit()
+
+
+async def test_batch_follow(async_client, as_session, user_test):
+    async with as_session() as session:
+        tweet = Tweet(content="Backfilled", author_id=1)
+        session.add(tweet)
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    response = await async_client.post(
+        "/api/users/follow:batch",
+        headers=headers,
+        json={"user_ids": [1, 3, 0]},
+    )
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"user_id": 1, "status": 201},
+        {"user_id": 3, "status": 201},
+        {"user_id": 0, "status": 404},
+    ]
+    response = await async_client.post(
+        "/api/users/follow:batch", headers=headers, json={"user_ids": [3]}
+    )
+    assert response.json()["results"] == [{"user_id": 3, "status": 200}]
+    response = await async_client.post(
+        "/api/users/follow:batch",
+        headers=headers,
+        json={"user_ids": [MAX_PK + 1]},
+    )
+    assert response.status_code == 422
+    response = await async_client.get("/api/users/me", headers=headers)
+    assert response.json()["user"]["following_count"] == 2
+    response = await async_client.get("/api/tweets", headers=headers)
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [tweet.id]
+
+
+async def test_get_tweets_by_ids(async_client, as_session, user_test):
+    async with as_session() as session:
+        tweets = [Tweet(content=f"Tweet {i}", author_id=3) for i in range(2)]
+        session.add_all(tweets)
+        await session.flush()
+        session.add(TweetLike(tweet_id=tweets[0].id, user_id=user_test.id))
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    ids = f"{tweets[0].id},0,{tweets[1].id},{tweets[0].id}"
+    response = await async_client.get(
+        "/api/tweets", headers=headers, params={"ids": ids, "compact": True}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [tweet["id"] for tweet in data["tweets"]] == [
+        tweets[0].id,
+        tweets[1].id,
+    ]
+    assert data["tweets"][0]["liked_by_me"]
+    assert data["tweets"][0]["author"] == {"id": 3, "name": "test_3"}
+    assert data["not_found"] == [0]
+    for params in (
+        {"ids": "1,a"},
+        {"ids": "1", "limit": 10},
+        {"ids": f"1,{MAX_PK + 1}"},
+    ):
+        response = await async_client.get(
+            "/api/tweets", headers=headers, params=params
+        )
+        assert response.status_code == 400
+
+
+async def test_benchmark_generator_and_baselines(engine, as_session):
+    import asyncpg
+    from benchmarks.generator import load
+    from benchmarks.load import compare, percentile
+
+    dsn = engine.url.set(drivername="postgresql").render_as_string(
+        hide_password=False
+    )
+    connection = await asyncpg.connect(dsn)
+    loaded = await load(
+        connection,
+        users=30,
+        follows=5,
+        alpha=1.0,
+        tweets=3,
+        likes=2,
+        medias=0.5,
+        seed=1,
+    )
+    counters = await connection.fetchrow(
+        """
+        SELECT
+            (SELECT sum(followers_count) FROM users
+                WHERE api_key LIKE 'bench_%') AS followers,
+            (SELECT sum(following_count) FROM users
+                WHERE api_key LIKE 'bench_%') AS following,
+            (SELECT sum(like_count) FROM tweets
+                WHERE content LIKE 'Benchmark tweet%') AS likes,
+            (SELECT sum(ref_count) FROM medias
+                WHERE media_path LIKE '/medias/bench_%') AS refs
+        """
+    )
+    await connection.execute("DELETE FROM users WHERE api_key LIKE 'bench_%'")
+    await connection.execute(
+        "DELETE FROM medias WHERE media_path LIKE '/medias/bench_%'"
+    )
+    await connection.close()
+    assert loaded["users"] == 30
+    assert counters["followers"] == counters["following"]
+    assert counters["followers"] == loaded["users_follow"]
+    assert counters["likes"] == loaded["tweet_likes"]
+    assert counters["refs"] == loaded["tweet_medias"]
+    assert loaded["user_timelines"] > 0
+
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile([3, 1, 2, 4], 99) == 4
+    baseline = {
+        "GET /api/tweets": {"p50": 10, "p95": 20, "p99": 30, "throughput": 100}
+    }
+    result = {"p50": 11, "p95": 30, "p99": 30, "throughput": 70}
+    assert compare({"GET /api/tweets": result}, baseline, 0.25) == {
+        "GET /api/tweets": ["p95", "throughput"]
+    }
+
+
+async def test_instrumentation(user_test, engine, monkeypatch, caplog):
+    slow_log = instrumentation.SlowLog(size=1, threshold=0)
+    monkeypatch.setattr(instrumentation, "slow_log", slow_log)
+    hub = EventHub()
+    monkeypatch.setattr(tweets_api.routes, "hub", hub)
+    headers = [("api-key", user_test.api_key)]
+    application = app.init_app()
+    async with AsyncClient(app=application, base_url="http://test") as client:
+        # Streams are not timed
+        stream = asyncio.create_task(
+            client.get("/api/tweets/stream", headers=headers)
+        )
+        while not hub.listening:
+            await asyncio.sleep(0.01)
+        hub.drain()
+        response = await asyncio.wait_for(stream, 5)
+        assert response.status_code == 200
+        assert slow_log.slowest() == []
+
+        response = await client.get("/api/tweets", headers=headers)
+        assert response.status_code == 200
+        timing = response.headers["server-timing"]
+        assert timing.startswith("db;dur=")
+        for name in ("auth", "query", "serialize", "app"):
+            assert f"{name};dur=" in timing
+        duration, method, path, stats = slow_log.slowest()[0]
+        assert (method, path) == ("GET", "/api/tweets")
+        assert stats.queries == len(stats.statements) > 0
+        assert any("FROM tweets" in sql for sql, _ in stats.statements)
+        assert "Slow request GET /api/tweets" in caplog.text
+        assert " ms, serialize " in caplog.text
+        for url, params in (
+            ("/api/tweets", {"ids": "1,2"}),
+            (f"/api/users/{user_test.id}", {}),
+        ):
+            response = await client.get(url, headers=headers, params=params)
+            timing = response.headers["server-timing"]
+            assert "query;dur=" in timing and "serialize;dur=" in timing
+
+        response = await client.get("/api/metrics")
+        assert response.status_code == 200
+    metrics = response.text
+    labels = 'method="GET",route="/api/tweets"'
+    assert (
+        f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}'
+        in metrics
+    )
+    assert f'http_responses_total{{{labels},status="200"}}' in metrics
+    assert f"db_queries_total{{{labels}}}" in metrics
+    assert "db_pool_checked_out" in metrics
+    labels = 'method="GET",route="/api/tweets/stream"'
+    assert f'http_responses_total{{{labels},status="200"}}' in metrics
+    assert f"http_request_duration_seconds_count{{{labels}}}" not in metrics
+
+    # A failed query does not leave its start time to the next one
+    token = instrumentation._request_stats.set(instrumentation.RequestStats())
+    try:
+        async with engine.connect() as conn:
+            with pytest.raises(DBAPIError):
+                await conn.execute(text("SELECT 1 / 0"))
+            assert not conn.sync_connection.info.get("query_started")
+    finally:
+        instrumentation._request_stats.reset(token)
+
+
+async def test_query_bounds(async_client, as_session, user_test, query_guard):
+    async with as_session() as session:
+        tweets = [
+            Tweet(content=f"Bounded {i}", author_id=user_test.id)
+            for i in range(25)
+        ]
+        media = Media(media_path="/medias/bounded.png")
+        session.add_all(tweets + [media])
+        await session.flush()
+        session.add_all(
+            [
+                TweetMedia(tweet_id=tweet.id, media_id=media.id)
+                for tweet in tweets
+            ]
+            + [
+                TweetLike(tweet_id=tweet.id, user_id=user_id)
+                for tweet in tweets
+                for user_id in (1, 2, 3)
+            ]
+        )
+        await session.commit()
+    headers = [("api-key", user_test.api_key)]
+    # Authenticate once, the principal is cached then
+    await async_client.get("/api/users/me", headers=headers)
+
+    # The feed takes the same queries for any page size
+    with query_guard(3, "GET /api/tweets?limit=1") as page_of_one:
+        response = await async_client.get(
+            "/api/tweets", headers=headers, params={"limit": 1}
+        )
+    assert len(response.json()["tweets"]) == 1
+    with query_guard(3, "GET /api/tweets?limit=20", page_of_one) as page:
+        response = await async_client.get(
+            "/api/tweets", headers=headers, params={"limit": 20}
+        )
+    assert len(response.json()["tweets"]) == 20
+    assert len(page) == len(page_of_one)
+    with query_guard(3, "GET /api/tweets?compact=true"):
+        await async_client.get(
+            "/api/tweets", headers=headers, params={"compact": True}
+        )
+    with query_guard(4, "GET /api/users/me"):
+        await async_client.get("/api/users/me", headers=headers)
+    with query_guard(3, "POST /api/tweets/{pk}/likes"):
+        await async_client.post(
+            f"/api/tweets/{tweets[0].id}/likes", headers=headers
+        )
+    with query_guard(5, "POST /api/tweets"):
+        await async_client.post(
+            "/api/tweets",
+            headers=headers,
+            json={"tweet_data": "Bounded", "tweet_media_ids": [media.id]},
+        )
+
+    guard = query_guard(1, "GET /api/tweets?limit=20", page_of_one)
+    with pytest.raises(pytest.fail.Exception) as failure:
+        with guard:
+            await async_client.get(
+                "/api/tweets", headers=headers, params={"limit": 20}
+            )
+            await async_client.get(
+                "/api/tweets", headers=headers, params={"limit": 20}
+            )
+    report = str(failure.value)
+    assert report.startswith(
+        "GET /api/tweets?limit=20: 4 statements, at most 1 expected"
+    )
+    assert "--- reference" in report
+    assert "\n+SELECT" in report
+    assert "Repeated statements:" in report
+    assert "  2x SELECT" in report
+
+
+@pytest.mark.parametrize("shared", [False, True])
+async def test_rate_limit(user_test, monkeypatch, shared):
+    store = ratelimit.LocalRedis()
+    if shared:
+        backend = ratelimit.RedisBackend(store)
+    else:
+        backend = ratelimit.MemoryBackend()
+    limiter = ratelimit.RateLimiter(
+        backend,
+        rate=1,
+        burst=10,
+        costs={"GET /api/tweets": 5, "GET /api/metrics": 0},
+    )
+    monkeypatch.setattr(ratelimit, "limiter", limiter)
+    # Reads from the primary, but with pool metrics of its own
+    replica = SimpleNamespace(
+        sync_engine=database.models.engine.sync_engine,
+        pool=SimpleNamespace(metrics=database.pool.PoolMetrics()),
+    )
+    monkeypatch.setattr(database.routing, "replica_engines", [replica])
+    principals.clear()
+    headers = [("api-key", user_test.api_key)]
+    application = app.init_app()
+    async with AsyncClient(app=application, base_url="http://test") as client:
+        for _ in range(2):
+            response = await client.get("/api/tweets", headers=headers)
+            assert response.status_code == 200
+        response = await client.get("/api/tweets", headers=headers)
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "5"
+        assert not response.json()["result"]
+        response = await client.post("/api/tweets/1/likes", headers=headers)
+        assert response.status_code == 429
+        # A wrong api-key empties only its own bucket
+        for status_code in (400, 400, 429):
+            response = await client.get(
+                "/api/tweets", headers=[("api-key", "unknown_1")]
+            )
+            assert response.status_code == status_code
+        # Not authenticated by this worker yet, and from the same address
+        response = await client.get(
+            "/api/tweets", headers=[("api-key", "test_1")]
+        )
+        assert response.status_code == 200
+        # Free routes are not limited
+        response = await client.get("/api/metrics")
+        assert response.status_code == 200
+
+        for pool_metrics in (
+            database.models.engine.pool.metrics,
+            replica.pool.metrics,
+        ):
+            try:
+                for _ in range(10):
+                    pool_metrics.observe_wait(2.0)
+                response = await client.get(
+                    "/api/users/me", headers=[("api-key", "test_3")]
+                )
+                assert response.status_code == 503
+                assert int(response.headers["retry-after"]) >= 1
+                response = await client.get("/api/metrics")
+                assert response.status_code == 200
+            finally:
+                pool_metrics.reset()
+    assert len(store.data) == (3 if shared else 0)
+    for key in store.data:
+        assert key.startswith("ratelimit:") and "test_" not in key
+    if not shared:
+        assert len(backend._buckets) == 3
+        assert not any("test_" in key for key in backend._buckets)